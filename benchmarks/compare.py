@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# compare.py: Compares two results files of run_benchmarks.py
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import sys
+import json
+import argparse
+
+# Keys where a lower value is better. Other numbers are only shown
+LOWER_IS_BETTER = ('seconds', 'sgd_seconds', 'mean', 'p50', 'p95', 'p99')
+
+
+def compare(base, new, threshold):
+    """Returns one row for each time measured in both reports
+
+    :param dict base: The report used as reference
+    :param dict new: The report to compare
+    :param float threshold: Ratio over which a time is a regression
+    :return: A list of (size, benchmark, key, base, new, ratio, regression)
+    :rtype: list
+    """
+    rows = []
+    for size, base_size in sorted(base['sizes'].items()):
+        if size not in new['sizes']:
+            continue
+        new_results = new['sizes'][size]['results']
+        for bench, base_values in sorted(base_size['results'].items()):
+            if bench not in new_results:
+                continue
+            for key in LOWER_IS_BETTER:
+                old = base_values.get(key)
+                cur = new_results[bench].get(key)
+                if not old or cur is None:
+                    continue
+                ratio = cur / old
+                rows.append((size, bench, key, old, cur, ratio,
+                             ratio > threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compares two benchmark results and shows regressions")
+    parser.add_argument('base', help="Results of the reference commit")
+    parser.add_argument('new', help="Results of the commit to check")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="Ratio new/base considered a regression")
+    args = parser.parse_args(argv)
+
+    with open(args.base) as base_file:
+        base = json.load(base_file)
+    with open(args.new) as new_file:
+        new = json.load(new_file)
+
+    print("Base: {}  New: {}".format(base.get('commit'), new.get('commit')))
+    rows = compare(base, new, args.threshold)
+    for size, bench, key, old, cur, ratio, regression in rows:
+        print("{0:>9} {1:<32} {2:<12} {3:>10.4f} {4:>10.4f} {5:>6.2f}x{6}"
+              .format(size, bench, key, old, cur, ratio,
+                      "  REGRESSION" if regression else ""))
+
+    # Non zero exit code, so it can be used from scripts
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
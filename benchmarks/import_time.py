@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# import_time.py: Times the start of the web and worker processes
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import subprocess
+import numpy as np
+
+# Root of the repository and directory the services are started from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICE_DIR = os.path.join(ROOT, "rest-service")
+
+# Modules that must not be imported until a request or task needs them
+HEAVY_MODULES = ('skge', 'sklearn', 'annoy', 'elasticsearch', 'requests',
+                 'redis', 'celery')
+
+# Module imported by each process, and the heavy modules it may import
+TARGETS = {
+    'web': ('routes', ()),
+    'worker': ('async_server.tasks', ('celery', 'redis')),
+}
+
+# Runs on a fresh interpreter: imports the module and reports the time and
+# the heavy modules loaded
+CHILD = """
+import sys, json, time, importlib
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds,
+                  'modules': [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+
+def git_commit():
+    """Returns the commit of the working tree, if it is a git repository"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_import(module, python=sys.executable):
+    """Imports a module on a new interpreter, as a new process does
+
+    :param str module: The module imported
+    :param str python: The interpreter used
+    :return: The import time, the time of the whole process and the heavy
+             modules imported, or an error
+    :rtype: dict
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT, SERVICE_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    env['PYTHONDONTWRITEBYTECODE'] = "1"
+    start = timeit.default_timer()
+    child = subprocess.run([python, "-c", CHILD, module] +
+                           list(HEAVY_MODULES),
+                           cwd=SERVICE_DIR, env=env, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE)
+    process_seconds = timeit.default_timer() - start
+    if child.returncode != 0:
+        lines = child.stderr.decode("utf-8").strip().splitlines()
+        return {'error': lines[-1] if lines else "exit code {}"
+                .format(child.returncode)}
+    result = json.loads(child.stdout.decode("utf-8").strip().splitlines()[-1])
+    result['process_seconds'] = process_seconds
+    return result
+
+
+def run_target(name, repeat):
+    """Imports the module of a process several times
+
+    :return: The times of the imports and the heavy modules loaded
+    :rtype: dict
+    """
+    module, allowed = TARGETS[name]
+    runs = [time_import(module) for _ in range(repeat)]
+    errors = [run['error'] for run in runs if 'error' in run]
+    if errors:
+        return {'module': module, 'error': errors[0]}
+    seconds = np.array([run['seconds'] for run in runs])
+    process = np.array([run['process_seconds'] for run in runs])
+    heavy = sorted(m for m in runs[0]['modules'] if m not in allowed)
+    return {'module': module,
+            'runs': repeat,
+            'seconds': float(np.median(seconds)),
+            'p95': float(np.percentile(seconds, 95)),
+            'process_seconds': float(np.median(process)),
+            'heavy_modules': heavy}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Times the imports done when the services start")
+    parser.add_argument('--targets', nargs='+', default=sorted(TARGETS),
+                        choices=sorted(TARGETS))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Imports of each module, on new processes")
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help="Fail if an import takes longer")
+    parser.add_argument('--output', default=None,
+                        help="Save a report that compare.py can read")
+    args = parser.parse_args(argv)
+
+    results, failed = {}, False
+    for name in args.targets:
+        result = run_target(name, args.repeat)
+        results['import_' + name] = result
+        if 'error' in result:
+            print("{0:<8} {1}: {2}".format(name, result['module'],
+                                           result['error']))
+            failed = True
+            continue
+        slow = args.max_seconds is not None and \
+            result['seconds'] > args.max_seconds
+        print("{0:<8} {1:<20} {2:>8.4f}s  process {3:>8.4f}s{4}{5}".format(
+            name, result['module'], result['seconds'],
+            result['process_seconds'],
+            "  SLOW" if slow else "",
+            "  HEAVY: " + ", ".join(result['heavy_modules'])
+            if result['heavy_modules'] else ""))
+        failed = failed or slow or bool(result['heavy_modules'])
+
+    if args.output:
+        report = {
+            'commit': git_commit(),
+            'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': vars(args),
+            'sizes': {'startup': {'results': results}}
+        }
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        print("Results saved on {}".format(args.output))
+
+    # Non zero exit code, so it can be used from scripts
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# run_benchmarks.py: Times the core paths of kgeserver on synthetic graphs
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import skge
+import kgeserver.dataset as dataset
+import kgeserver.algorithm as algorithm
+import kgeserver.native_trainer as native_trainer
+import kgeserver.server as server
+
+# Import the generator from this directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+try:
+    import synthetic_kg
+except ImportError:
+    raise
+
+# Model and evaluator used for every model name
+MODELS = {
+    'TransE': (skge.TransE, algorithm.TransEEval),
+    'HolE': (skge.HolE, algorithm.HolEEval),
+}
+
+# Trainer class of every trainer name, and the suffix of its results
+TRAINERS = {
+    'skge': (skge.PairwiseStochasticTrainer, ''),
+    'native': (native_trainer.PairwiseTrainer, '_native'),
+}
+
+
+def git_commit():
+    """Returns the commit of the working tree, if it is a git repository"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentiles(values):
+    """Returns the latency summary of a list of seconds"""
+    values = np.asarray(values, dtype=np.float64)
+    return {'mean': float(values.mean()),
+            'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+            'p99': float(np.percentile(values, 99))}
+
+
+class Timer():
+    """Measures the wall time of a with block"""
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = timeit.default_timer() - self.start
+        return False
+
+
+def bench_dataset(dtset, workdir):
+    """Times train_split, save_to_binary and load_from_binary
+
+    :return: The results and the path of the saved dataset
+    :rtype: tuple
+    """
+    results = {}
+    dtset.splited_subs = {'updated': False}
+    with Timer() as t:
+        dtset.train_split()
+    results['train_split'] = {'seconds': t.seconds}
+
+    path = os.path.join(workdir, "dataset.bin")
+    with Timer() as t:
+        dtset.save_to_binary(path)
+    results['dataset_save'] = {'seconds': t.seconds,
+                               'bytes': os.path.getsize(path)}
+
+    loaded = dataset.Dataset()
+    with Timer() as t:
+        loaded.load_from_binary(path)
+    results['dataset_load'] = {'seconds': t.seconds}
+    return results, path
+
+
+def bench_epoch(dtset, model_name, args, trainer_name='skge'):
+    """Trains one epoch of a model
+
+    :return: The results and the trained model
+    :rtype: tuple
+    """
+    model_type, eval_type = MODELS[model_name]
+    trainer = algorithm.ModelTrainer(dtset, model_type=model_type,
+                                     trainer_type=TRAINERS[trainer_name][0],
+                                     eval_type=eval_type, ncomp=args.ncomp,
+                                     max_epochs=1, test_all=-1,
+                                     train_all=True, nbatches=args.nbatches,
+                                     workers=args.workers)
+    with Timer() as t:
+        model = trainer.run()
+    sgd_time = trainer.telemetry.series['sgd_time'][0]
+    return {'seconds': t.seconds,
+            'sgd_seconds': sgd_time,
+            'epochs_per_sec': 1 / sgd_time if sgd_time else None,
+            'triples_per_sec': trainer.n_train / sgd_time if sgd_time
+            else None}, model
+
+
+def bench_ranking(dtset, model, model_name, args):
+    """Times FilteredRankingEval.positions over a sample of test triples"""
+    subs = dtset.train_split()
+    true_triples = subs['train_subs'] + subs['valid_subs'] + \
+        subs['test_subs']
+    rng = np.random.RandomState(args.seed)
+    test = subs['test_subs']
+    sample = [test[i] for i in rng.permutation(len(test))[:args.eval_triples]]
+    evaluator = MODELS[model_name][1](sample, true_triples)
+    with Timer() as t:
+        pos, fpos = evaluator.positions(model)
+    ranked = sum(len(p['head']) for p in pos.values())
+    return {'seconds': t.seconds,
+            'triples': ranked,
+            'triples_per_sec': ranked / t.seconds if t.seconds else None}
+
+
+def bench_search_index(model, args):
+    """Times the build of the search index and the queries of the Server"""
+    results = {}
+    search_index = server.SearchIndex()
+    with Timer() as t:
+        search_index.build_from_trained_model(model, args.trees)
+    results['search_index_build'] = {'seconds': t.seconds,
+                                     'trees': args.trees}
+
+    srv = server.Server(search_index)
+    rng = np.random.RandomState(args.seed)
+    ids = rng.randint(0, model.E.shape[0], size=args.queries).tolist()
+    latencies = []
+    with Timer() as total:
+        for entity_id in ids:
+            with Timer() as t:
+                srv.similarity_by_id(entity_id, args.k,
+                                     search_k=args.search_k)
+            latencies.append(t.seconds)
+    query = percentiles(latencies)
+    query.update({'queries': len(ids),
+                  'k': args.k,
+                  'search_k': args.search_k,
+                  'queries_per_sec': len(ids) / total.seconds})
+    results['server_query'] = query
+    return results
+
+
+def run_size(n_triples, args):
+    """Runs all benchmarks on a synthetic graph of the given size"""
+    print("Generating a graph with {} triples".format(n_triples))
+    with Timer() as t:
+        dtset, classes = synthetic_kg.synthetic_dataset(
+            n_triples, seed=args.seed, n_relations=args.relations,
+            alpha=args.alpha)
+    graph = {'triples': len(dtset.subs),
+             'entities': len(dtset.entities),
+             'relations': len(dtset.relations),
+             'classes': dict((c, len(r)) for c, r in classes.items()),
+             'generation_seconds': t.seconds}
+
+    workdir = tempfile.mkdtemp(prefix="kgeserver-bench-")
+    results, path = bench_dataset(dtset, workdir)
+    for model_name in args.models:
+        # The rest of the benchmarks use the model of the first trainer
+        models = []
+        for trainer_name in args.trainers:
+            print("Training one epoch of {} with {}".format(
+                model_name, trainer_name))
+            epoch, model = bench_epoch(dtset, model_name, args, trainer_name)
+            results['epoch_' + model_name + TRAINERS[trainer_name][1]] = epoch
+            models.append(model)
+        model = models[0]
+        results['ranking_' + model_name] = bench_ranking(dtset, model,
+                                                         model_name, args)
+        for name, value in bench_search_index(model, args).items():
+            results[name + '_' + model_name] = value
+    os.remove(path)
+    os.rmdir(workdir)
+    return {'graph': graph, 'results': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks kgeserver with synthetic knowledge graphs")
+    parser.add_argument('--triples', type=int, nargs='+', default=[10000],
+                        help="Sizes of the graphs, in triples")
+    parser.add_argument('--relations', type=int, default=50)
+    parser.add_argument('--alpha', type=float, default=1.1,
+                        help="Exponent of the degree distribution")
+    parser.add_argument('--models', nargs='+', default=['TransE', 'HolE'],
+                        choices=sorted(MODELS))
+    parser.add_argument('--ncomp', type=int, default=50)
+    parser.add_argument('--nbatches', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Training processes (0 uses all the cores)")
+    parser.add_argument('--trainers', nargs='+', default=['skge'],
+                        choices=sorted(TRAINERS),
+                        help="Trainers timed on the epoch benchmark")
+    parser.add_argument('--eval-triples', type=int, default=500,
+                        help="Test triples ranked by the evaluator")
+    parser.add_argument('--trees', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--search-k', type=int, default=-1)
+    parser.add_argument('--seed', type=int, default=137)
+    parser.add_argument('--output', default="benchmark_results.json")
+    args = parser.parse_args(argv)
+
+    report = {
+        'commit': git_commit(),
+        'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'config': vars(args),
+        'sizes': {}
+    }
+    for n_triples in args.triples:
+        report['sizes'][str(n_triples)] = run_size(n_triples, args)
+
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print("Results saved on {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
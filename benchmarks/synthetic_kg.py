@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# synthetic_kg.py: Generates synthetic knowledge graphs for benchmarks
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import numpy as np
+import kgeserver.dataset as dataset
+import kgeserver.graph_statistics as graph_statistics
+
+# Share of relations of each class, if no other is given
+DEFAULT_CARDINALITIES = {'1-1': 0.1, '1-N': 0.2, 'M-1': 0.3, 'M-N': 0.4}
+
+ENTITY_URI = "http://example.org/entity/E{}"
+RELATION_URI = "http://example.org/relation/P{}"
+
+
+def power_law_weights(n_elements, alpha):
+    """Probability of every element, following a Zipf like distribution
+
+    The element with rank r has a probability proportional to r^-alpha.
+
+    :param int n_elements: The number of elements
+    :param float alpha: The exponent. Greater values give bigger hubs
+    :rtype: numpy.ndarray
+    """
+    weights = np.arange(1, n_elements + 1, dtype=np.float64) ** -alpha
+    return weights / weights.sum()
+
+
+def _unique_side(n_entities, size, rng):
+    """Draws entities without repetitions while it is possible"""
+    if size <= n_entities:
+        return rng.permutation(n_entities)[:size]
+    return rng.randint(0, n_entities, size=size)
+
+
+def _draw_triples(rng, rel_sizes, rel_classes, hubs, entity_weights):
+    """Draws the triples of every relation, following its class
+
+    The classes use the same convention as graph_statistics: on a 1-N
+    relation every head has about one tail, and tails have many heads.
+    """
+    n_entities = len(hubs)
+    blocks = []
+    for p, size in enumerate(rel_sizes):
+        if size == 0:
+            continue
+        head_side, tail_side = rel_classes[p].split("-")
+        if head_side == "1":
+            ss = _unique_side(n_entities, size, rng)
+        else:
+            ss = hubs[rng.choice(n_entities, size=size, p=entity_weights)]
+        if tail_side == "1":
+            os = _unique_side(n_entities, size, rng)
+        else:
+            os = hubs[rng.choice(n_entities, size=size, p=entity_weights)]
+        blocks.append(np.column_stack((ss, os, np.full(size, p))))
+    return np.concatenate(blocks).astype(np.int64)
+
+
+def generate_triples(n_triples, n_entities=None, n_relations=50,
+                     alpha=1.1, relation_alpha=0.8, cardinalities=None,
+                     seed=137):
+    """Generates the triples of a synthetic knowledge graph
+
+    The degree of the entities follows a power law, and every relation
+    behaves as one of the classes 1-1, 1-N, M-1 or M-N: the "1" sides are
+    drawn without repetitions, and the "N" sides are drawn from the power
+    law. The number of triples of each relation is also skewed, like on real
+    graphs, where a few relations hold most of the triples.
+
+    Duplicated triples are removed, and more triples are drawn to replace
+    them. The same seed always gives the same graph.
+
+    :param int n_triples: The number of triples wanted
+    :param int n_entities: The number of entities. Default is n_triples / 5
+    :param int n_relations: The number of relations
+    :param float alpha: Exponent of the degree distribution of entities
+    :param float relation_alpha: Exponent of the size of relations
+    :param dict cardinalities: Share of relations of each class
+    :param int seed: The seed of the random generator
+    :return: The (subject, object, predicate) array and the relation classes
+    :rtype: tuple
+    """
+    rng = np.random.RandomState(seed)
+    if n_entities is None:
+        n_entities = max(n_triples // 5, 10)
+    if cardinalities is None:
+        cardinalities = DEFAULT_CARDINALITIES
+
+    classes = sorted(cardinalities)
+    shares = np.array([cardinalities[c] for c in classes], dtype=np.float64)
+    rel_classes = rng.choice(classes, size=n_relations, p=shares/shares.sum())
+    rel_weights = power_law_weights(n_relations, relation_alpha)
+
+    # Hubs are not always the first ids
+    entity_weights = power_law_weights(n_entities, alpha)
+    hubs = rng.permutation(n_entities)
+
+    # Duplicates are found after drawing, so draw more if needed
+    n_draw = n_triples
+    for _ in range(3):
+        rel_sizes = rng.multinomial(n_draw, rel_weights)
+        xs = _draw_triples(rng, rel_sizes, rel_classes, hubs, entity_weights)
+        xs = graph_statistics.unique_triples(xs, n_entities, n_relations)
+        if len(xs) >= n_triples:
+            break
+        n_draw = int(n_draw * 1.05 * n_triples / max(len(xs), 1))
+
+    xs = xs[rng.permutation(len(xs))[:n_triples]]
+    classes_dict = dict((c, np.flatnonzero(rel_classes == c).tolist())
+                        for c in classes)
+    return xs, classes_dict
+
+
+def build_dataset(xs, n_entities, n_relations):
+    """Creates a Dataset with the given triples
+
+    Entities and relations get synthetic URIs, so the dataset can be saved,
+    loaded, trained and queried like the ones built from SPARQL endpoints.
+
+    :param numpy.ndarray xs: The (subject, object, predicate) array
+    :param int n_entities: The number of entities
+    :param int n_relations: The number of relations
+    :rtype: kgeserver.dataset.Dataset
+    """
+    dtset = dataset.Dataset()
+    # Avoid sharing the lists of the class with other datasets
+    dtset.entities = [ENTITY_URI.format(i) for i in range(n_entities)]
+    dtset.relations = [RELATION_URI.format(i) for i in range(n_relations)]
+    dtset.entities_dict = {}
+    dtset.relations_dict = {}
+    dtset._load_elements_into_dict(dtset.entities_dict, dtset.entities)
+    dtset._load_elements_into_dict(dtset.relations_dict, dtset.relations)
+    dtset.subs = [tuple(triple) for triple in xs.tolist()]
+    dtset.statistics = None
+    return dtset
+
+
+def synthetic_dataset(n_triples, seed=137, **kwargs):
+    """Generates a synthetic Dataset. See `generate_triples` arguments
+
+    :param int n_triples: The number of triples wanted
+    :param int seed: The seed of the random generator
+    :return: The dataset and the class of each relation
+    :rtype: tuple
+    """
+    n_entities = kwargs.pop('n_entities', None)
+    if n_entities is None:
+        n_entities = max(n_triples // 5, 10)
+    n_relations = kwargs.pop('n_relations', 50)
+    xs, classes = generate_triples(n_triples, n_entities=n_entities,
+                                   n_relations=n_relations, seed=seed,
+                                   **kwargs)
+    return build_dataset(xs, n_entities, n_relations), classes
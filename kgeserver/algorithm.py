@@ -23,12 +23,48 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import pickle
+import collections
 import numpy as np
 import threading
 import itertools
-import skge
 import kgeserver.dataset as dataset
 import kgeserver.experiment as experiment
+import kgeserver.native_trainer as native_trainer
+from kgeserver.lazy_import import lazy_import
+
+# Imported when a model is trained or scored
+skge = lazy_import("skge")
+
+
+# Number of values computed at once when scoring all entities with TransE
+SCORE_BLOCK = 2 ** 16
+
+
+def _l1_scores(queries, entities):
+    """Negative L1 distance between each query row and each entity row
+
+    Entities are processed by blocks on a reused buffer small enough to stay
+    on the CPU cache, even with millions of entities. Rows are summed with a
+    dot product, which is faster than numpy.sum over short rows.
+
+    :param numpy.ndarray queries: A (n_queries, ncomp) matrix
+    :param numpy.ndarray entities: A (n_entities, ncomp) matrix
+    :return: A (n_queries, n_entities) matrix
+    :rtype: numpy.ndarray
+    """
+    scores = np.empty((len(queries), len(entities)), dtype=entities.dtype)
+    rows = max(1, SCORE_BLOCK // entities.shape[1])
+    buf = np.empty((rows, entities.shape[1]), dtype=entities.dtype)
+    ones = np.ones(entities.shape[1], dtype=entities.dtype)
+    for start in range(0, len(entities), rows):
+        block = entities[start:start + rows]
+        diff = buf[:len(block)]
+        for i, query in enumerate(queries):
+            np.subtract(block, query, out=diff)
+            np.abs(diff, out=diff)
+            np.dot(diff, ones, out=scores[i, start:start + len(block)])
+    return np.negative(scores, out=scores)
 
 
 class TransEEval(experiment.FilteredRankingEval):
@@ -42,11 +78,157 @@ class TransEEval(experiment.FilteredRankingEval):
     def scores_s(self, mdl, o, p):
         return -np.sum(np.abs(self.ER - mdl.E[o]), axis=1)
 
+    @staticmethod
+    def batch_scores_o(mdl, ss, ps):
+        """Scores every entity as object of many (s, p, ?) queries
+
+        :param skge.TransE mdl: The trained model
+        :param numpy.ndarray ss: The subject of each query
+        :param numpy.ndarray ps: The predicate of each query
+        :return: A (n_queries, n_entities) matrix. Higher is better
+        :rtype: numpy.ndarray
+        """
+        return _l1_scores(mdl.E[ss] + mdl.R[ps], mdl.E)
+
+    @staticmethod
+    def batch_scores_s(mdl, os, ps):
+        """Scores every entity as subject of many (?, p, o) queries
+
+        :param skge.TransE mdl: The trained model
+        :param numpy.ndarray os: The object of each query
+        :param numpy.ndarray ps: The predicate of each query
+        :return: A (n_queries, n_entities) matrix. Higher is better
+        :rtype: numpy.ndarray
+        """
+        # |s + p - o| is the same as |s - (o - p)|
+        return _l1_scores(mdl.E[os] - mdl.R[ps], mdl.E)
+
+
+class HolEEngine(object):
+    """Scores HolE triples in the frequency domain
+
+    HolE scores a triple as ``p · ccorr(s, o)``, and a circular correlation
+    is an element-wise product of Fourier transforms:
+    ``ccorr(a, b) = irfft(conj(rfft(a)) * rfft(b))``. The rfft of all the
+    entities and relations is computed once, when the engine is created, so
+    the correlations of many (relation, entity) pairs only need a product
+    and an inverse transform.
+
+    The projections of all the entities by a relation, ``ccorr(p, E)``, are
+    kept in memory until they use more than *cache_bytes*, and the least
+    recently used are removed first.
+
+    The engine must be created again if the model parameters change.
+    """
+    def __init__(self, mdl, cache_bytes=2 ** 28):
+        """Computes the transforms of a model
+
+        :param skge.HolE mdl: The model
+        :param int cache_bytes: Memory for the relation projections
+        """
+        self.model = mdl
+        self.ncomp = mdl.E.shape[1]
+        self.dtype = mdl.E.dtype
+        # Single precision transforms for float32 embeddings
+        ctype = np.complex64 if self.dtype == np.float32 else np.complex128
+        self.fE = np.fft.rfft(mdl.E).astype(ctype, copy=False)
+        self.fR = np.fft.rfft(mdl.R).astype(ctype, copy=False)
+        self.cache_bytes = cache_bytes
+        self.projections = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _irfft(self, spectrum):
+        return np.fft.irfft(spectrum, n=self.ncomp).astype(self.dtype,
+                                                           copy=False)
+
+    def ccorr(self, ps, es):
+        """Returns ccorr(R[p], E[e]) for many (relation, entity) pairs
+
+        :param numpy.ndarray ps: The relations
+        :param numpy.ndarray es: The entities
+        :return: A (n_pairs, ncomp) matrix
+        :rtype: numpy.ndarray
+        """
+        return self._irfft(np.conj(self.fR[ps]) * self.fE[es])
+
+    def cconv(self, es, ps):
+        """Returns cconv(E[e], R[p]) for many (entity, relation) pairs
+
+        :param numpy.ndarray es: The entities
+        :param numpy.ndarray ps: The relations
+        :return: A (n_pairs, ncomp) matrix
+        :rtype: numpy.ndarray
+        """
+        return self._irfft(self.fE[es] * self.fR[ps])
+
+    def projection(self, p):
+        """Returns ccorr(R[p], E), the projection of all entities
+
+        :param int p: The relation
+        :return: A (n_entities, ncomp) matrix. Do not modify it
+        :rtype: numpy.ndarray
+        """
+        with self.lock:
+            if p in self.projections:
+                self.projections.move_to_end(p)
+                return self.projections[p]
+        proj = self._irfft(np.conj(self.fR[p]) * self.fE)
+        with self.lock:
+            self.projections[p] = proj
+            used = sum(value.nbytes for value in self.projections.values())
+            while len(self.projections) > 1 and used > self.cache_bytes:
+                _, old = self.projections.popitem(last=False)
+                used -= old.nbytes
+        return proj
+
+    def scores_o(self, ss, ps):
+        """Scores every entity as object of many (s, p, ?) queries
+
+        The score p · ccorr(s, o) is equal to o · cconv(s, p), so all
+        entities are scored with a single matrix product.
+
+        :param numpy.ndarray ss: The subject of each query
+        :param numpy.ndarray ps: The predicate of each query
+        :return: A (n_queries, n_entities) matrix. Higher is better
+        :rtype: numpy.ndarray
+        """
+        return np.dot(self.cconv(ss, ps), self.model.E.T)
+
+    def scores_s(self, os, ps):
+        """Scores every entity as subject of many (?, p, o) queries
+
+        The score p · ccorr(s, o) is equal to s · ccorr(p, o).
+
+        :param numpy.ndarray os: The object of each query
+        :param numpy.ndarray ps: The predicate of each query
+        :return: A (n_queries, n_entities) matrix. Higher is better
+        :rtype: numpy.ndarray
+        """
+        return np.dot(self.ccorr(ps, os), self.model.E.T)
+
+    def score_triples(self, ss, os, ps):
+        """Returns the score of many (s, o, p) triples
+
+        :param numpy.ndarray ss: The subjects
+        :param numpy.ndarray os: The objects
+        :param numpy.ndarray ps: The predicates
+        :rtype: numpy.ndarray
+        """
+        corr = self._irfft(np.conj(self.fE[ss]) * self.fE[os])
+        return np.sum(self.model.R[ps] * corr, axis=1)
+
 
 class HolEEval(experiment.FilteredRankingEval):
 
+    def prepare_global(self, mdl):
+        # Parameters change between evaluations while training
+        self.engine = HolEEngine(mdl)
+
     def prepare(self, mdl, p):
-        self.ER = skge.util.ccorr(mdl.R[p], mdl.E)
+        if getattr(self, 'engine', None) is None or \
+                self.engine.model is not mdl:
+            self.prepare_global(mdl)
+        self.ER = self.engine.projection(p)
 
     def scores_o(self, mdl, s, p):
         return np.dot(self.ER, mdl.E[s])
@@ -54,20 +236,101 @@ class HolEEval(experiment.FilteredRankingEval):
     def scores_s(self, mdl, o, p):
         return np.dot(mdl.E, self.ER[o])
 
+    @staticmethod
+    def batch_scores_o(mdl, ss, ps):
+        """Scores every entity as object of many (s, p, ?) queries
+
+        See HolEEngine.scores_o. To score many batches of the same model,
+        use a HolEEngine, which transforms the embeddings only once.
+
+        :param skge.HolE mdl: The trained model
+        :param numpy.ndarray ss: The subject of each query
+        :param numpy.ndarray ps: The predicate of each query
+        :return: A (n_queries, n_entities) matrix. Higher is better
+        :rtype: numpy.ndarray
+        """
+        return np.dot(native_trainer.cconv(mdl.E[ss], mdl.R[ps]), mdl.E.T)
+
+    @staticmethod
+    def batch_scores_s(mdl, os, ps):
+        """Scores every entity as subject of many (?, p, o) queries
+
+        See HolEEngine.scores_s
+
+        :param skge.HolE mdl: The trained model
+        :param numpy.ndarray os: The object of each query
+        :param numpy.ndarray ps: The predicate of each query
+        :return: A (n_queries, n_entities) matrix. Higher is better
+        :rtype: numpy.ndarray
+        """
+        return np.dot(native_trainer.ccorr(mdl.R[ps], mdl.E[os]), mdl.E.T)
+
+
+# Models that can be trained: the name of the skge class and the class used
+# to evaluate them. See get_model_types
+MODELS = {
+    'TransE': ('TransE', TransEEval),
+    'HolE': ('HolE', HolEEval),
+}
+
+
+def get_model_types(name, native=False):
+    """Returns the skge model class and the evaluator class of a model
+
+    :param str name: One of the MODELS keys
+    :param bool native: Return the model of kgeserver.native_trainer, instead
+                        of the skge one
+    :return: The model and evaluator classes
+    :rtype: tuple
+    """
+    model_name, eval_type = MODELS[name]
+    if native:
+        return native_trainer.MODELS[model_name], eval_type
+    return getattr(skge, model_name), eval_type
+
+
+def is_native(trainer_type):
+    """True if a trainer class is the vectorized trainer of kgeserver
+
+    :param type trainer_type: The trainer class
+    :rtype: bool
+    """
+    return getattr(trainer_type, 'vectorized', False)
+
+
+def load_model(filepath):
+    """Loads a trained model of any type from disk
+
+    Models are pickled with its class, so TransE and HolE models are loaded
+    in the same way. See Experiment.save_trained_model
+
+    :param str filepath: The path of the model
+    :return: The trained model
+    :rtype: skge.Model
+    """
+    with open(filepath, "rb") as model_file:
+        return pickle.load(model_file)
+
 
 class ModelTrainer(experiment.Experiment):
     """Creates a Model from a dataset and trains it"""
 
     def __init__(self, dataset, ncomp=150, afs='sigmoid',
-                 trainer_type=skge.PairwiseStochasticTrainer,
-                 model_type=skge.TransE, eval_type=TransEEval, **kwargs):
+                 trainer_type=None, model_type=None, eval_type=TransEEval,
+                 **kwargs):
         """Constructor method.
 
         :param Dataset dataset: The dataset to train
         :param int ncomp: Number of latent components
         :param string afs: Activation function
-        :param skge.Trainer trainer_type: The class desired for the trainer
-        :param skge.Model model_type: The Model used to train
+        :param skge.Trainer trainer_type: The class desired for the trainer.
+                                          Defaults to PairwiseStochasticTrainer
+                                          (native_trainer.PairwiseTrainer
+                                          trains without skge)
+        :param skge.Model model_type: The Model used to train. Defaults to
+                                      TransE. With the native trainer, skge
+                                      models are replaced by the native
+                                      model with the same name
         :param Class eval_type: The class used to evaluate the model
         :param float margin: Margin for loss function
         :param string init: Initialization method
@@ -81,12 +344,21 @@ class ModelTrainer(experiment.Experiment):
         :param bool no_pairwise: If true, trainer used is no pairwise
         :param string mode:
         :param string sampler:
+        :param int workers: Processes that train the model at once
+        :param int neval: Validation triples ranked on each evaluation
+        :param float eval_seconds: Time budget of each evaluation
+        :param int patience: Evaluations without improvement before stopping
+        :param float min_delta: Minimum improvement of the validation score
         """
         super(ModelTrainer, self).__init__(dataset, **kwargs)
         self.ncomp = ncomp
         self.evaluator = eval_type
-        self.trainer_type = trainer_type
-        self.model_type = model_type
+        self.trainer_type = trainer_type or skge.PairwiseStochasticTrainer
+        if is_native(self.trainer_type):
+            model_type = model_type or native_trainer.TransE
+            if not getattr(model_type, 'vectorized', False):
+                model_type = native_trainer.MODELS[model_type.__name__]
+        self.model_type = model_type or skge.TransE
         self.afs = afs
         print(self.__dict__)
 
@@ -98,19 +370,48 @@ class ModelTrainer(experiment.Experiment):
         :return: An instantiated trainer
         :rtype: skge.Trainer
         """
+        if is_native(self.trainer_type):
+            af = self.afs
+        else:
+            af = skge.activation_functions[self.afs]
         model = self.model_type(size, self.ncomp, init=self.init, rparam=0,
-                                af=skge.activation_functions[self.afs])
+                                af=af)
         trainer = self.trainer_type(
             model,
             nbatches=self.nb,
             margin=self.margin,
             max_epochs=self.me,
             learning_rate=self.lr,
-            samplef=sampler.sample,
+            # The native trainer corrupts whole batches at once
+            samplef=sampler.sample_batch if is_native(self.trainer_type)
+            else sampler.sample,
             post_epoch=[self.callback]
         )
         return trainer
 
+    def vectorized(self):
+        """True if the trainer is the vectorized one of native_trainer
+
+        :rtype: bool
+        """
+        return is_native(self.trainer_type)
+
+    def create_sampler(self, xs, sz):
+        """Creates the sampler of negative triples used by the trainer
+
+        The native trainer corrupts whole batches with a
+        native_trainer.CorruptionSampler, or with a sampling.TypedSampler.
+
+        :param list xs: The training triples
+        :param tuple sz: A tuple (N, N, M) with the size of the tensor
+        """
+        if not is_native(self.trainer_type) or self.sampler == 'corrupted':
+            return super(ModelTrainer, self).create_sampler(xs, sz)
+        if self.sampler not in native_trainer.SAMPLER_MODES:
+            raise ValueError('Unknown sampler (%s)' % self.sampler)
+        return native_trainer.CorruptionSampler(
+            self.ne, xs, sz, native_trainer.SAMPLER_MODES[self.sampler])
+
     def get_conf(self):
         """Returns a dict with all model configuration
         """
@@ -128,7 +429,59 @@ class ModelTrainer(experiment.Experiment):
                 'test_all': self.test_all,
                 'no_pairwise': self.no_pairwise,
                 'mode': self.mode,
-                'sampler': self.sampler}
+                'sampler': self.sampler,
+                'workers': self.workers,
+                'neval': self.neval,
+                'eval_seconds': self.eval_seconds,
+                'patience': getattr(self.early_stopping, 'patience', None),
+                'min_delta': getattr(self.early_stopping, 'min_delta', 0.0)}
+
+
+def search_trials(models, margins, embedding_sizes, max_epochs):
+    """Returns every configuration tried by a hyperparameter search
+
+    :param list models: Names of the models (MODELS keys)
+    :param list margins: The margins
+    :param list embedding_sizes: The numbers of latent components
+    :param int max_epochs: Maximum number of epochs of each trial
+    :return: The algorithm dicts, as the AlgorithmDAO stores them
+    :rtype: list
+    """
+    return [{'model': model, 'margin': margin, 'embedding_size': ncomp,
+             'max_epochs': max_epochs}
+            for model, margin, ncomp in itertools.product(
+                models, margins, embedding_sizes)]
+
+
+def evaluate_algorithm(dtset, algorithm_dict, native=False, **kwargs):
+    """Trains an algorithm on the train triples, validating it
+
+    :param Dataset dtset: The dataset, or a dataset_split.SplitDataset
+    :param dict algorithm_dict: The model, margin, embedding_size and
+                                max_epochs
+    :param bool native: Train with native_trainer instead of skge
+    :param dict kwargs: Other ModelTrainer params, such as test_all or
+                        patience
+    :return: The best filtered MRR on validation (None if the model was not
+             evaluated), the epoch it was reached and the epochs trained
+    :rtype: dict
+    """
+    model_type, eval_type = get_model_types(
+        algorithm_dict.get('model') or 'TransE', native=native)
+    trainer = ModelTrainer(
+        dtset, model_type=model_type, eval_type=eval_type,
+        trainer_type=native_trainer.PairwiseTrainer if native else None,
+        ncomp=algorithm_dict['embedding_size'],
+        margin=algorithm_dict['margin'],
+        max_epochs=algorithm_dict['max_epochs'], **kwargs)
+    trainer.run()
+    scores = [score for score in trainer.scores if score['type'] == "FMRR"]
+    best = max(scores, key=lambda score: score['score']) if scores else None
+    # No epoch is recorded with max_epochs=0
+    epochs = trainer.telemetry.series['epoch']
+    return {'score': float(best['score']) if best else None,
+            'best_epoch': best['epoch'] if best else None,
+            'epochs': epochs[-1] if epochs else 0}
 
 
 class Algorithm():
@@ -139,15 +492,18 @@ class Algorithm():
         self.th_semaphore = threading.Semaphore(thread_limiter)
 
     def find_best(self, margins=[0.2, 2.0], ncomps=range(50, 100, 20),
-                  model_types=[skge.HolE, skge.TransE], **kwargs):
+                  model_types=None, **kwargs):
         """Find the best training params for a given dataset
 
         This method makes several trains with different models and
         parameters, and returns a ModelTrainer Instance.
         :param list margins: A list of all margins to try
         :param list ncomps: A list of latent components
-        :param list model_types: A list of models
+        :param list model_types: A list of models. Defaults to HolE and
+                                 TransE
         """
+        if model_types is None:
+            model_types = [skge.HolE, skge.TransE]
 
         # Create a pool of threads
         threads = []
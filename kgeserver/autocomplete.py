@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# autocomplete.py: Embedded prefix index to suggest entities by their labels
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import bisect
+import unicodedata
+import numpy as np
+import kgeserver.vocabulary as vocabulary
+
+# Suggestions precomputed for the shortest prefixes, and the longest prefix
+# precomputed. Short prefixes match too many labels to rank them on each query
+TOP_SUGGESTIONS = 50
+SHORT_PREFIX = 2
+# Prefixes with less labels than this are always ranked on each query
+SHORT_PREFIX_MIN_ROWS = 1024
+
+
+def suggest_path(dataset_path):
+    """Path of the autocomplete index of a binary dataset
+
+    :param str dataset_path: The path of the binary dataset
+    :rtype: str
+    """
+    return dataset_path[:-4] + "_suggest.bin"
+
+
+def fold(text):
+    """Returns the key of a label: lowercase, without accents nor spaces
+
+    It is similar to the analyzer used by the Elasticsearch suggestions, with
+    ascii folding and without separators, so "Jose Lopez" is found with
+    "josélo".
+
+    :param str text: The label
+    :rtype: bytes
+    """
+    text = unicodedata.normalize('NFKD', text.lower())
+    return "".join(char for char in text
+                   if not unicodedata.combining(char) and
+                   not char.isspace()).encode("utf-8")
+
+
+def entity_labels(entity):
+    """Returns all the labels and alternative labels of an entity document
+
+    :param dict entity: A document with 'label' and 'alt_label' dicts by
+                        language, as stored by build_autocomplete_index
+    :rtype: list
+    """
+    labels = list(entity.get('label', {}).values())
+    for alt_labels in entity.get('alt_label', {}).values():
+        labels += alt_labels
+    return labels
+
+
+class _Column():
+    """Rows of a bytes buffer, truncated to *width* bytes if given"""
+    def __init__(self, buffer, offsets, width=None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.width = width
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        start, end = self.offsets[row], self.offsets[row + 1]
+        if self.width is not None:
+            end = min(end, start + self.width)
+        return self.buffer[start:end].tobytes()
+
+
+class SuggestIndex():
+    """A sorted prefix index of the labels of the entities of a dataset
+
+    Every label is stored once for each entity that has it, folded (see
+    `fold`), and all of them are sorted. The labels that start with a prefix
+    are a contiguous range, found with two binary searches, and the entities
+    of the range are ranked by their score (the degree of the entity).
+
+    The index is stored on a single memory mapped file, with these arrays:
+
+    * *keys* and *key_offsets*: The folded labels, sorted.
+    * *texts* and *text_offsets*: The original label of each key.
+    * *key_entities*: The entity of each key.
+    * *scores*: The score of each entity.
+    * *docs* and *doc_offsets*: The JSON document of each entity.
+    * *top_rows*: The best keys of the short prefixes (*top_prefixes*), with
+      one key for each entity.
+    """
+    def __init__(self, arrays, top_prefixes):
+        self.arrays = arrays
+        self.keys = _Column(arrays['keys'], arrays['key_offsets'])
+        self.texts = _Column(arrays['texts'], arrays['text_offsets'])
+        self.docs = _Column(arrays['docs'], arrays['doc_offsets'])
+        self.key_entities = arrays['key_entities']
+        self.scores = arrays['scores']
+        self.top_rows = arrays['top_rows']
+        self.top_prefixes = top_prefixes
+
+    @classmethod
+    def build(cls, entities, scores=None):
+        """Creates the index of some entity documents
+
+        :param list entities: The documents of the entities, with the
+                              'entity', 'label', 'alt_label' and
+                              'description' keys
+        :param list scores: The score of each entity. Higher scores are
+                            suggested first. Defaults to 0
+        :rtype: SuggestIndex
+        """
+        if scores is None:
+            scores = np.zeros(len(entities))
+        rows = []
+        for entity_row, entity in enumerate(entities):
+            for label in set(entity_labels(entity)):
+                key = fold(label)
+                if key:
+                    rows.append((key, entity_row, label.encode("utf-8")))
+        rows.sort()
+
+        def pack(values):
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in values], out=offsets[1:])
+            return np.frombuffer(b"".join(values), dtype=np.uint8), offsets
+
+        arrays = {}
+        arrays['keys'], arrays['key_offsets'] = pack([r[0] for r in rows])
+        arrays['texts'], arrays['text_offsets'] = pack([r[2] for r in rows])
+        arrays['key_entities'] = np.array([r[1] for r in rows],
+                                          dtype=np.int32)
+        arrays['scores'] = np.asarray(scores, dtype=np.float32)
+        arrays['docs'], arrays['doc_offsets'] = pack(
+            [json.dumps(entity, sort_keys=True).encode("utf-8")
+             for entity in entities])
+        arrays['top_rows'] = np.zeros((0, TOP_SUGGESTIONS), dtype=np.int32)
+
+        index = cls(arrays, [])
+        index._build_top_rows()
+        return index
+
+    def _build_top_rows(self):
+        """Ranks the keys of every short prefix with many keys"""
+        prefixes = set()
+        for row in range(len(self.keys)):
+            key = self.keys[row]
+            for length in range(1, SHORT_PREFIX + 1):
+                prefixes.add(key[:length])
+        top_prefixes, top_rows = [], []
+        for prefix in sorted(prefixes):
+            start, end = self._range(prefix)
+            if end - start >= SHORT_PREFIX_MIN_ROWS:
+                best = self._rank(start, end, TOP_SUGGESTIONS)
+                top_prefixes.append(prefix)
+                top_rows.append(best + [-1] * (TOP_SUGGESTIONS - len(best)))
+        self.top_prefixes = top_prefixes
+        self.top_rows = np.array(top_rows, dtype=np.int32).reshape(
+            len(top_rows), TOP_SUGGESTIONS)
+        self.arrays['top_rows'] = self.top_rows
+
+    def __len__(self):
+        return len(self.keys)
+
+    def nbytes(self):
+        """Memory used by the arrays of the index"""
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def _range(self, prefix):
+        """Returns the first and the last key (excluded) with a prefix"""
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_right(
+            _Column(self.keys.buffer, self.keys.offsets, len(prefix)),
+            prefix, start)
+        return start, end
+
+    def _rank(self, start, end, size):
+        """Returns the best keys of a range, one for each entity
+
+        Entities are sorted by score, and then by key.
+        """
+        entities = np.asarray(self.key_entities[start:end])
+        scores = np.asarray(self.scores)[entities]
+        # Only some of the best keys are sorted, unless they are not enough
+        candidates = min(len(entities), size * 8)
+        while True:
+            if candidates < len(entities):
+                best = np.argpartition(-scores, candidates - 1)[:candidates]
+            else:
+                best = np.arange(len(entities))
+            best = best[np.lexsort((best, -scores[best]))]
+            rows, seen = [], set()
+            for position in best:
+                entity = int(entities[position])
+                if entity not in seen:
+                    seen.add(entity)
+                    rows.append(start + int(position))
+                    if len(rows) == size:
+                        return rows
+            if candidates >= len(entities):
+                return rows
+            candidates = len(entities)
+
+    def suggest(self, text, size=10):
+        """Returns the entities with a label that starts with a text
+
+        :param str text: The text written by the user
+        :param int size: The number of entities returned
+        :return: A list of {"entity": document, "text": label} dicts, with
+                 the entities with more score first
+        :rtype: list
+        """
+        prefix = fold(text)
+        if not prefix or size < 1:
+            return []
+        position = bisect.bisect_left(self.top_prefixes, prefix)
+        if size <= TOP_SUGGESTIONS and position < len(self.top_prefixes) and\
+                self.top_prefixes[position] == prefix:
+            rows = [int(row) for row in self.top_rows[position, :size]
+                    if row >= 0]
+        else:
+            start, end = self._range(prefix)
+            rows = self._rank(start, end, size) if end > start else []
+        return [{"entity": json.loads(self.docs[
+                    int(self.key_entities[row])].decode("utf-8")),
+                 "text": self.texts[row].decode("utf-8")}
+                for row in rows]
+
+    def save(self, filepath):
+        """Saves the index on a single file
+
+        :param str filepath: The path of the file
+        """
+        meta = {'top_prefixes': [prefix.hex()
+                                 for prefix in self.top_prefixes]}
+        vocabulary.write_arrays(filepath, meta, self.arrays)
+
+    @classmethod
+    def load(cls, filepath):
+        """Maps an index file on memory
+
+        :param str filepath: The path of the file
+        :rtype: SuggestIndex
+        """
+        meta, arrays = vocabulary.read_arrays(filepath)
+        return cls(arrays, [bytes.fromhex(prefix)
+                            for prefix in meta['top_prefixes']])
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# checkpoint.py: Saves and restores the state of a training on disk
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pickle
+import tempfile
+import numpy as np
+
+# Increase when the content of checkpoints changes
+CHECKPOINT_VERSION = 1
+
+
+def atomic_pickle(obj, filepath, protocol=2):
+    """Pickles an object on a file, without leaving half written files
+
+    The object is written on a temporary file of the same directory, which
+    is renamed to filepath when it is complete. A reader, or a process that
+    dies while writing, will always find the previous or the new file.
+
+    :param object obj: The object to be saved
+    :param str filepath: The final path of the file
+    :param int protocol: The pickle protocol
+    """
+    directory = os.path.dirname(os.path.abspath(filepath))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp",
+                                    prefix=os.path.basename(filepath) + ".")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            pickle.dump(obj, tmp_file, protocol=protocol)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _updater_state(updater):
+    """Returns the arrays of an optimizer (such as AdaGrad accumulators)"""
+    return dict((name, np.array(value))
+                for name, value in vars(updater).items()
+                if isinstance(value, np.ndarray) and name != 'param')
+
+
+def trainer_state(trainer):
+    """Returns the state needed to continue a training later
+
+    The state has a copy of all parameters of the model, the state of the
+    optimizer of each parameter and the state of the numpy random generator,
+    which is used to shuffle the triples and to sample negative examples.
+
+    :param skge.Trainer trainer: The trainer, just after an epoch
+    :rtype: dict
+    """
+    model = trainer.model
+    updaters = getattr(trainer, '_updaters', {})
+    return {
+        'version': CHECKPOINT_VERSION,
+        'epoch': trainer.epoch,
+        'params': dict((name, np.array(param))
+                       for name, param in model._params.items()),
+        'updaters': dict((name, _updater_state(updater))
+                         for name, updater in updaters.items()),
+        'rng_state': np.random.get_state()
+    }
+
+
+def restore_trainer(trainer, state):
+    """Loads a state on a trainer which has not started yet
+
+    Arrays are copied inside the current ones, because the optimizers keep
+    references to the parameters of the model.
+
+    :param skge.Trainer trainer: A trainer built with the same configuration
+    :param dict state: The state returned by `trainer_state`
+    :return: False if the state does not fit on the trainer
+    :rtype: bool
+    """
+    params = trainer.model._params
+    if state.get('version') != CHECKPOINT_VERSION or \
+            set(state['params']) != set(params):
+        return False
+    for name, value in state['params'].items():
+        if params[name].shape != value.shape:
+            return False
+
+    for name, value in state['params'].items():
+        params[name][...] = value
+    updaters = getattr(trainer, '_updaters', {})
+    for name, arrays in state['updaters'].items():
+        for attr, value in arrays.items():
+            getattr(updaters[name], attr)[...] = value
+    np.random.set_state(state['rng_state'])
+    return True
+
+
+def save_checkpoint(filepath, state, **extra):
+    """Saves a training state, and any extra value, on disk
+
+    :param str filepath: The path of the checkpoint
+    :param dict state: The state returned by `trainer_state`
+    :param dict extra: Other values to be saved with the state
+    """
+    checkpoint = dict(state)
+    checkpoint['extra'] = extra
+    atomic_pickle(checkpoint, filepath)
+
+
+def load_checkpoint(filepath):
+    """Loads a checkpoint from disk
+
+    :param str filepath: The path of the checkpoint
+    :return: The checkpoint, or None if there is no valid one
+    :rtype: dict
+    """
+    try:
+        with open(filepath, "rb") as ckpt_file:
+            return pickle.load(ckpt_file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError) as err:
+        if os.path.exists(filepath):
+            print("Checkpoint {0} can't be loaded: {1}".format(filepath, err))
+        return None
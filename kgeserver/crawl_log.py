@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# crawl_log.py: Persists the state of a SPARQL crawl to resume it later
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import pickle
+import shutil
+import threading
+import kgeserver.checkpoint as checkpoint
+
+
+def log_path(dataset_path):
+    """Path of the crawl log of a binary dataset
+
+    :param str dataset_path: The path of the binary dataset
+    :rtype: str
+    """
+    return dataset_path[:-4] + "_crawl"
+
+
+class CrawlLog():
+    """Stores on disk every step of `Dataset.load_dataset_recurrently`
+
+    The log is a directory with these files:
+
+    * *seed.bin*: The dataset after loading the graph pattern, and the seed
+      vector. Saved once, before the first level.
+    * *frontier_<level>.json*: The entities to be scanned on a level. Saved
+      once, when the level starts.
+    * *level_<level>.seg*: An append-only segment with one JSON line for each
+      entity scanned on the level: the triples added, the entities found for
+      next level and if the entity has been marked as explored. The last line
+      is ``{"end": true}`` when the level has finished.
+
+    When a crawl starts again with the same log, the triples of all segments
+    are added again to the dataset, and the crawl continues on the level that
+    was not finished, skipping the entities that were already scanned.
+    """
+    SEED_FILE = "seed.bin"
+    FRONTIER_FILE = "frontier_{}.json"
+    SEGMENT_FILE = "level_{}.seg"
+
+    def __init__(self, path, signature=None):
+        """Opens a crawl log. The directory is created if needed
+
+        :param str path: The directory of the log
+        :param dict signature: Params of the crawl (graph pattern, levels...)
+                               A log with other signature is discarded
+        """
+        self.path = path
+        self.signature = signature
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_level = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def load_seed(self, dtset):
+        """Loads the seed dataset saved by a previous crawl
+
+        :param Dataset dtset: The dataset where the seed will be loaded
+        :return: The seed vector, or None if there is no valid seed
+        :rtype: list
+        """
+        try:
+            with open(self._file(self.SEED_FILE), "rb") as seed_file:
+                seed = pickle.load(seed_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if seed['signature'] != self.signature:
+            print("Crawl log {} belongs to other crawl. Starting again"
+                  .format(self.path))
+            self.clear()
+            return None
+
+        dtset.entities = seed['entities']
+        dtset.relations = seed['relations']
+        dtset.subs = seed['subs']
+        dtset.entities_dict = {}
+        dtset.relations_dict = {}
+        dtset._load_elements_into_dict(dtset.entities_dict, dtset.entities)
+        dtset._load_elements_into_dict(dtset.relations_dict, dtset.relations)
+        dtset.splited_subs['updated'] = False
+        dtset.statistics = None
+        return seed['seed_vector']
+
+    def save_seed(self, dtset, seed_vector):
+        """Saves the dataset after loading the seed, before the first level
+
+        :param Dataset dtset: The dataset with the seed triples
+        :param list seed_vector: The entities of the first level
+        """
+        os.makedirs(self.path, exist_ok=True)
+        checkpoint.atomic_pickle({'signature': self.signature,
+                                  'entities': dtset.entities,
+                                  'relations': dtset.relations,
+                                  'subs': dtset.subs,
+                                  'seed_vector': list(seed_vector)},
+                                 self._file(self.SEED_FILE))
+
+    def _read_frontier(self, level):
+        try:
+            with open(self._file(self.FRONTIER_FILE.format(level))) as fr:
+                return json.load(fr)
+        except (OSError, ValueError):
+            return None
+
+    def _read_segment(self, level):
+        """Returns the records of a level and if the level has finished"""
+        records = []
+        try:
+            with open(self._file(self.SEGMENT_FILE.format(level))) as seg:
+                for line in seg:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line may be incomplete after a crash
+                        break
+                    if record.get('end'):
+                        return records, True
+                    records.append(record)
+        except OSError:
+            pass
+        return records, False
+
+    def restore(self, dtset):
+        """Adds to the dataset the triples of all the scanned entities
+
+        :param Dataset dtset: The dataset, with the seed already loaded
+        :return: The level to continue, its frontier, the entities found
+                 for next level and the entities already scanned. None if
+                 the crawl has not started any level
+        :rtype: tuple
+        """
+        level = 0
+        frontier = self._read_frontier(level)
+        if frontier is None:
+            return None
+        while True:
+            records, finished = self._read_segment(level)
+            next_queue = []
+            for record in records:
+                for subject, obj, pred in record['triples']:
+                    dtset.add_triple(subject, obj, pred)
+                if record['explored']:
+                    dtset.set_explored(record['entity'])
+                next_queue += record['next']
+            next_frontier = self._read_frontier(level + 1)
+            if not finished or next_frontier is None:
+                scanned = set(record['entity'] for record in records)
+                if finished:
+                    # Finished, but next level had not started
+                    return level + 1, None, next_queue, set()
+                return level, frontier, next_queue, scanned
+            level += 1
+            frontier = next_frontier
+
+    def start_level(self, level, frontier):
+        """Saves the frontier of a level before scanning it
+
+        :param int level: The level
+        :param list frontier: The entities to be scanned
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file(self.FRONTIER_FILE.format(level)) + ".tmp",
+                  "w") as fr:
+            json.dump(frontier, fr)
+        os.replace(self._file(self.FRONTIER_FILE.format(level)) + ".tmp",
+                   self._file(self.FRONTIER_FILE.format(level)))
+
+    def _append(self, level, record):
+        with self.lock:
+            if self.segment_level != level:
+                self.close()
+                self.segment = open(
+                    self._file(self.SEGMENT_FILE.format(level)), "a")
+                self.segment_level = level
+            self.segment.write(json.dumps(record) + "\n")
+            self.segment.flush()
+
+    def add_entity(self, level, entity, triples, next_entities, explored):
+        """Appends the result of scanning an entity to the segment of a level
+
+        :param int level: The level
+        :param str entity: The entity scanned
+        :param list triples: The (subject, object, predicate) added
+        :param list next_entities: The entities found for next level
+        :param bool explored: If the entity has been marked as explored
+        """
+        self._append(level, {'entity': entity,
+                             'triples': triples,
+                             'next': next_entities,
+                             'explored': explored})
+
+    def end_level(self, level):
+        """Marks a level as finished"""
+        self._append(level, {'end': True})
+        with self.lock:
+            os.fsync(self.segment.fileno())
+            self.close()
+
+    def close(self):
+        """Closes the segment being written"""
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+            self.segment_level = None
+
+    def clear(self):
+        """Removes the log, once the dataset has been saved"""
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
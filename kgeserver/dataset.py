@@ -18,8 +18,9 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import requests
+import os
 import json
+import zlib
 import pickle
 import numpy as np
 import threading
@@ -28,6 +29,12 @@ import time
 import copy
 import logging
 from collections import defaultdict
+import kgeserver.graph_statistics as graph_statistics
+import kgeserver.delta_log as delta_log
+from kgeserver.lazy_import import lazy_import
+
+# Only needed to query the SPARQL endpoint
+requests = lazy_import("requests")
 
 # Disable logging for requests library
 logging.getLogger("requests").setLevel(logging.WARNING)
@@ -44,6 +51,7 @@ class Dataset():
     relations = []
     relations_dict = {}
     subs = []
+    statistics = None
 
     # Used to show current status
     status = {'started': 0,
@@ -67,9 +75,19 @@ class Dataset():
         self.th_semaphore = threading.Semaphore(thread_limiter)
         # self.query_sem = threading.Semaphore(thread_limiter)
 
+        # Triples added by each thread, used to log a crawl
+        self._recorder = threading.local()
+
         # Instanciate splited subs as false
         self.splited_subs = {'updated': False}
 
+        # Each dataset has its own elements, not the lists of the class
+        self.entities = []
+        self.entities_dict = {}
+        self.relations = []
+        self.relations_dict = {}
+        self.subs = []
+
     def show(self, verbose=False):
         """Show all elements of the dataset
 
@@ -134,6 +152,29 @@ class Dataset():
         else:
             return False
 
+    def is_explored(self, entity):
+        """Check if an entity has been already explored by process_entity
+
+        Only child objects which keep an ``entities_explored`` dict can
+        explore entities.
+
+        :param string entity: The entity
+        :rtype: bool
+        """
+        explored = getattr(self, 'entities_explored', None)
+        if explored is None:
+            return False
+        return self.exist_element(self.check_entity(entity), explored)
+
+    def set_explored(self, entity):
+        """Marks an entity as already explored by process_entity
+
+        :param string entity: The entity
+        """
+        explored = getattr(self, 'entities_explored', None)
+        if explored is not None:
+            explored[self.check_entity(entity)] = True
+
     def check_entity(self, entity):
         """Check the entity given and return a valid representation
 
@@ -220,6 +261,10 @@ class Dataset():
             if id_subj is not False or id_pred is not False:
                 self.subs.append((id_subj, id_obj, id_pred))
                 self.splited_subs['updated'] = False
+                self.statistics = None
+                recorded = getattr(self._recorder, 'triples', None)
+                if recorded is not None:
+                    recorded.append((subject, obj, pred))
                 return True
         return False
 
@@ -463,6 +508,38 @@ class Dataset():
                       "Exiting".format(times_new, exc, max_tries))
                 return False
 
+    def _crawl_entity(self, entity, level, crawl_log, append_queue,
+                      callback, **kwargs):
+        """Wrapper of `dataset.process_entity`_ that logs the result
+
+        The triples added and the entities found are saved on the crawl log
+        before calling the callback, so the entity will not be queried again
+        if the crawl is resumed.
+
+        :param string entity: The URI of element to be scanned
+        :param int level: The level being scanned
+        :param CrawlLog crawl_log: The log of the crawl
+        :param function append_queue: Receives the entities for next level
+        :param function callback: The callback function
+        """
+        found = []
+        self._recorder.triples = []
+
+        def log_callback(status):
+            triples = self._recorder.triples
+            self._recorder.triples = None
+            crawl_log.add_entity(level, entity, triples, found,
+                                 self.is_explored(entity))
+            for element in found:
+                append_queue(element)
+            return callback(status)
+
+        try:
+            return self.process_entity(entity, append_queue=found.append,
+                                       callback=log_callback, **kwargs)
+        finally:
+            self._recorder.triples = None
+
     def load_from_graph_pattern(self):
         """Get the root entities where the graph build should start
 
@@ -480,7 +557,7 @@ class Dataset():
 
     def load_dataset_recurrently(self, levels, seed_vector, verbose=1,
                                  limit_ent=None, ext_callback=lambda x: None,
-                                 **keyword_args):
+                                 crawl_log=None, **keyword_args):
         """Loads to dataset all entities with BNE ID and their relations
 
         Due to Wikidata endpoint cann't execute queries that take long time
@@ -491,6 +568,8 @@ class Dataset():
         :param list seed_vector: A vector of entities to start with
         :param integer levels: The depth to get triplets
         :param integer verbose: The level of verbosity. 0 is low, and 2 is high
+        :param CrawlLog crawl_log: Saves every entity scanned. If the log
+                                   has a previous crawl, it will be resumed
         :return: True if operation was successful
         :rtype: bool
         """
@@ -498,6 +577,19 @@ class Dataset():
         new_queue = seed_vector
         el_queue = []
 
+        # Continue the crawl saved on the log, if any
+        start_level = 0
+        resumed = None
+        if crawl_log is not None:
+            resumed = crawl_log.restore(self)
+        if resumed is not None:
+            start_level, el_queue, new_queue, scanned = resumed
+            if verbose > 0:
+                print("Resuming crawl on level {}/{}, {} entities already "
+                      "scanned".format(start_level+1, levels, len(scanned)))
+        else:
+            scanned = set()
+
         self.status['started'] = datetime.now()
         self.status['it_analyzed'] = 0
         self.status['active'] = True
@@ -511,16 +603,25 @@ class Dataset():
             status_thread.start()
 
         # Loop for depth levels
-        for level in range(0, levels):
+        for level in range(start_level, levels):
             # Loop for every item on the queue
 
-            # Interchange lists
-            el_queue = copy.copy(new_queue)
-            new_queue = []
+            if resumed is not None and level == start_level and \
+                    el_queue is not None:
+                # The level was started before, the frontier is on the log
+                pass
+            else:
+                # Interchange lists
+                el_queue = copy.copy(new_queue)
+                new_queue = []
+                scanned = set()
+
+                # Apply limitation
+                if limit_ent is not None:
+                    el_queue = el_queue[:limit_ent*((level+1)**3)]
 
-            # Apply limitation
-            if limit_ent is not None:
-                el_queue = el_queue[:limit_ent*((level+1)**3)]
+                if crawl_log is not None:
+                    crawl_log.start_level(level, el_queue)
 
             if verbose > 0:
                 print("Scanning level {}/{} with {} elements"
@@ -529,13 +630,16 @@ class Dataset():
             # Initialize some status variables
             self.status['round_curr'] = level
             self.status['it_total'] = len(el_queue)
-            self.status['it_analyzed'] = 0
+            self.status['it_analyzed'] = len(scanned)
 
             # pool for threads
             threads = []
 
             # Scan every entity on queue
             for element in el_queue:
+                # Already scanned before resuming the crawl
+                if element in scanned:
+                    continue
                 # Generate n threads, start them and save into pool
 
                 def func_callback(status):
@@ -548,8 +652,14 @@ class Dataset():
                 call_kwargs['verbose'] = verbose
                 call_kwargs['append_queue'] = lambda e: new_queue.append(e)
                 call_kwargs['callback'] = func_callback
+                if crawl_log is not None:
+                    call_kwargs['level'] = level
+                    call_kwargs['crawl_log'] = crawl_log
+                    target = self._crawl_entity
+                else:
+                    target = self.process_entity
                 t = threading.Thread(
-                    target=self.process_entity,
+                    target=target,
                     args=(element, ),
                     kwargs=call_kwargs)
                 threads.append(t)
@@ -561,6 +671,9 @@ class Dataset():
             for th in threads:
                 th.join()
 
+            if crawl_log is not None:
+                crawl_log.end_level(level)
+
         if verbose > 1:
             # To help kill the status thread may
             # be useful to imput a 'q' character on stdin
@@ -636,6 +749,7 @@ class Dataset():
             'train_subs': subs2['train_subs'],
             'valid_subs': subs2['valid_subs'],
             'test_subs': subs2['test_subs'],
+            'statistics': self.get_statistics(),
             '__class__': self.__class__
         }
         try:
@@ -652,12 +766,15 @@ class Dataset():
         f.close()
         return True
 
-    def load_from_binary(self, filepath, **kwargs):
+    def load_from_binary(self, filepath, with_delta=True, **kwargs):
         """Loads the dataset object from the disk
 
-        Loads this dataset object with the binary file
+        Loads this dataset object with the binary file, and adds the triples
+        inserted later on its delta log (see kgeserver.delta_log). If the
+        log is compacted while loading, the dataset is loaded again.
 
         :param string filepath: The path of the binary file
+        :param bool with_delta: False to skip the triples of the delta log
         :return: True if operation was successful
         :rtype: bool
         """
@@ -667,6 +784,7 @@ class Dataset():
         except FileNotFoundError:
             msg = "The path {0} is not valid".format(filepath)
             raise FileNotFoundError(msg)
+        inode = os.fstat(f.fileno()).st_ino
         all_dataset = pickle.load(f)
         f.close()
         try:
@@ -681,7 +799,13 @@ class Dataset():
         self.subs = all_dataset['train_subs'] + all_dataset['valid_subs'] +\
             all_dataset['test_subs']
 
-        # Fill dicts
+        # Old datasets were saved without statistics
+        self.statistics = all_dataset.get('statistics')
+
+        # Fill dicts. New ones: the class dicts are shared by all instances,
+        # and the delta log adds entities by looking them up
+        self.entities_dict = {}
+        self.relations_dict = {}
         self._load_elements_into_dict(self.entities_dict, self.entities)
         self._load_elements_into_dict(self.relations_dict, self.relations)
 
@@ -692,8 +816,80 @@ class Dataset():
             'test_subs': all_dataset['test_subs']
             }
         # self.subs = all_dataset['subs']
+
+        if with_delta:
+            self.add_delta(delta_log.DeltaLog(filepath).read())
+            try:
+                replaced = os.stat(filepath).st_ino != inode
+            except FileNotFoundError:
+                replaced = False
+            if replaced:
+                # The log was merged on a new binary file meanwhile
+                return self.load_from_binary(filepath, **kwargs)
         return True
 
+    def add_delta(self, triples, ratio=0.8):
+        """Adds triples to the dataset without splitting it again
+
+        Each new triple goes to *train_subs*, *valid_subs* or *test_subs*
+        depending on a hash of its ids, in the proportions of train_split. So
+        every process that reads the same delta log gets the same split, and
+        the triples already split stay where they were. Triples already on
+        the dataset are skipped.
+
+        :param list triples: The (subject, object, predicate) to add
+        :param float ratio: The ratio of new triples for *train_subs*
+        :return: The number of triples added
+        :rtype: int
+        """
+        if not triples:
+            return 0
+        n_subs = len(self.subs)
+        statistics = self.statistics
+        for subject, obj, pred in triples:
+            self.add_triple(subject, obj, pred)
+        known = set(self.subs[:n_subs])
+        new_subs = []
+        for triple in self.subs[n_subs:]:
+            if triple not in known:
+                known.add(triple)
+                new_subs.append(triple)
+        self.subs[n_subs:] = new_subs
+        if not new_subs:
+            self.statistics = statistics
+
+        if 'train_subs' in self.splited_subs:
+            splits = {'train_subs': list(self.splited_subs['train_subs']),
+                      'valid_subs': list(self.splited_subs['valid_subs']),
+                      'test_subs': list(self.splited_subs['test_subs'])}
+            for triple in new_subs:
+                bucket = zlib.crc32("{} {} {}".format(*triple)
+                                    .encode("utf-8")) % 1000 / 1000
+                if bucket < ratio:
+                    splits['train_subs'].append(triple)
+                elif bucket < ratio + (1 - ratio) / 2:
+                    splits['valid_subs'].append(triple)
+                else:
+                    splits['test_subs'].append(triple)
+            splits['updated'] = True
+            self.splited_subs = splits
+        return len(new_subs)
+
+    def get_statistics(self):
+        """Returns the degree and relation statistics of the dataset
+
+        The statistics are computed only once and are saved with the binary
+        dataset. Adding new triples will compute them again when needed. See
+        kgeserver.graph_statistics to get more information.
+
+        :return: A dictionary with all statistics
+        :rtype: dict
+        """
+        if self.statistics is None:
+            self.statistics = graph_statistics.compute_statistics(
+                self.subs, len(self.entities), len(self.relations))
+        return self.statistics
+
     def _load_elements_into_dict(self, el_dict, el_list):
         """Insert elements from a list into dict
 
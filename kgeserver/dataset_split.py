@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# dataset_split.py: Memory mapped train, valid and test triples of a dataset
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import binascii
+import numpy as np
+import kgeserver.graph_statistics as graph_statistics
+import kgeserver.vocabulary as vocabulary
+
+# The subsets of triples stored on a split file
+SPLITS = ('train_subs', 'valid_subs', 'test_subs')
+
+
+def split_path(dataset_path):
+    """Path of the split file of a binary dataset
+
+    :param str dataset_path: The path of the binary dataset
+    :rtype: str
+    """
+    return dataset_path[:-4] + "_split.bin"
+
+
+def save_split(dtset, filepath):
+    """Saves the train, valid and test triples of a dataset
+
+    The triples are stored as int32 arrays with vocabulary.write_arrays, so
+    many processes (or machines sharing the volume) map the same file
+    instead of unpickling the whole dataset, with its URIs.
+
+    The file keeps its *generation* while the triples are only appended to
+    the end of the splits, as Dataset.add_delta does, so the cursors of
+    SplitDataset.scan are still valid. Any other change starts a new one.
+
+    :param kgeserver.dataset.Dataset dtset: The dataset
+    :param str filepath: The path of the file
+    """
+    subs = dtset.train_split()
+    arrays = dict((name, graph_statistics.triples_array(subs[name])
+                   .astype(np.int32)) for name in SPLITS)
+    meta = {'n_entities': len(dtset.entities),
+            'n_relations': len(dtset.relations),
+            'generation': _generation(filepath, arrays)}
+    vocabulary.write_arrays(filepath, meta, arrays)
+
+
+def _generation(filepath, arrays):
+    """Returns the generation of the split file that will hold the arrays
+
+    It is the generation of the current file if each of its splits is the
+    start of the new one, or a new random one.
+    """
+    try:
+        meta, current = vocabulary.read_arrays(filepath)
+        if all(len(current[name]) <= len(arrays[name]) and
+               np.array_equal(current[name],
+                              arrays[name][:len(current[name])])
+               for name in SPLITS):
+            return meta['generation']
+    except (OSError, ValueError, KeyError):
+        pass
+    return binascii.hexlify(os.urandom(4)).decode("ascii")
+
+
+class SplitDataset():
+    """The triples of a split file, with the attributes of a Dataset that
+    ModelTrainer uses to train and evaluate a model
+
+    *entities* and *relations* only have a length: URIs are not stored.
+    """
+    def __init__(self, n_entities, n_relations, arrays, generation=None):
+        self.entities = range(n_entities)
+        self.relations = range(n_relations)
+        self.arrays = arrays
+        self.generation = generation
+
+    @classmethod
+    def load(cls, filepath):
+        """Maps a split file on memory
+
+        :param str filepath: The path of the file
+        :rtype: SplitDataset
+        """
+        meta, arrays = vocabulary.read_arrays(filepath)
+        return cls(meta['n_entities'], meta['n_relations'], arrays,
+                   meta.get('generation'))
+
+    def train_split(self):
+        """Returns the triples of each split, as Dataset.train_split does
+
+        The triples are the int32 arrays mapped from the file, not lists of
+        tuples, so the processes that train on them do not copy the whole
+        dataset. Experiment.train converts them for the skge trainers.
+
+        :rtype: dict
+        """
+        return dict((name, self.arrays[name]) for name in SPLITS)
+
+    def __len__(self):
+        return sum(len(self.arrays[name]) for name in SPLITS)
+
+    def scan(self, start=(0, 0), relation=None, entity=None,
+             chunk_size=65536):
+        """Reads the triples in order, a chunk at a time
+
+        The triples of *train_subs*, *valid_subs* and *test_subs* are read
+        one after the other. A triple is found by the index of its split and
+        its position on it, which does not change when new triples are
+        appended to the splits, so it can be used as the cursor of a page.
+        Only the chunk being read is copied from the file.
+
+        :param tuple start: The split and the position of the first triple
+        :param int relation: Only the triples of this relation id
+        :param int entity: Only the triples with this entity id as subject
+                           or object
+        :param int chunk_size: The triples read at once
+        :return: For each chunk, the index of its split, the positions of
+                 the triples that pass the filters and the triples as rows of
+                 (subject, object, predicate)
+        :rtype: generator
+        """
+        first_split, first = start
+        for index, name in enumerate(SPLITS[first_split:], first_split):
+            array = self.arrays[name]
+            begin = first if index == first_split else 0
+            for begin in range(begin, len(array), chunk_size):
+                rows = np.array(array[begin:begin + chunk_size])
+                mask = np.ones(len(rows), dtype=bool)
+                if relation is not None:
+                    mask &= rows[:, 2] == relation
+                if entity is not None:
+                    mask &= (rows[:, 0] == entity) | (rows[:, 1] == entity)
+                yield index, np.flatnonzero(mask) + begin, rows[mask]
+
+    def cursor(self, start):
+        """Returns the cursor of a position of scan
+
+        :param tuple start: The split and the position of a triple
+        :rtype: str
+        """
+        return "{}-{}-{}".format(self.generation, *start)
+
+    def parse_cursor(self, cursor):
+        """Returns the position of scan of a cursor
+
+        :param str cursor: A cursor returned by SplitDataset.cursor
+        :return: The split and the position of the triple, or None if the
+                 triples of the file have changed since the cursor was made
+        :rtype: tuple
+        :raises ValueError: If it is not a cursor
+        """
+        generation, split, position = cursor.rsplit("-", 2)
+        start = int(split), int(position)
+        if not 0 <= start[0] < len(SPLITS) or start[1] < 0:
+            raise ValueError("{} is not a cursor".format(cursor))
+        if generation != str(self.generation):
+            return None
+        return start
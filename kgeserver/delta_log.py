@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# delta_log.py: Append-only log of the triples inserted on a binary dataset
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import json
+import fcntl
+
+
+def delta_path(dataset_path):
+    """Path of the delta log of a binary dataset
+
+    :param str dataset_path: The path of the binary dataset
+    :rtype: str
+    """
+    return dataset_path[:-4] + "_delta.log"
+
+
+def _read_file(path):
+    """Returns the triples of a log file
+
+    Lines that cannot be read, such as a batch not finished when a process
+    died, are skipped.
+    """
+    triples = []
+    try:
+        with open(path, encoding="utf-8") as log:
+            for line in log:
+                try:
+                    batch = json.loads(line)['triples']
+                except (ValueError, KeyError, TypeError):
+                    continue
+                triples += [tuple(triple) for triple in batch]
+    except FileNotFoundError:
+        pass
+    return triples
+
+
+class DeltaLog():
+    """Triples inserted on a binary dataset after it was written
+
+    Inserting triples only appends one JSON line to the log, instead of
+    loading and writing the whole binary dataset. `Dataset.load_from_binary`
+    adds the triples of the log to the dataset, so every reader sees them.
+
+    When the log grows, `compact` merges it on the binary dataset. The log is
+    first renamed to *<log>.compacting*, so the inserts made meanwhile go to
+    a new log. Readers add the triples of both files until the binary
+    dataset has been replaced.
+
+    A compaction is scheduled by creating the *<log>.scheduled* file, so
+    only one is queued however many inserts find the log too big, and
+    compactions are serialized by a lock on *<log>.lock*.
+    """
+    COMPACTING_SUFFIX = ".compacting"
+    SCHEDULED_SUFFIX = ".scheduled"
+    LOCK_SUFFIX = ".lock"
+    # A compaction scheduled longer ago than this, in seconds, is lost
+    SCHEDULED_TIMEOUT = 3600
+
+    def __init__(self, dataset_path):
+        """Opens the delta log of a binary dataset. Nothing is created
+
+        :param str dataset_path: The path of the binary dataset
+        """
+        self.dataset_path = dataset_path
+        self.path = delta_path(dataset_path)
+        self.compacting_path = self.path + self.COMPACTING_SUFFIX
+        self.scheduled_path = self.path + self.SCHEDULED_SUFFIX
+        self.lock_path = self.path + self.LOCK_SUFFIX
+
+    def files(self):
+        """The files of the log, in the order they must be read"""
+        return [self.compacting_path, self.path]
+
+    def size(self):
+        """Size of the log that receives the inserts, in bytes
+
+        :rtype: int
+        """
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def schedule_compaction(self):
+        """Marks the log as waiting for a compaction
+
+        Only the first process that calls it gets True, until the compaction
+        calls `unschedule_compaction`, or the mark is older than
+        SCHEDULED_TIMEOUT because that compaction was lost.
+
+        :return: True if the caller must start the compaction
+        :rtype: bool
+        """
+        try:
+            fd = os.open(self.scheduled_path,
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            try:
+                age = time.time() - os.path.getmtime(self.scheduled_path)
+            except FileNotFoundError:
+                # The compaction has just finished
+                return self.schedule_compaction()
+            if age < self.SCHEDULED_TIMEOUT:
+                return False
+            os.utime(self.scheduled_path)
+            return True
+        os.close(fd)
+        return True
+
+    def unschedule_compaction(self):
+        """Removes the mark of `schedule_compaction`"""
+        try:
+            os.remove(self.scheduled_path)
+        except FileNotFoundError:
+            pass
+
+    def append(self, triples):
+        """Appends a batch of triples to the log
+
+        The batch is written as a single line while the log is locked, so the
+        inserts of other processes are never mixed with it. If the log has
+        been renamed by a compaction while waiting for the lock, the batch is
+        written on the new log.
+
+        :param list triples: The (subject, object, predicate) to insert
+        :return: The size of the log before and after the batch, in bytes
+        :rtype: tuple
+        """
+        line = json.dumps({'triples': [list(triple) for triple in triples]})
+        while True:
+            with open(self.path, "a+b") as log:
+                fcntl.flock(log, fcntl.LOCK_EX)
+                try:
+                    if not self._is_current(log):
+                        continue
+                    size = log.seek(0, os.SEEK_END)
+                    data = line + "\n"
+                    if size > 0:
+                        log.seek(size - 1)
+                        if log.read(1) != b"\n":
+                            # The last batch was not finished
+                            data = "\n" + data
+                    log.write(data.encode("utf-8"))
+                    log.flush()
+                    os.fsync(log.fileno())
+                    return size, log.tell()
+                finally:
+                    fcntl.flock(log, fcntl.LOCK_UN)
+
+    def _is_current(self, log):
+        """Checks if an open log is still on self.path"""
+        try:
+            return os.stat(self.path).st_ino == os.fstat(log.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def read(self):
+        """Returns the triples of the log, in the order they were inserted
+
+        :return: A list of (subject, object, predicate) tuples
+        :rtype: list
+        """
+        triples = []
+        for path in self.files():
+            triples += _read_file(path)
+        return triples
+
+    def _start_compaction(self):
+        """Moves the log to the compacting file
+
+        A compacting file left by a compaction that did not finish is merged
+        first, and the log is kept for the next compaction.
+
+        :return: False if there is nothing to compact
+        :rtype: bool
+        """
+        if os.path.isfile(self.compacting_path):
+            return True
+        try:
+            log = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        with log:
+            fcntl.flock(log, fcntl.LOCK_EX)
+            try:
+                os.rename(self.path, self.compacting_path)
+            finally:
+                fcntl.flock(log, fcntl.LOCK_UN)
+        return True
+
+    def compact(self):
+        """Merges the log on the binary dataset
+
+        The binary dataset is written on a temporary file that replaces it
+        when it is complete. If another process replaces the binary dataset
+        meanwhile, the compaction is cancelled and the log is kept. Only one
+        process compacts the log at a time, the others wait for it.
+
+        :return: The number of triples merged, or None if it was cancelled
+        :rtype: int
+        """
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return self._compact()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _compact(self):
+        """Merges the log on the binary dataset, holding the lock"""
+        # Imported here: kgeserver.dataset uses this module
+        import kgeserver.dataset as dataset
+
+        # A long series of compactions does not time out the schedule mark
+        try:
+            os.utime(self.scheduled_path)
+        except FileNotFoundError:
+            pass
+        if not self._start_compaction():
+            return 0
+        base_stat = os.stat(self.dataset_path)
+        dtset = dataset.Dataset()
+        dtset.load_from_binary(self.dataset_path, with_delta=False)
+        added = dtset.add_delta(_read_file(self.compacting_path))
+
+        tmp_path = self.dataset_path + ".compacting"
+        dtset.save_to_binary(tmp_path)
+        current_stat = os.stat(self.dataset_path)
+        if (current_stat.st_ino, current_stat.st_mtime_ns) != \
+                (base_stat.st_ino, base_stat.st_mtime_ns):
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, self.dataset_path)
+        os.remove(self.compacting_path)
+        return added
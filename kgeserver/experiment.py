@@ -30,22 +30,35 @@ from collections import defaultdict as ddict
 import pickle
 import timeit
 import logging
-from sklearn.metrics import precision_recall_curve, auc, roc_auc_score
+import resource
 
-from skge import sample
-from skge.util import to_tensor
+import kgeserver.checkpoint as checkpoint
+import kgeserver.hogwild as hogwild
+import kgeserver.graph_statistics as graph_statistics
+import kgeserver.sampling as sampling
+from kgeserver.lazy_import import lazy_import
+
+# Only needed to train or evaluate models
+sample = lazy_import("skge.sample")
+sklearn_metrics = lazy_import("sklearn.metrics")
 
 logging.basicConfig(level=logging.WARNING)
 log = logging.getLogger('EX-KG')
 np.random.seed(137)
 
+# Validation triples ranked to measure the time of an evaluation
+EVAL_PROBE = 50
+
 
 class Experiment(object):
 
     def __init__(self, dataset, th_num=0, train_all=False,
                  margin=2.0, init='nunif', lr=0.1, max_epochs=500,
                  ne=1, nbatches=100, fout=None, fin=None, test_all=50,
-                 no_pairwise=False, mode='rank', sampler='random-mode', **k):
+                 no_pairwise=False, mode='rank', sampler='random-mode',
+                 checkpoint_path=None, checkpoint_epochs=None,
+                 checkpoint_minutes=None, workers=1, neval=-1,
+                 eval_seconds=None, patience=None, min_delta=0.0, **k):
         """
         :param Dataset dataset: The dataset to train
         :param float margin: Margin for loss function
@@ -61,6 +74,20 @@ class Experiment(object):
         :param string mode:
         :param string sampler:
         :param bool train_all: Train with all triplets or use only train subs
+        :param string checkpoint_path: Path to save the training state. If a
+                                       valid checkpoint exists, training will
+                                       continue from it
+        :param integer checkpoint_epochs: Save a checkpoint every x epochs
+        :param float checkpoint_minutes: Save a checkpoint every x minutes
+        :param integer workers: Processes that train the model at once. See
+                                kgeserver.hogwild. 0 uses all the cores
+        :param integer neval: Validation triples ranked on each evaluation.
+                              -1 ranks all of them
+        :param float eval_seconds: Time budget of each evaluation. Sets neval
+                                   to the triples ranked on that time
+        :param integer patience: Evaluations without improvement before the
+                                 training stops. None never stops early
+        :param float min_delta: Minimum improvement of the validation score
         """
         self.margin = margin        # Margin for loss function
         self.init = init            # Initialization method
@@ -76,16 +103,32 @@ class Experiment(object):
         self.sampler = sampler
         self.train_all = train_all
 
-        self.neval = -1
+        self.neval = neval
+        self.eval_seconds = eval_seconds
+        if patience is not None:
+            self.early_stopping = EarlyStopping(patience, min_delta)
+        else:
+            self.early_stopping = None
         self.best_valid_score = -1.0
         self.exectimes = []
         # Store the score and epochs
         self.scores = []
         self.violations = []
         self.best_epoch = None
+        # Time series with information about each epoch
+        self.telemetry = EpochTelemetry()
+        self.n_train = 0
+
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_epochs = checkpoint_epochs
+        self.checkpoint_minutes = checkpoint_minutes
+        # Epochs already trained before resuming from a checkpoint
+        self.epoch_offset = 0
+        self.last_checkpoint = None
 
         self.th_num = th_num
         self.dataset = dataset
+        self.workers = workers or hogwild.available_workers()
 
         try:
             self.external_callback = k.pop("external_callback")
@@ -102,28 +145,146 @@ class Experiment(object):
             self.callback = self.ranking_callback
         elif self.mode == 'lp':
             self.callback = self.lp_callback
-            self.evaluator = LinkPredictionEval
+            self.evaluator = SampledLinkPredictionEval
         else:
             raise ValueError('Unknown experiment mode (%s)' % self.mode)
         trainer = self.train()
+        # The model carries the telemetry when it is saved to disk
+        trainer.model.telemetry = self.telemetry.to_dict()
+        if self.early_stopping is not None:
+            trainer.model.early_stopping = self.early_stopping.to_dict()
         return trainer.model
 
     def save_trained_model(self, filepath, model):
-        """Given a model and a filepath, save it to disk"""
-        try:
-            bin_file = open(filepath, "wb+")
-        except Exception:
-            print("Failed when loading file")
+        """Given a model and a filepath, save it to disk
 
-        return pickle.dump(bin_file, model)
+        The file is replaced atomically, so a previous model is never lost.
+        """
+        checkpoint.atomic_pickle(model, filepath)
 
     def thread_start(self, callback):
         """Used when threads are created"""
         self.run()
         callback(self)
 
+    def record_epoch(self, trn, sgd_time, eval_time, mrr=None, hits10=None):
+        """Appends the information of the current epoch to the telemetry
+
+        :param skge.Trainer trn: The trainer
+        :param float sgd_time: Seconds spent in SGD, or None if unknown
+        :param float eval_time: Seconds spent evaluating the model
+        :param float mrr: The filtered MRR on validation, if evaluated
+        :param float hits10: The filtered Hits@10 on validation, if evaluated
+        """
+        if sgd_time:
+            triples_per_sec = self.n_train / sgd_time
+        else:
+            triples_per_sec = None
+        self.telemetry.record(epoch=trn.epoch,
+                              sgd_time=sgd_time,
+                              eval_time=eval_time,
+                              triples_per_sec=triples_per_sec,
+                              violations=getattr(trn, 'nviolations', None),
+                              loss=getattr(trn, 'loss', None),
+                              mrr=mrr,
+                              hits10=hits10,
+                              rss=memory_usage())
+
+    def checkpoint_signature(self, trn):
+        """Values that must not change to resume a training from a checkpoint
+        """
+        return {'model': trn.model.__class__.__name__,
+                'trainer': trn.__class__.__name__,
+                'margin': self.margin,
+                'init': self.init,
+                'lr': self.lr,
+                'ne': self.ne,
+                'nbatches': self.nb,
+                'mode': self.mode,
+                'sampler': self.sampler,
+                'n_train': self.n_train}
+
+    def resume(self, trn):
+        """Loads the last checkpoint on a new trainer, if there is one
+
+        The trainer will only run the epochs left to reach max_epochs.
+
+        :param skge.Trainer trn: The trainer, before calling fit
+        :return: True if the training continues from a checkpoint
+        :rtype: bool
+        """
+        self.last_checkpoint = (0, timeit.default_timer())
+        if self.checkpoint_path is None:
+            return False
+        ckpt = checkpoint.load_checkpoint(self.checkpoint_path)
+        if ckpt is None:
+            return False
+        extra = ckpt.get('extra', {})
+        if extra.get('signature') != self.checkpoint_signature(trn) or \
+                not checkpoint.restore_trainer(trn, ckpt):
+            print("[%d] Checkpoint %s belongs to other training, ignored" %
+                  (self.th_num, self.checkpoint_path))
+            return False
+
+        self.epoch_offset = ckpt['epoch']
+        self.best_valid_score = extra['best_valid_score']
+        self.scores = extra['scores']
+        self.violations = extra['violations']
+        self.exectimes = extra['exectimes']
+        self.telemetry.series = extra['telemetry']
+        # The same validation sample, so scores are comparable
+        self.neval = extra.get('neval', self.neval)
+        if self.early_stopping is not None and extra.get('early_stopping'):
+            self.early_stopping.load(extra['early_stopping'])
+        self.last_checkpoint = (ckpt['epoch'], timeit.default_timer())
+
+        trn.max_epochs = max(self.me - self.epoch_offset, 0)
+        # The training had already stopped early
+        if self.early_stopping is not None and \
+                self.early_stopping.stopped_epoch is not None:
+            trn.max_epochs = 0
+        # Used by the last callback, if there are no epochs left
+        trn.epoch = self.epoch_offset
+        trn.epoch_start = timeit.default_timer()
+        trn.nviolations = self.violations[-1] if self.violations else 0
+        print("[%d] Resuming training from epoch %d" %
+              (self.th_num, self.epoch_offset))
+        return True
+
+    def save_checkpoint(self, trn, force=False):
+        """Saves the state of the training if it is time to do it
+
+        :param skge.Trainer trn: The trainer, just after an epoch
+        :param bool force: Save even if the interval has not passed
+        """
+        if self.checkpoint_path is None:
+            return
+        last_epoch, last_time = self.last_checkpoint
+        by_epochs = self.checkpoint_epochs and \
+            trn.epoch - last_epoch >= self.checkpoint_epochs
+        by_time = self.checkpoint_minutes and \
+            timeit.default_timer() - last_time >= self.checkpoint_minutes * 60
+        if not (force or by_epochs or by_time):
+            return
+
+        checkpoint.save_checkpoint(
+            self.checkpoint_path, checkpoint.trainer_state(trn),
+            signature=self.checkpoint_signature(trn),
+            best_valid_score=self.best_valid_score,
+            scores=self.scores,
+            violations=self.violations,
+            exectimes=self.exectimes,
+            telemetry=self.telemetry.to_dict(),
+            neval=self.neval,
+            early_stopping=self.early_stopping.state()
+            if self.early_stopping is not None else None)
+        self.last_checkpoint = (trn.epoch, timeit.default_timer())
+
     def ranking_callback(self, trn, with_eval=False):
         """Print basic info"""
+        # Epochs of a resumed training continue after the checkpoint
+        if not with_eval:
+            trn.epoch += self.epoch_offset
         # print basic info
         elapsed = timeit.default_timer() - trn.epoch_start
         self.exectimes.append(elapsed)
@@ -135,12 +296,15 @@ class Experiment(object):
                   (self.th_num, trn.epoch, elapsed, trn.nviolations))
             self.violations.append(trn.nviolations)
 
+        eval_start = timeit.default_timer()
+        fmrr_valid = fhits_valid = None
         if self.test_all > 0 and (trn.epoch % self.test_all == 0 or with_eval)\
                 and not trn.stop_training:
             print("[%d] before eval" % self.th_num)
             pos_v, fpos_v = self.ev_valid.positions(trn.model)
             print("[%d] after eval, {} before ranking" % self.th_num)
             fmrr_valid = ranking_scores(pos_v, fpos_v, trn.epoch, 'VALID')
+            fhits_valid = compute_scores(_flatten_positions(fpos_v))[2]
             print("[%d] after ranking" % self.th_num)
 
             print("[%d] FMRR valid = %f, best = %f" %
@@ -151,12 +315,19 @@ class Experiment(object):
                                 'epoch': trn.epoch,
                                 'type': "FMRR"})
 
-            # If scores are too low, is better to stop the trainer
-            if fmrr_valid < 0.1:
-                trn.stop_training = True
+            if self.early_stopping is None:
+                # If scores are too low, is better to stop the trainer
+                if fmrr_valid < 0.1:
+                    trn.stop_training = True
+
+                # If violations to the trainer are the same, stop the trainer
+                if self.violations[0] == self.violations[-1]:
+                    trn.stop_training = True
 
-            # If violations to the trainer are the same, stop the trainer
-            if self.violations[0] == self.violations[-1]:
+            # If the score has not improved for a while, stop the trainer
+            elif not with_eval and self.early_stopping.update(trn, fmrr_valid):
+                print("[%d] No improvement since epoch %d, stopping" %
+                      (self.th_num, self.early_stopping.best_epoch))
                 trn.stop_training = True
 
             # if improved the validation error, store model and calc test error
@@ -172,10 +343,18 @@ class Experiment(object):
                         'fpos test': fpos_t,
                         'pos valid': pos_v,
                         'fpos valid': fpos_v,
-                        'exectimes': self.exectimes
+                        'exectimes': self.exectimes,
+                        'telemetry': self.telemetry.to_dict()
                     }
                     with open(self.fout, 'wb') as fout:
                         pickle.dump(st, fout, protocol=2)
+
+        # The last call (with_eval) is not made after an epoch of SGD
+        self.record_epoch(trn, None if with_eval else elapsed,
+                          timeit.default_timer() - eval_start,
+                          mrr=fmrr_valid, hits10=fhits_valid)
+        if not with_eval:
+            self.save_checkpoint(trn)
         try:
             self.external_callback(trn)
         except Exception:
@@ -185,6 +364,9 @@ class Experiment(object):
         return True
 
     def lp_callback(self, m, with_eval=False):
+        # Epochs of a resumed training continue after the checkpoint
+        if not with_eval:
+            m.epoch += self.epoch_offset
         # print basic info
         elapsed = timeit.default_timer() - m.epoch_start
         self.exectimes.append(elapsed)
@@ -196,39 +378,109 @@ class Experiment(object):
                   (self.th_num, m.epoch, elapsed, m.nviolations))
 
         # if we improved the validation error, store model and calc test error
+        eval_start = timeit.default_timer()
         if self.test_all > 0 and (m.epoch % self.test_all == 0 or with_eval):
-            auc_valid, roc_valid = self.ev_valid.scores(m)
+            auc_valid, roc_valid = self.ev_valid.scores(m.model)
 
             print("[%d] AUC PR valid = %f, best = %f" %
                   (self.th_num, auc_valid, self.best_valid_score))
 
             # Store fmrr_valid score with params.
             self.scores.append({'score': auc_valid,
-                                'epoch': trn.epoch,
+                                'epoch': m.epoch,
                                 'type': "AUC_PR"})
             self.scores.append({'score': roc_valid,
-                                'epoch': trn.epoch,
+                                'epoch': m.epoch,
                                 'type': "AUC_ROC"})
 
+            # If the score has not improved for a while, stop the trainer
+            if not with_eval and self.early_stopping is not None and \
+                    self.early_stopping.update(m, auc_valid):
+                print("[%d] No improvement since epoch %d, stopping" %
+                      (self.th_num, self.early_stopping.best_epoch))
+                m.stop_training = True
+
             if auc_valid > self.best_valid_score:
                 self.best_valid_score = auc_valid
-                auc_test, roc_test = self.ev_test.scores(m)
+                auc_test, roc_test = self.ev_test.scores(m.model)
                 print("[%d] AUC PR test = %f, AUC ROC test = %f" %
                       (self.th_num, auc_test, roc_test))
 
                 if self.fout is not None:
                     st = {
-                        'model': m,
+                        'model': m.model,
                         'auc pr test': auc_test,
                         'auc pr valid': auc_valid,
                         'auc roc test': roc_test,
                         'auc roc valid': roc_valid,
-                        'exectimes': self.exectimes
+                        'exectimes': self.exectimes,
+                        'telemetry': self.telemetry.to_dict()
                     }
                     with open(self.fout, 'wb') as fout:
                         pickle.dump(st, fout, protocol=2)
+
+        self.record_epoch(m, None if with_eval else elapsed,
+                          timeit.default_timer() - eval_start)
+        if not with_eval:
+            self.save_checkpoint(m)
+        try:
+            self.external_callback(m)
+        except Exception:
+            # Callback is not present
+            pass
+
         return True
 
+    def vectorized(self):
+        """True if the trainer takes arrays of triples instead of lists of
+        tuples, see native_trainer
+
+        :rtype: bool
+        """
+        return False
+
+    def create_sampler(self, xs, sz):
+        """Creates the sampler of negative triples used by the trainer
+
+        :param list xs: The training triples
+        :param tuple sz: A tuple (N, N, M) with the size of the tensor
+        :rtype: skge.Sampler
+        """
+        if self.sampler == 'corrupted':
+            # Heads and tails of the same relation, see sampling.TypedSampler
+            return sampling.TypedSampler(self.ne, xs, sz)
+        elif self.sampler == 'random-mode':
+            return sample.RandomModeSampler(self.ne, [0, 1], xs, sz)
+        elif self.sampler == 'lcwa':
+            return sample.LCWASampler(self.ne, [0, 1, 2], xs, sz)
+        else:
+            raise ValueError('Unknown sampler (%s)' % self.sampler)
+
+    def budget_evaluator(self, mdl, evaluator):
+        """Sets the triples of a validation evaluator to take eval_seconds
+
+        The time to rank a triple is measured on EVAL_PROBE triples. It
+        depends on the size of the model, not on the values of its
+        parameters, so the model does not need to be trained yet. The
+        evaluator keeps its true triples, which are not indexed again.
+
+        :param skge.Model mdl: The model that will be evaluated
+        :param FilteredRankingEval evaluator: The validation evaluator
+        :return: The evaluator, with neval set to the triples that fit
+        """
+        evaluator.set_neval(min(EVAL_PROBE, evaluator.sz))
+        start = timeit.default_timer()
+        pos, _ = evaluator.positions(mdl)
+        elapsed = max(timeit.default_timer() - start, 1e-6)
+        # Every triple is ranked twice, by its head and by its tail
+        ranked = max(len(_flatten_positions(pos)) // 2, 1)
+        neval = int(self.eval_seconds * ranked / elapsed)
+        self.neval = min(max(neval, 1), evaluator.sz)
+        print("[%d] Evaluating %d validation triples each time" %
+              (self.th_num, self.neval))
+        evaluator.set_neval(self.neval)
+        return evaluator
+
     def train(self):
         """Train the model"""
         # Compute training vector size
@@ -238,14 +490,27 @@ class Experiment(object):
 
         # Extract triples from dataset
         subs = self.dataset.train_split()
-        true_triples = subs['train_subs'] + \
-            subs['test_subs'] + subs['valid_subs']
+        if self.vectorized():
+            # Arrays, such as the ones mapped from a split file, are kept
+            subs = dict((name, triples if isinstance(triples, np.ndarray)
+                         else graph_statistics.triples_array(triples))
+                        for name, triples in subs.items())
+            true_triples = np.concatenate(
+                (subs['train_subs'], subs['test_subs'], subs['valid_subs']))
+        else:
+            # The skge samplers keep the triples on sets
+            subs = dict((name, [tuple(x) for x in triples.tolist()]
+                         if isinstance(triples, np.ndarray) else triples)
+                        for name, triples in subs.items())
+            true_triples = subs['train_subs'] + \
+                subs['test_subs'] + subs['valid_subs']
 
         if self.train_all:
             xs = true_triples
         else:
             xs = subs['train_subs']
         ys = np.ones(len(xs))
+        self.n_train = len(xs)
 
         # Instantiate the evaluator
         if self.mode == 'rank':
@@ -253,42 +518,202 @@ class Experiment(object):
                                           self.neval)
             self.ev_valid = self.evaluator(subs['valid_subs'], true_triples,
                                            self.neval)
-        # ¹Assuming labels are if triple is either true or false:
+        # Negative triples are sampled once, so scores are comparable
         elif self.mode == 'lp':
-            self.ev_test = self.evaluator(subs['test_subs'],
-                                          # subs['test_labels'])
-                                          np.ones(len(subs['test_subs'])))
-            self.ev_valid = self.evaluator(subs['valid_subs'],
-                                           # subs['valid_labels'])
-                                           np.ones(len(subs['valid_subs'])))
-
-        # create sampling objects
-        if self.sampler == 'corrupted':
-            # create type index, here it is ok to use the whole data
-            sampler = sample.CorruptedSampler(self.ne, xs, ti)
-        elif self.sampler == 'random-mode':
-            sampler = sample.RandomModeSampler(self.ne, [0, 1], xs, sz)
-        elif self.sampler == 'lcwa':
-            sampler = sample.LCWASampler(self.ne, [0, 1, 2], xs, sz)
-        else:
-            raise ValueError('Unknown sampler (%s)' % self.sampler)
+            self.ev_test = self.evaluator(subs['test_subs'], true_triples,
+                                          sz, ne=self.ne)
+            self.ev_valid = self.evaluator(subs['valid_subs'], true_triples,
+                                           sz, ne=self.ne)
 
         # Instantiate trainer
-        trn = self.setup_trainer(sz, sampler)
+        trn = self.setup_trainer(sz, self.create_sampler(xs, sz))
         print("Fitting model %s with trainer %s" % (
             trn.model.__class__.__name__,
             trn.__class__.__name__)
         )
-        # Start trainer
-        trn.fit(xs, ys)
+        # Continue a previous training, if it was interrupted
+        resumed = self.resume(trn)
+        if not resumed:
+            # Used by the last callback, if max_epochs is 0
+            trn.epoch = 0
+            trn.epoch_start = timeit.default_timer()
+            trn.nviolations = 0
+        # Validation sample that fits on the time budget
+        if self.mode == 'rank' and self.eval_seconds and self.test_all > 0:
+            if resumed:
+                self.ev_valid.set_neval(self.neval)
+            else:
+                self.budget_evaluator(trn.model, self.ev_valid)
+        # Start trainer, on several processes if there is a sampler
+        if self.workers > 1 and getattr(trn, 'samplef', None) is not None:
+            hogwild.HogwildTrainer(trn, self.workers).fit(xs, ys)
+        else:
+            trn.fit(xs, ys)
+        # Keep the parameters of the best evaluation
+        if self.early_stopping is not None and \
+                self.early_stopping.restore(trn.model):
+            self.best_epoch = self.early_stopping.best_epoch
+            print("[%d] Restored the model of epoch %d" %
+                  (self.th_num, self.best_epoch))
         self.callback(trn, with_eval=True)
 
         return trn
 
 
+class EpochTelemetry(object):
+    """Time series with the information of every training epoch
+
+    Values are stored by columns, so the series can be saved as a compact
+    JSON object. Missing values are stored as None.
+
+    * *epoch*: The epoch number
+    * *sgd_time*: Seconds spent in SGD
+    * *eval_time*: Seconds spent evaluating the model
+    * *triples_per_sec*: Training triples processed each second
+    * *violations*: Margin violations (pairwise trainers)
+    * *loss*: Loss of the epoch (no pairwise trainers)
+    * *mrr*: Filtered MRR on validation triples
+    * *hits10*: Filtered Hits@10 on validation triples
+    * *rss*: Resident memory of the process, in bytes
+    """
+    FIELDS = ('epoch', 'sgd_time', 'eval_time', 'triples_per_sec',
+              'violations', 'loss', 'mrr', 'hits10', 'rss')
+
+    def __init__(self):
+        self.series = dict((field, []) for field in self.FIELDS)
+
+    def __len__(self):
+        return len(self.series['epoch'])
+
+    def record(self, **values):
+        """Appends the values of a new epoch
+
+        :param dict values: A value for any of the FIELDS
+        """
+        for field in self.FIELDS:
+            value = values.get(field)
+            if isinstance(value, (float, np.floating)):
+                value = round(float(value), 4)
+            elif isinstance(value, np.integer):
+                value = int(value)
+            self.series[field].append(value)
+
+    def to_dict(self):
+        """Returns a copy of the series, ready to be serialized as JSON
+
+        :rtype: dict
+        """
+        return dict((field, list(values))
+                    for field, values in self.series.items())
+
+
+class EarlyStopping(object):
+    """Stops a training when its validation score does not improve
+
+    The score must improve the best one by more than *min_delta* at least
+    once every *patience* evaluations. A copy of the parameters of the best
+    evaluation is kept, so the model can be restored to it at the end.
+    """
+    def __init__(self, patience, min_delta=0.0):
+        """
+        :param int patience: Evaluations without improvement allowed
+        :param float min_delta: Minimum improvement of the score
+        """
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_score = None
+        self.best_epoch = None
+        self.best_params = None
+        self.bad_evaluations = 0
+        self.stopped_epoch = None
+
+    def update(self, trn, score):
+        """Records the validation score of the current epoch
+
+        :param skge.Trainer trn: The trainer, just after an evaluation
+        :param float score: The validation score, higher is better
+        :return: True if the training must stop
+        :rtype: bool
+        """
+        if self.best_score is None or score > self.best_score + self.min_delta:
+            self.best_score = score
+            self.best_epoch = trn.epoch
+            self.best_params = dict((name, np.array(param)) for name, param
+                                    in trn.model._params.items())
+            self.bad_evaluations = 0
+            return False
+        self.bad_evaluations += 1
+        if self.bad_evaluations >= self.patience:
+            self.stopped_epoch = trn.epoch
+            return True
+        return False
+
+    def restore(self, mdl):
+        """Copies the parameters of the best evaluation on a model
+
+        :param skge.Model mdl: The trained model
+        :return: False if there has not been any evaluation
+        :rtype: bool
+        """
+        if self.best_params is None:
+            return False
+        for name, value in self.best_params.items():
+            mdl._params[name][...] = value
+        return True
+
+    def state(self):
+        """Returns the state to be saved on a checkpoint"""
+        return dict(vars(self))
+
+    def load(self, state):
+        """Loads the state returned by `state`"""
+        vars(self).update(state)
+
+    def to_dict(self):
+        """Returns the result of the early stopping, ready for JSON
+
+        :rtype: dict
+        """
+        return {'patience': self.patience,
+                'min_delta': self.min_delta,
+                'best_score': None if self.best_score is None
+                else float(self.best_score),
+                'best_epoch': self.best_epoch,
+                'stopped_epoch': self.stopped_epoch}
+
+
+def memory_usage():
+    """Returns the resident memory of the current process in bytes
+
+    Reads it from /proc when available, otherwise returns the maximum
+    resident memory the process has used.
+
+    :rtype: int
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 class FilteredRankingEval(object):
 
-    def __init__(self, xs, true_triples, neval=-1):
+    def __init__(self, xs, true_triples, neval=-1, seed=137):
+        """
+        :param list xs: The triples to be ranked, or an array of them
+        :param list true_triples: All the triples known to be true, or an
+                                  array of them
+        :param int neval: Number of triples ranked. -1 ranks all of them
+        :param int seed: Seed of the sample of triples ranked, the same on
+                         every evaluation, with the triples of each relation
+                         in proportion
+        """
+        # Python ints are faster than numpy scalars as keys
+        if isinstance(xs, np.ndarray):
+            xs = xs.tolist()
+        if isinstance(true_triples, np.ndarray):
+            true_triples = true_triples.tolist()
         idx = ddict(list)
         # tt stands for true triples
         tt = ddict(lambda: {'ss': ddict(list), 'os': ddict(list)})
@@ -305,15 +730,30 @@ class FilteredRankingEval(object):
             tt[p]['ss'][o].append(s)
 
         # Unpack dict
-        self.idx = dict(idx)
+        self._sos = dict(idx)
         self.tt = dict(tt)
+        self.seed = seed
+        self.set_neval(neval)
 
+    def set_neval(self, neval):
+        """Changes the number of triples ranked, keeping the true triples
+
+        The triples ranked are the same ones a new evaluator with this neval
+        would rank.
+
+        :param int neval: Number of triples ranked. -1 ranks all of them
+        """
+        self.idx = {}
         self.neval = {}
-        for p, sos in self.idx.items():
+        rng = np.random.RandomState(self.seed)
+        for p, sos in self._sos.items():
             if neval == -1:
-                self.neval[p] = -1
+                self.idx[p] = sos
+                self.neval[p] = len(sos)
             else:
-                self.neval[p] = np.int(np.ceil(neval * len(sos) / len(xs)))
+                self.idx[p] = list(sos)
+                rng.shuffle(self.idx[p])
+                self.neval[p] = int(np.ceil(neval * len(sos) / self.sz))
 
     def positions(self, mdl):
         pos = {}
@@ -366,19 +806,69 @@ class LinkPredictionEval(object):
 
     def scores(self, mdl):
         scores = mdl._scores(self.ss, self.ps, self.os)
-        pr, rc, _ = precision_recall_curve(self.ys, scores)
-        roc = roc_auc_score(self.ys, scores)
-        return auc(rc, pr), roc
+        pr, rc, _ = sklearn_metrics.precision_recall_curve(self.ys, scores)
+        roc = sklearn_metrics.roc_auc_score(self.ys, scores)
+        return sklearn_metrics.auc(rc, pr), roc
 
 
-def ranking_scores(pos, fpos, epoch, txt):
+class SampledLinkPredictionEval(LinkPredictionEval):
+    """Link prediction evaluation over true and typed corrupted triples
+
+    For each evaluated triple, ``ne`` negative triples are built replacing
+    its head or its tail by an entity of the same type (an entity seen as
+    head or tail of the same relation). Negatives known to be true are
+    filtered out. The triples are scored in batches with ``mdl._scores``.
+    """
+
+    def __init__(self, xs, true_triples, sz, ne=1, batch_size=100000,
+                 seed=137):
+        """
+        :param list xs: The triples to be evaluated
+        :param list true_triples: All the triples known to be true
+        :param tuple sz: A tuple (N, N, M) with the size of the tensor
+        :param int ne: Number of negative triples for each triple
+        :param int batch_size: Number of triples scored at once
+        :param int seed: Seed used to generate the negative triples
+        """
+        rng = np.random.RandomState(seed)
+        pos = graph_statistics.triples_array(xs)
+        type_index = sampling.TypeIndex(true_triples, sz[2])
+        true_index = sampling.TripleIndex(true_triples, sz[0], sz[2])
+
+        neg = np.repeat(pos, ne, axis=0)
+        head_mask = rng.random_sample(len(neg)) < 0.5
+        neg = sampling.typed_corruptions(neg, type_index, true_index,
+                                         head_mask, rng=rng)
+
+        all_xs = np.concatenate((pos, neg))
+        self.ss = all_xs[:, 0]
+        self.os = all_xs[:, 1]
+        self.ps = all_xs[:, 2]
+        self.ys = np.concatenate((np.ones(len(pos)), np.zeros(len(neg))))
+        self.batch_size = batch_size
+
+    def scores(self, mdl):
+        scores = np.concatenate([
+            mdl._scores(self.ss[i:i + self.batch_size],
+                        self.ps[i:i + self.batch_size],
+                        self.os[i:i + self.batch_size])
+            for i in range(0, len(self.ys), self.batch_size)])
+        pr, rc, _ = sklearn_metrics.precision_recall_curve(self.ys, scores)
+        roc = sklearn_metrics.roc_auc_score(self.ys, scores)
+        return sklearn_metrics.auc(rc, pr), roc
+
+
+def _flatten_positions(pos):
+    """Joins the head and tail positions of all relations in one array"""
     hpos = [p for k in pos.keys() for p in pos[k]['head']]
     tpos = [p for k in pos.keys() for p in pos[k]['tail']]
-    fhpos = [p for k in fpos.keys() for p in fpos[k]['head']]
-    ftpos = [p for k in fpos.keys() for p in fpos[k]['tail']]
+    return np.array(hpos + tpos)
+
+
+def ranking_scores(pos, fpos, epoch, txt):
     fmrr = _print_pos(
-        np.array(hpos + tpos),
-        np.array(fhpos + ftpos),
+        _flatten_positions(pos),
+        _flatten_positions(fpos),
         epoch, txt)
     return fmrr
 
@@ -400,23 +890,17 @@ def compute_scores(pos, hits=10):
 
 
 def cardinalities(xs, ys, sz):
-    T = to_tensor(xs, ys, sz)
-    c_head = []
-    c_tail = []
-    for Ti in T:
-        sh = Ti.tocsr().sum(axis=1)
-        st = Ti.tocsc().sum(axis=0)
-        c_head.append(sh[np.where(sh)].mean())
-        c_tail.append(st[np.where(st)].mean())
-
-    cards = {'1-1': [], '1-N': [], 'M-1': [], 'M-N': []}
-    for k in range(sz[2]):
-        if c_head[k] < 1.5 and c_tail[k] < 1.5:
-            cards['1-1'].append(k)
-        elif c_head[k] < 1.5:
-            cards['1-N'].append(k)
-        elif c_tail[k] < 1.5:
-            cards['M-1'].append(k)
-        else:
-            cards['M-N'].append(k)
+    """Classifies the relations into 1-1, 1-N, M-1 and M-N classes
+
+    See kgeserver.graph_statistics.relation_cardinalities
+
+    :param list xs: The triples, as (subject, object, predicate) tuples
+    :param list ys: The label of every triple. Zero labels are ignored
+    :param tuple sz: A tuple (N, N, M) with the size of the tensor
+    :return: A dict with the relations of each class
+    :rtype: dict
+    """
+    xs = graph_statistics.triples_array(xs)
+    xs = xs[np.asarray(ys) != 0]
+    cards, _, _ = graph_statistics.relation_cardinalities(xs, sz[0], sz[2])
     return cards
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# graph_statistics.py: Degree and relation statistics of a dataset
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+# Relations with less than this average of elements on one side are "1"
+CARDINALITY_THRESHOLD = 1.5
+
+
+def triples_array(triples):
+    """Converts a list of (subject, object, predicate) tuples into an array
+
+    :param list triples: A list of triples, or an already built array
+    :return: An integer array with shape (n_triples, 3)
+    :rtype: numpy.ndarray
+    """
+    xs = np.asarray(triples, dtype=np.int64)
+    if xs.size == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+    return xs.reshape(-1, 3)
+
+
+def unique_triples(xs, n_entities, n_relations):
+    """Removes duplicated triples from a triples array
+
+    Each triple is encoded in a single int64 key, so duplicates are found
+    with only one sort. If the key does not fit on 64 bits, rows are compared
+    directly, which is slower.
+
+    :param numpy.ndarray xs: An array with (subject, object, predicate) rows
+    :param int n_entities: The number of entities of the dataset
+    :param int n_relations: The number of relations of the dataset
+    :return: The array without duplicated rows
+    :rtype: numpy.ndarray
+    """
+    if len(xs) == 0:
+        return xs
+    n_entities = max(int(n_entities), 1)
+    if n_entities * n_entities * max(int(n_relations), 1) >= 2 ** 63:
+        return np.unique(xs, axis=0)
+
+    keys = (xs[:, 2] * n_entities + xs[:, 0]) * n_entities + xs[:, 1]
+    keys = np.unique(keys)
+    ps, rest = np.divmod(keys, n_entities * n_entities)
+    ss, os = np.divmod(rest, n_entities)
+    return np.column_stack((ss, os, ps))
+
+
+def _distinct_per_relation(ps, elements, n_elements, n_relations):
+    """Counts how many distinct elements appear with every relation
+
+    :param numpy.ndarray ps: The relation of each triple
+    :param numpy.ndarray elements: The subject or object of each triple
+    :param int n_elements: The number of distinct elements
+    :param int n_relations: The number of relations
+    :return: The number of distinct elements for each relation
+    :rtype: numpy.ndarray
+    """
+    keys = np.unique(ps * max(int(n_elements), 1) + elements)
+    return np.bincount(keys // max(int(n_elements), 1),
+                       minlength=n_relations)
+
+
+def relation_cardinalities(xs, n_entities, n_relations,
+                           threshold=CARDINALITY_THRESHOLD):
+    """Classifies every relation into 1-1, 1-N, M-1 or M-N classes
+
+    For each relation, the average number of tails of every head and the
+    average number of heads of every tail are computed. The classification
+    is the same that ``experiment.cardinalities`` has been using, but is
+    obtained through grouped reductions over the triples array instead of
+    building a sparse matrix for each relation.
+
+    :param numpy.ndarray xs: An array with (subject, object, predicate) rows
+    :param int n_entities: The number of entities of the dataset
+    :param int n_relations: The number of relations of the dataset
+    :param float threshold: The average under which a side is considered "1"
+    :return: The classes dict, and tails per head and heads per tail arrays
+    :rtype: tuple
+    """
+    xs = unique_triples(triples_array(xs), n_entities, n_relations)
+    return _cardinalities(xs, n_entities, n_relations, threshold)
+
+
+def _cardinalities(xs, n_entities, n_relations, threshold):
+    """Same as `relation_cardinalities`, but xs must not have duplicates"""
+    ss, os, ps = xs[:, 0], xs[:, 1], xs[:, 2]
+
+    counts = np.bincount(ps, minlength=n_relations).astype(np.float64)
+    heads = _distinct_per_relation(ps, ss, n_entities, n_relations)
+    tails = _distinct_per_relation(ps, os, n_entities, n_relations)
+
+    # Relations without any triple have 0 on both averages, but they are
+    # classified as M-N, as experiment.cardinalities has always done
+    tails_per_head = np.divide(counts, heads, out=np.zeros_like(counts),
+                               where=heads > 0)
+    heads_per_tail = np.divide(counts, tails, out=np.zeros_like(counts),
+                               where=tails > 0)
+
+    one_head = (tails_per_head < threshold) & (heads > 0)
+    one_tail = (heads_per_tail < threshold) & (tails > 0)
+    cards = {
+        '1-1': np.flatnonzero(one_head & one_tail).tolist(),
+        '1-N': np.flatnonzero(one_head & ~one_tail).tolist(),
+        'M-1': np.flatnonzero(~one_head & one_tail).tolist(),
+        'M-N': np.flatnonzero(~one_head & ~one_tail).tolist()
+    }
+    return cards, tails_per_head, heads_per_tail
+
+
+def degree_histogram(degrees):
+    """Builds a histogram of degrees using logarithmic bins
+
+    The first bin contains the entities with degree 0, and each next bin
+    ``k`` contains those with a degree in ``[2**(k-1), 2**k)``. This keeps
+    the histogram small even on graphs with power-law distributions.
+
+    :param numpy.ndarray degrees: The degree of every entity
+    :return: A dict with the lower bound of each bin and its count
+    :rtype: dict
+    """
+    degrees = np.asarray(degrees, dtype=np.int64)
+    if degrees.size == 0:
+        return {'bins': [], 'counts': []}
+    bins = np.zeros(degrees.shape, dtype=np.int64)
+    nonzero = degrees > 0
+    bins[nonzero] = np.floor(np.log2(degrees[nonzero])).astype(np.int64) + 1
+    counts = np.bincount(bins)
+    lower = [0] + [2 ** (k - 1) for k in range(1, len(counts))]
+    return {'bins': lower, 'counts': counts.tolist()}
+
+
+def _degree_summary(degrees):
+    """Returns the mean, max and histogram of a degree array"""
+    if degrees.size == 0:
+        return {'mean': 0.0, 'max': 0, 'histogram': degree_histogram(degrees)}
+    return {'mean': float(degrees.mean()),
+            'max': int(degrees.max()),
+            'histogram': degree_histogram(degrees)}
+
+
+def entity_degrees(triples, n_entities):
+    """Returns the number of triples where each entity appears
+
+    :param list triples: A list of (subject, object, predicate) tuples
+    :param int n_entities: The number of entities of the dataset
+    :return: The degree (in plus out) of each entity
+    :rtype: numpy.ndarray
+    """
+    xs = triples_array(triples)
+    return np.bincount(xs[:, 0], minlength=n_entities) +\
+        np.bincount(xs[:, 1], minlength=n_entities)
+
+
+def compute_statistics(triples, n_entities, n_relations):
+    """Computes all the statistics of a dataset from its triples
+
+    The result only contains python builtin types, so it can be stored
+    inside the binary dataset or returned as JSON by the REST service.
+
+    :param list triples: A list of (subject, object, predicate) tuples
+    :param int n_entities: The number of entities of the dataset
+    :param int n_relations: The number of relations of the dataset
+    :return: A dictionary with all statistics
+    :rtype: dict
+    """
+    xs = unique_triples(triples_array(triples), n_entities, n_relations)
+
+    out_degree = np.bincount(xs[:, 0], minlength=n_entities)
+    in_degree = np.bincount(xs[:, 1], minlength=n_entities)
+    relation_counts = np.bincount(xs[:, 2], minlength=n_relations)
+    cards, tph, hpt = _cardinalities(xs, n_entities, n_relations,
+                                     CARDINALITY_THRESHOLD)
+
+    return {
+        'entities': int(n_entities),
+        'relations': int(n_relations),
+        'triples': int(len(xs)),
+        'relation_counts': relation_counts.tolist(),
+        'cardinalities': cards,
+        'tails_per_head': tph.tolist(),
+        'heads_per_tail': hpt.tolist(),
+        'out_degree': _degree_summary(out_degree),
+        'in_degree': _degree_summary(in_degree)
+    }
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# hogwild.py: Trains a model on several processes over shared parameters
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import mmap
+import timeit
+import logging
+import traceback
+import multiprocessing
+import numpy as np
+import kgeserver.graph_statistics as graph_statistics
+
+log = logging.getLogger('EX-KG')
+
+
+def available_workers():
+    """Returns the number of cores this process can run on
+
+    :rtype: int
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def process_context():
+    """Returns the context used to fork the workers, or None if it can't
+
+    Daemonic processes, such as the prefork workers of celery, can't have
+    children with multiprocessing. billiard, the fork of multiprocessing
+    used by celery, allows them, so it is used on these processes.
+
+    :rtype: multiprocessing.context.BaseContext
+    """
+    if not multiprocessing.current_process().daemon:
+        return multiprocessing.get_context('fork')
+    try:
+        import billiard
+    except ImportError:
+        return None
+    return billiard.get_context('fork')
+
+
+def shared_array(array):
+    """Copies an array on memory shared with the processes forked later
+
+    The memory is an anonymous shared memory map, so the processes forked
+    after this call write on the same array. Subclasses of ndarray (such as
+    the parameters of skge) keep their class and attributes.
+
+    :param numpy.ndarray array: The array to be copied
+    :rtype: numpy.ndarray
+    """
+    buf = mmap.mmap(-1, max(1, array.nbytes))
+    shared = np.frombuffer(buf, dtype=array.dtype, count=array.size)
+    shared = shared.reshape(array.shape)
+    shared[...] = array
+    return _same_class(shared, array)
+
+
+def private_array(array):
+    """Copies a shared array on the memory of this process
+
+    :param numpy.ndarray array: The array to be copied
+    :rtype: numpy.ndarray
+    """
+    return _same_class(np.array(array), array)
+
+
+def _same_class(new, old):
+    if type(old) is not np.ndarray:
+        new = new.view(type(old))
+        new.__dict__.update(getattr(old, '__dict__', {}))
+    return new
+
+
+def _replace_arrays(trainer, copy):
+    """Replaces the parameters of a model and its optimizer state by copies
+
+    The optimizers keep references to the parameters of the model, so they
+    are replaced on both places.
+
+    :param skge.Trainer trainer: The trainer
+    :param function copy: Returns the copy of an array
+    """
+    model = trainer.model
+    for name, param in list(model._params.items()):
+        model._params[name] = copy(param)
+        if name in vars(model):
+            setattr(model, name, model._params[name])
+    for name, updater in getattr(trainer, '_updaters', {}).items():
+        for attr, value in list(vars(updater).items()):
+            if attr == 'param':
+                setattr(updater, attr, model._params[name])
+            elif isinstance(value, np.ndarray):
+                setattr(updater, attr, copy(value))
+
+
+def share_trainer(trainer):
+    """Moves the parameters and the optimizer state of a trainer to shared
+    memory. See `shared_array`
+
+    :param skge.Trainer trainer: The trainer, before forking the workers
+    """
+    _replace_arrays(trainer, shared_array)
+
+
+def unshare_trainer(trainer):
+    """Moves the parameters and the optimizer state of a trainer back to the
+    memory of this process, once the workers have finished
+
+    :param skge.Trainer trainer: The trainer
+    """
+    _replace_arrays(trainer, private_array)
+
+
+def _worker(trainer, xs, ys, nbatches, seed, conn):
+    """Trains the epochs requested through *conn* on a shard of triples
+
+    Receives the number of each epoch, and answers with the violations and
+    the loss of the shard (None if the trainer does not compute them), or
+    with the traceback of an error. None stops the worker.
+    """
+    try:
+        np.random.seed(seed)
+        # Vectorized trainers take the batches as arrays of triples
+        vectorized = getattr(trainer, 'vectorized', False)
+        if vectorized:
+            xys = xs[ys == 1]
+        else:
+            xys = list(zip([tuple(x) for x in xs.tolist()], ys.tolist()))
+        idx = np.arange(len(xys))
+        batch_size = max(1, int(np.ceil(len(xys) / nbatches)))
+        batch_idx = np.arange(batch_size, len(xys), batch_size)
+        epoch = conn.recv()
+        while epoch is not None:
+            trainer.epoch = epoch
+            trainer._pre_epoch()
+            np.random.shuffle(idx)
+            for batch in np.split(idx, batch_idx):
+                if vectorized:
+                    trainer._process_batch(xys[batch])
+                else:
+                    trainer._process_batch([xys[z] for z in batch])
+            conn.send(('ok', getattr(trainer, 'nviolations', None),
+                       getattr(trainer, 'loss', None)))
+            epoch = conn.recv()
+    except Exception:
+        conn.send(('error', traceback.format_exc(), None))
+    finally:
+        conn.close()
+
+
+class HogwildTrainer():
+    """Runs the epochs of a skge trainer on several processes at once
+
+    The parameters of the model and the state of its optimizer (AdaGrad
+    accumulators) are moved to shared memory, and a worker process is forked
+    for each shard of the training triples. Workers update the parameters
+    without locks, as described on "Hogwild!: A Lock-Free Approach to
+    Parallelizing Stochastic Gradient Descent": the updates of each batch
+    only change the rows of a few entities, so they seldom collide.
+
+    Epochs are synchronized: the *post_epoch* callbacks of the trainer run
+    on this process after every worker has finished the epoch, while they
+    wait, so evaluations and checkpoints see a consistent model. The
+    violations (or loss) of the epoch are the sum of all the shards.
+
+    Workers are forked, so this only works on platforms with ``fork``. On
+    a daemonic process without billiard (see process_context), the epochs
+    run on this process, as a single worker.
+    """
+    def __init__(self, trainer, workers):
+        """
+        :param skge.Trainer trainer: A trainer with a sampler (samplef)
+        :param int workers: The number of processes
+        """
+        self.trainer = trainer
+        self.workers = workers
+
+    def fit(self, xs, ys):
+        """Trains the model with the triples, as skge Trainer.fit does
+
+        :param list xs: The training triples
+        :param list ys: The label of each triple
+        """
+        trn = self.trainer
+        context = process_context()
+        if context is None:
+            log.warning("workers=%d ignored: this daemonic process can't "
+                        "have children and billiard is not installed. "
+                        "Training on a single process", self.workers)
+            return trn.fit(xs, ys)
+        xs = graph_statistics.triples_array(xs)
+        ys = np.asarray(ys)
+        trn.stop_training = getattr(trn, 'stop_training', False)
+        workers = max(1, min(self.workers, len(xs)))
+        # The same number of batches as a single process, on all shards
+        nbatches = max(1, int(np.ceil(trn.nbatches / workers)))
+        order = np.random.permutation(len(xs))
+        shards = np.array_split(order, workers)
+        seeds = np.random.randint(2 ** 31 - 1, size=workers)
+
+        share_trainer(trn)
+        processes, conns = [], []
+        try:
+            for shard, seed in zip(shards, seeds):
+                parent, child = context.Pipe()
+                process = context.Process(
+                    target=_worker,
+                    args=(trn, xs[shard], ys[shard], nbatches, seed, child))
+                process.daemon = True
+                process.start()
+                child.close()
+                processes.append(process)
+                conns.append(parent)
+
+            for epoch in range(1, trn.max_epochs + 1):
+                trn.epoch = epoch
+                trn.epoch_start = timeit.default_timer()
+                self._run_epoch(epoch, conns)
+                for f in trn.post_epoch:
+                    if not f(trn):
+                        break
+                if trn.stop_training:
+                    break
+        finally:
+            for conn in conns:
+                try:
+                    conn.send(None)
+                except (OSError, EOFError):
+                    pass
+            for process in processes:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+            unshare_trainer(trn)
+
+    def _run_epoch(self, epoch, conns):
+        """Trains an epoch on all the workers and adds up their results"""
+        for conn in conns:
+            conn.send(epoch)
+        results, errors = [], []
+        for conn in conns:
+            try:
+                status, nviolations, loss = conn.recv()
+            except EOFError:
+                status, nviolations = 'error', "The worker died"
+            if status == 'ok':
+                results.append((nviolations, loss))
+            else:
+                errors.append(nviolations)
+        if errors:
+            raise RuntimeError("A hogwild worker failed:\n" + errors[0])
+        for position, attr in enumerate(('nviolations', 'loss')):
+            values = [result[position] for result in results
+                      if result[position] is not None]
+            if values:
+                setattr(self.trainer, attr, sum(values))
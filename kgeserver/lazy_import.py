@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# lazy_import.py: Modules imported the first time they are used
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import types
+import threading
+import importlib
+
+_lock = threading.RLock()
+
+
+class LazyModule(types.ModuleType):
+    """A module that is imported when one of its attributes is used
+
+    Heavy dependencies (skge, sklearn, annoy, elasticsearch, celery tasks)
+    are only needed by some requests or tasks, so importing them with the
+    rest of the modules makes the web and worker processes slower to start.
+    An ImportError is raised on first use if the module is not installed.
+    """
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            with _lock:
+                module = self.__dict__['_lazy_module']
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__['_lazy_module'] else "not loaded"
+        return "<lazy module '{}' ({})>".format(self.__name__, state)
+
+
+def lazy_import(name):
+    """Returns a module that is imported the first time it is used
+
+    :param str name: The absolute name of the module, as in import_module
+    :rtype: LazyModule
+    """
+    return LazyModule(name)
+
+
+def is_loaded(module):
+    """Checks if a module returned by lazy_import has been imported"""
+    if isinstance(module, LazyModule):
+        return module.__dict__['_lazy_module'] is not None
+    return True
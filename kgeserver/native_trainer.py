@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# native_trainer.py: Vectorized TransE and HolE trainer written with numpy
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import timeit
+import numpy as np
+import kgeserver.graph_statistics as graph_statistics
+import kgeserver.sampling as sampling
+
+# Entity, or relation, replaced by each negative sampler. See CorruptionSampler
+SAMPLER_MODES = {
+    'random-mode': (0, 1),
+    'lcwa': (0, 1, 2),
+}
+
+
+def init_nunif(shape, rng=np.random):
+    """Uniform values scaled by the size of the matrix, as skge does"""
+    bound = np.sqrt(6) / np.sqrt(shape[0] + shape[1])
+    return rng.uniform(-bound, bound, size=shape)
+
+
+def normalize(rows):
+    """Scales every row to norm 1"""
+    norms = np.linalg.norm(rows, axis=1)
+    norms[norms == 0] = 1
+    return rows / norms[:, np.newaxis]
+
+
+def normless1(rows):
+    """Scales the rows with a norm greater than 1 to norm 1"""
+    norms = np.linalg.norm(rows, axis=1)
+    return rows / np.maximum(norms, 1)[:, np.newaxis]
+
+
+def ccorr(a, b):
+    """Circular correlation of the rows of two matrices"""
+    return np.fft.irfft(np.conj(np.fft.rfft(a)) * np.fft.rfft(b),
+                        n=a.shape[-1]).astype(a.dtype, copy=False)
+
+
+def cconv(a, b):
+    """Circular convolution of the rows of two matrices"""
+    return np.fft.irfft(np.fft.rfft(a) * np.fft.rfft(b),
+                        n=a.shape[-1]).astype(a.dtype, copy=False)
+
+
+def sum_rows(rows, grads):
+    """Adds up the gradients of the same row
+
+    The gradients are sorted by row once, and each group is added with a
+    single ``np.add.reduceat``, which is faster than ``np.add.at``.
+
+    :param numpy.ndarray rows: The row of each gradient
+    :param numpy.ndarray grads: A gradient on each row
+    :return: The distinct rows and the sum of their gradients
+    :rtype: tuple
+    """
+    order = np.argsort(rows, kind='mergesort')
+    rows = rows[order]
+    starts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+    return rows[starts], np.add.reduceat(grads[order], starts, axis=0)
+
+
+class Model():
+    """Parameters of a model trained by PairwiseTrainer
+
+    The parameters are float32 matrices on ``_params``, as on skge models,
+    so the checkpoints, the evaluators and the server use both in the same
+    way. Subclasses define the score of a triple and its gradients.
+    """
+    # Trained by a PairwiseTrainer, not by an skge trainer
+    vectorized = True
+    # Function applied to the rows of each parameter after an update
+    POST = {}
+
+    def __init__(self, sz, ncomp, init='nunif', rparam=0, af='sigmoid',
+                 dtype=np.float32):
+        """
+        :param tuple sz: A tuple (N, N, M) with the size of the tensor
+        :param int ncomp: Number of latent components
+        :param str init: Initialization method. Only 'nunif'
+        :param float rparam: Regularization of the parameters updated
+        :param str af: Activation function, 'sigmoid' or 'linear'
+        :param dtype: The type of the parameters
+        """
+        if init != 'nunif':
+            raise ValueError("Unknown initialization ({})".format(init))
+        if af not in ('sigmoid', 'linear'):
+            raise ValueError("Unknown activation function ({})".format(af))
+        self.sz = sz
+        self.ncomp = ncomp
+        self.rparam = rparam
+        self.af = af
+        self.margin = 1.0
+        self._params = {}
+        for name, rows in (('E', sz[0]), ('R', sz[2])):
+            param = init_nunif((rows, ncomp)).astype(dtype)
+            if name in self.POST:
+                param = self.POST[name](param).astype(dtype)
+            self._params[name] = param
+
+    @property
+    def E(self):
+        return self._params['E']
+
+    @property
+    def R(self):
+        return self._params['R']
+
+    def post(self, name, rows):
+        """Applies the constraints of a parameter to the rows updated"""
+        if name in self.POST:
+            param = self._params[name]
+            param[rows] = self.POST[name](param[rows])
+
+    def _activation(self, scores):
+        if self.af == 'sigmoid':
+            return 1 / (1 + np.exp(-scores))
+        return scores
+
+    def _activation_grad(self, values):
+        """Derivative of the activation function, given its values"""
+        if self.af == 'sigmoid':
+            return values * (1 - values)
+        return np.ones_like(values)
+
+    def _regularize(self, grads):
+        if self.rparam:
+            for name, (rows, grad) in grads.items():
+                grad += self.rparam * self._params[name][rows]
+        return grads
+
+    def _scores(self, ss, ps, os):
+        """Returns the score of many triples, higher is better"""
+        raise NotImplementedError("Implemented by each model")
+
+    def _pairwise_gradients(self, pos, neg):
+        """Gradients of the margin ranking loss of a batch
+
+        :param numpy.ndarray pos: The (subject, object, predicate) triples
+        :param numpy.ndarray neg: A corrupted triple for each one of pos
+        :return: The number of pairs that violate the margin, their loss
+                 and, for each parameter, the rows updated and their
+                 gradients
+        :rtype: tuple
+        """
+        raise NotImplementedError("Implemented by each model")
+
+
+class TransE(Model):
+    """Translation model: the score of a triple is ``-|s + p - o|`` (L1)"""
+    POST = {'E': normalize}
+
+    def _scores(self, ss, ps, os):
+        return -np.sum(np.abs(self.E[ss] + self.R[ps] - self.E[os]), axis=1)
+
+    def _pairwise_gradients(self, pos, neg):
+        sp, op, pp = pos[:, 0], pos[:, 1], pos[:, 2]
+        sn, on, pn = neg[:, 0], neg[:, 1], neg[:, 2]
+        E, R = self.E, self.R
+        dp = E[sp] + R[pp] - E[op]
+        dn = E[sn] + R[pn] - E[on]
+        fp = -np.sum(np.abs(dp), axis=1)
+        fn = -np.sum(np.abs(dn), axis=1)
+        violations = np.flatnonzero(fn + self.margin > fp)
+        if len(violations) == 0:
+            return 0, 0.0, {}
+        loss = float(np.sum(self.margin - fp[violations] + fn[violations]))
+        gp = np.sign(dp[violations])
+        gn = np.sign(dn[violations])
+        sp, op, pp = sp[violations], op[violations], pp[violations]
+        sn, on, pn = sn[violations], on[violations], pn[violations]
+        grads = {
+            'E': (np.concatenate((sp, op, sn, on)),
+                  np.concatenate((gp, -gp, -gn, gn))),
+            'R': (np.concatenate((pp, pn)), np.concatenate((gp, -gn)))
+        }
+        return len(violations), loss, self._regularize(
+            dict((name, sum_rows(*value)) for name, value in grads.items()))
+
+
+class HolE(Model):
+    """Holographic embeddings: the score of a triple is
+    ``af(p · ccorr(s, o))``"""
+    POST = {'E': normless1}
+
+    def _scores(self, ss, ps, os):
+        return np.sum(self.R[ps] * ccorr(self.E[ss], self.E[os]), axis=1)
+
+    def _pairwise_gradients(self, pos, neg):
+        sp, op, pp = pos[:, 0], pos[:, 1], pos[:, 2]
+        sn, on, pn = neg[:, 0], neg[:, 1], neg[:, 2]
+        E, R = self.E, self.R
+        corr_p = ccorr(E[sp], E[op])
+        corr_n = ccorr(E[sn], E[on])
+        fp = self._activation(np.sum(R[pp] * corr_p, axis=1))
+        fn = self._activation(np.sum(R[pn] * corr_n, axis=1))
+        violations = np.flatnonzero(fn + self.margin > fp)
+        if len(violations) == 0:
+            return 0, 0.0, {}
+        loss = float(np.sum(self.margin - fp[violations] + fn[violations]))
+        # Derivative of the loss by the score of each triple
+        gp = -self._activation_grad(fp[violations])[:, np.newaxis]
+        gn = self._activation_grad(fn[violations])[:, np.newaxis]
+        gp, gn = gp.astype(E.dtype), gn.astype(E.dtype)
+        sp, op, pp = sp[violations], op[violations], pp[violations]
+        sn, on, pn = sn[violations], on[violations], pn[violations]
+        # d(p · ccorr(s, o)) is ccorr(p, o) for s, cconv(p, s) for o and
+        # ccorr(s, o) for p
+        grads = {
+            'E': (np.concatenate((sp, op, sn, on)),
+                  np.concatenate((gp * ccorr(R[pp], E[op]),
+                                  gp * cconv(R[pp], E[sp]),
+                                  gn * ccorr(R[pn], E[on]),
+                                  gn * cconv(R[pn], E[sn])))),
+            'R': (np.concatenate((pp, pn)),
+                  np.concatenate((gp * corr_p[violations],
+                                  gn * corr_n[violations])))
+        }
+        return len(violations), loss, self._regularize(
+            dict((name, sum_rows(*value)) for name, value in grads.items()))
+
+
+# Native models, by the name of their skge counterpart
+MODELS = {
+    'TransE': TransE,
+    'HolE': HolE,
+}
+
+
+class AdaGrad():
+    """AdaGrad updates of the rows of a parameter"""
+    def __init__(self, param, learning_rate, epsilon=1e-7):
+        self.param = param
+        self.learning_rate = learning_rate
+        self.epsilon = epsilon
+        self.p2 = np.zeros_like(param)
+
+    def __call__(self, grad, rows):
+        """Updates some rows of the parameter
+
+        :param numpy.ndarray grad: The gradient of each row
+        :param numpy.ndarray rows: The rows, without repetitions
+        """
+        p2 = self.p2[rows] + grad * grad
+        self.p2[rows] = p2
+        self.param[rows] -= self.learning_rate * grad / np.maximum(
+            np.sqrt(p2), self.epsilon)
+
+
+class CorruptionSampler():
+    """Corrupts a batch of triples at once
+
+    Each triple is repeated *ne* times, and on each copy the subject, the
+    object or the predicate (see SAMPLER_MODES) is replaced by a random one.
+    Copies that are known triples are drawn again up to *max_tries* times,
+    and discarded if they are still true.
+    """
+    def __init__(self, ne, xs, sz, modes=(0, 1), max_tries=10):
+        """
+        :param int ne: Number of negative triples for each triple
+        :param list xs: The triples known to be true
+        :param tuple sz: A tuple (N, N, M) with the size of the tensor
+        :param tuple modes: The positions that may be replaced
+        :param int max_tries: Maximum number of draws for each triple
+        """
+        self.ne = ne
+        self.sizes = np.array(sz, dtype=np.int64)
+        self.modes = np.array(modes, dtype=np.int64)
+        self.max_tries = max_tries
+        self.true_index = sampling.TripleIndex(xs, sz[0], sz[2])
+
+    def sample_batch(self, xs):
+        """Returns the positive and negative pairs of a batch
+
+        :param numpy.ndarray xs: The (subject, object, predicate) triples
+        :return: Two arrays of the same length, the triple and its
+                 corruption
+        :rtype: tuple
+        """
+        pos = np.repeat(xs, self.ne, axis=0)
+        neg = pos.copy()
+        modes = self.modes[np.random.randint(len(self.modes), size=len(neg))]
+        todo = np.arange(len(neg))
+        for _ in range(self.max_tries):
+            if len(todo) == 0:
+                break
+            for mode in self.modes:
+                rows = todo[modes[todo] == mode]
+                neg[rows, mode] = np.random.randint(self.sizes[mode],
+                                                    size=len(rows))
+            todo = todo[self.true_index.contains(neg[todo])]
+        keep = np.ones(len(neg), dtype=bool)
+        keep[todo] = False
+        return pos[keep], neg[keep]
+
+
+class PairwiseTrainer():
+    """Trains a Model with mini-batches of margin ranking loss
+
+    A batch is a few integer arrays: the positive triples, their
+    corruptions, and the rows gathered from the parameters. The gradients
+    of each row are added up and applied with a single AdaGrad update, on
+    float32, without any Python loop per triple.
+
+    It takes the same arguments as skge.PairwiseStochasticTrainer, and runs
+    the *post_epoch* callbacks the same way, so Experiment, the checkpoints
+    and HogwildTrainer use both. *samplef* is the ``sample_batch`` method of
+    a CorruptionSampler or a sampling.TypedSampler.
+    """
+    vectorized = True
+
+    def __init__(self, model, nbatches=100, margin=1.0, max_epochs=500,
+                 learning_rate=0.1, samplef=None, post_epoch=()):
+        self.model = model
+        self.model.margin = margin
+        self.nbatches = nbatches
+        self.max_epochs = max_epochs
+        self.learning_rate = learning_rate
+        self.samplef = samplef
+        self.post_epoch = list(post_epoch)
+        self.stop_training = False
+        self.epoch = 0
+        self._updaters = dict(
+            (name, AdaGrad(param, learning_rate))
+            for name, param in model._params.items())
+
+    def fit(self, xs, ys):
+        """Trains the model with the triples labeled with 1
+
+        :param list xs: The training triples
+        :param list ys: The label of each triple
+        """
+        xs = graph_statistics.triples_array(xs)[np.asarray(ys) == 1]
+        batch_size = max(1, int(np.ceil(len(xs) / self.nbatches)))
+        for epoch in range(1, self.max_epochs + 1):
+            self.epoch = epoch
+            self._pre_epoch()
+            order = np.random.permutation(len(xs))
+            self.epoch_start = timeit.default_timer()
+            for start in range(0, len(xs), batch_size):
+                self._process_batch(xs[order[start:start + batch_size]])
+            for f in self.post_epoch:
+                if not f(self):
+                    break
+            if self.stop_training:
+                break
+
+    def _pre_epoch(self):
+        self.nviolations = 0
+        self.loss = 0.0
+
+    def _process_batch(self, xs):
+        """Takes an AdaGrad step with a batch of triples
+
+        :param numpy.ndarray xs: The (subject, object, predicate) triples
+        """
+        pos, neg = self.samplef(xs)
+        if len(pos) == 0:
+            return
+        nviolations, loss, grads = self.model._pairwise_gradients(pos, neg)
+        self.nviolations += nviolations
+        self.loss += loss
+        for name, (rows, grad) in grads.items():
+            self._updaters[name](grad, rows)
+            self.model.post(name, rows)
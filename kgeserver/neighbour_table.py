@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# neighbour_table.py: Precomputed nearest neighbours of the entities
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import kgeserver.graph_statistics as graph_statistics
+
+# Queries and entities compared at once by each matrix product
+QUERY_ROWS = 256
+ENTITY_ROWS = 65536
+
+# Embeddings opened by each worker, by path
+_matrices = {}
+_matrices_lock = threading.Lock()
+
+
+def table_paths(prefix):
+    """Paths of the files of a table
+
+    :param str prefix: The prefix of the table files
+    :return: The paths of the ids, distances and rows files
+    :rtype: tuple
+    """
+    return (prefix + "_ids.npy", prefix + "_distances.npy",
+            prefix + "_rows.npy")
+
+
+def top_entities_by_degree(triples, n_entities, n):
+    """Returns the n entities which appear on more triples
+
+    :param list triples: The (subject, object, predicate) triples
+    :param int n_entities: The number of entities of the dataset
+    :param int n: The number of entities returned
+    :rtype: numpy.ndarray
+    """
+    degree = graph_statistics.entity_degrees(triples, n_entities)
+    n = min(n, n_entities)
+    top = np.argpartition(-degree, n - 1)[:n] if n < n_entities \
+        else np.arange(n_entities)
+    return np.sort(top)
+
+
+def _open_matrix(path):
+    with _matrices_lock:
+        if path not in _matrices:
+            _matrices[path] = np.load(path, mmap_mode='r')
+        return _matrices[path]
+
+
+def _neighbours_block(args):
+    """Finds the k nearest entities of some rows of the table
+
+    The entities are compared by blocks with a matrix product, and only the
+    k best of each row are kept between blocks. Results are written on the
+    table files, opened again by each worker.
+    """
+    norm_path, prefix, entities, start, k = args
+    matrix = _open_matrix(norm_path)
+    queries = np.asarray(matrix[entities])
+    rows = np.arange(len(queries))[:, None]
+    best_sims = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+    for first in range(0, len(matrix), ENTITY_ROWS):
+        sims = queries.dot(matrix[first:first + ENTITY_ROWS].T)
+        ids = np.arange(first, first + sims.shape[1])
+        sims = np.concatenate([best_sims, sims], axis=1)
+        ids = np.concatenate(
+            [best_ids, np.broadcast_to(ids, (len(queries), len(ids)))],
+            axis=1)
+        if sims.shape[1] > k:
+            # Partition without negating, which would copy the block
+            top = np.argpartition(sims, sims.shape[1] - k, axis=1)[:, -k:]
+            sims, ids = sims[rows, top], ids[rows, top]
+        best_sims, best_ids = sims, ids
+
+    order = np.argsort(-best_sims, axis=1, kind='mergesort')
+    best_sims, best_ids = best_sims[rows, order], best_ids[rows, order]
+    ids_path, dist_path, _ = table_paths(prefix)
+    out_ids = np.load(ids_path + ".tmp.npy", mmap_mode='r+')
+    out_dist = np.load(dist_path + ".tmp.npy", mmap_mode='r+')
+    out_ids[start:start + len(queries)] = best_ids
+    # Same distance used by Annoy angular indexes
+    out_dist[start:start + len(queries)] = np.sqrt(
+        np.maximum(2 - 2 * best_sims, 0))
+    out_ids.flush()
+    out_dist.flush()
+    return len(queries)
+
+
+def _make_pool(processes):
+    if multiprocessing.current_process().daemon:
+        # Daemonic processes, such as celery workers, can't have children.
+        # Matrix products release the GIL, so threads also run in parallel
+        return ThreadPool(processes)
+    return multiprocessing.Pool(processes)
+
+
+class NeighbourTable():
+    """The k nearest entities of every entity, computed beforehand
+
+    The table is stored on three ``.npy`` files, which are memory mapped
+    when loaded, so only the rows requested are read from disk:
+
+    * *ids*: A (N, k) matrix with the nearest entities of each row, nearest
+      first. The entity itself is usually the first one.
+    * *distances*: A (N, k) matrix with the angular distance of each one.
+    * *rows*: The row of each entity, or -1 if the table has not the entity.
+
+    Distances are computed with the exact cosine, and are the same distances
+    an Annoy ``angular`` index returns.
+    """
+    def __init__(self, rows, ids, distances):
+        self.rows = rows
+        self.ids = ids
+        self.distances = distances
+        self.k = ids.shape[1]
+
+    @classmethod
+    def build(cls, embeddings, prefix, k=51, entities=None, processes=None):
+        """Computes the table and saves it on disk
+
+        :param numpy.ndarray embeddings: The embeddings, one entity by row.
+                                         QuantizedEmbeddings are also valid
+        :param str prefix: The prefix of the table files
+        :param int k: Neighbours stored for each entity
+        :param list entities: Entities of the table. Defaults to all
+        :param int processes: Parallel workers. Defaults to the CPU count
+        :rtype: NeighbourTable
+        """
+        n_entities = len(embeddings)
+        k = min(k, n_entities)
+        if entities is None:
+            entities = np.arange(n_entities)
+        entities = np.asarray(entities, dtype=np.int64)
+        ids_path, dist_path, rows_path = table_paths(prefix)
+
+        # The table is not valid while it is being built
+        cls.remove(prefix)
+
+        # Normalized embeddings are shared with workers through a file
+        norm_path = prefix + "_normalized.tmp.npy"
+        normalized = np.lib.format.open_memmap(
+            norm_path, mode='w+', dtype=np.float32,
+            shape=(n_entities, embeddings.shape[1]))
+        for first in range(0, n_entities, ENTITY_ROWS):
+            block = np.asarray(embeddings[first:first + ENTITY_ROWS],
+                               dtype=np.float32)
+            norms = np.maximum(np.linalg.norm(block, axis=1), 1e-12)
+            normalized[first:first + len(block)] = block / norms[:, None]
+        normalized.flush()
+        del normalized
+
+        np.lib.format.open_memmap(ids_path + ".tmp.npy", mode='w+',
+                                  dtype=np.int32,
+                                  shape=(len(entities), k)).flush()
+        np.lib.format.open_memmap(dist_path + ".tmp.npy", mode='w+',
+                                  dtype=np.float32,
+                                  shape=(len(entities), k)).flush()
+
+        jobs = [(norm_path, prefix, entities[start:start + QUERY_ROWS],
+                 start, k)
+                for start in range(0, len(entities), QUERY_ROWS)]
+        try:
+            pool = _make_pool(processes or multiprocessing.cpu_count())
+            try:
+                for _ in pool.imap_unordered(_neighbours_block, jobs):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            with _matrices_lock:
+                _matrices.pop(norm_path, None)
+            os.remove(norm_path)
+
+        rows = np.full(n_entities, -1, dtype=np.int32)
+        rows[entities] = np.arange(len(entities))
+        os.replace(ids_path + ".tmp.npy", ids_path)
+        os.replace(dist_path + ".tmp.npy", dist_path)
+        # Rows are saved the last, so a table with rows is complete
+        np.save(rows_path + ".tmp.npy", rows)
+        os.replace(rows_path + ".tmp.npy", rows_path)
+        return cls.load(prefix)
+
+    @classmethod
+    def load(cls, prefix):
+        """Opens a table saved on disk
+
+        :param str prefix: The prefix of the table files
+        :rtype: NeighbourTable
+        """
+        ids_path, dist_path, rows_path = table_paths(prefix)
+        return cls(np.load(rows_path), np.load(ids_path, mmap_mode='r'),
+                   np.load(dist_path, mmap_mode='r'))
+
+    @staticmethod
+    def exists(prefix):
+        """Checks if there is a complete table on disk"""
+        return os.path.isfile(table_paths(prefix)[2])
+
+    @staticmethod
+    def remove(prefix):
+        """Removes the files of a table, if they exist"""
+        # Rows first, so the table is never used half removed
+        for path in reversed(table_paths(prefix)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def neighbours(self, entity, k):
+        """Returns the k nearest entities of an entity
+
+        :param int entity: The entity id
+        :param int k: The number of entities, including the entity itself
+        :return: A list of pairs (entity, distance), or None if the table
+                 has not the entity or less than k neighbours by entity
+        :rtype: list
+        """
+        if k > self.k or entity < 0 or entity >= len(self.rows) or \
+                self.rows[entity] < 0:
+            return None
+        row = self.rows[entity]
+        return [(int(e_id), float(dist)) for e_id, dist in
+                zip(self.ids[row, :k], self.distances[row, :k])]
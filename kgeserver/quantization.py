@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# quantization.py: Compact storage of trained embeddings to serve them
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import numpy as np
+import kgeserver.vocabulary as vocabulary
+
+# Supported storage types. float16 keeps the neighbours almost exact, int8
+# uses half the memory but loses more precision
+DTYPES = ('float16', 'int8')
+
+
+def quantized_path(model_path, dtype):
+    """Path of the quantized embeddings of a model
+
+    :param str model_path: The path of the trained model
+    :param str dtype: The storage type
+    :rtype: str
+    """
+    return model_path[:-4] + "_{}.bin".format(dtype)
+
+
+class QuantizedEmbeddings():
+    """Entity embeddings stored with less bits than the trained model
+
+    With *float16* every value is rounded to half precision. With *int8* each
+    row is divided by its own scale (the maximum absolute value / 127) and
+    rounded, so rows with very different norms keep the same precision.
+
+    Rows are returned as float32 arrays, so it can be used where the ``E``
+    matrix of a model is expected: ``embeddings[i]``, ``embeddings.shape``
+    and ``len(embeddings)``.
+    """
+    def __init__(self, data, scales=None, report=None):
+        """Creates the object from the stored arrays. See `quantize`
+
+        :param numpy.ndarray data: The quantized matrix
+        :param numpy.ndarray scales: The scale of each row (only int8)
+        :param dict report: The precision report, if it was computed
+        """
+        self.data = data
+        self.scales = scales
+        self.dtype = data.dtype.name
+        self.shape = data.shape
+        self.report = report
+
+    @classmethod
+    def quantize(cls, matrix, dtype='float16'):
+        """Quantizes a full precision matrix
+
+        :param numpy.ndarray matrix: The embeddings, one entity by row
+        :param str dtype: One of DTYPES
+        :rtype: QuantizedEmbeddings
+        """
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if dtype == 'float16':
+            return cls(matrix.astype(np.float16))
+        elif dtype == 'int8':
+            scales = np.abs(matrix).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            data = np.rint(matrix / scales[:, None]).astype(np.int8)
+            return cls(data, scales.astype(np.float32))
+        raise ValueError("Unknown dtype {}. Use one of {}".format(dtype,
+                                                                  DTYPES))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        """Returns the float32 values of one row, or several rows"""
+        values = self.data[rows].astype(np.float32)
+        if self.scales is not None:
+            scales = self.scales[rows]
+            values *= scales[..., None] if np.ndim(scales) else scales
+        return values
+
+    def nbytes(self):
+        """Memory used by the quantized arrays"""
+        return self.data.nbytes + (0 if self.scales is None
+                                   else self.scales.nbytes)
+
+    def save(self, filepath):
+        """Saves the quantized embeddings with vocabulary.write_arrays
+
+        :param str filepath: The path of the file
+        """
+        arrays = {'data': self.data}
+        if self.scales is not None:
+            arrays['scales'] = self.scales
+        vocabulary.write_arrays(filepath, {'report': self.report}, arrays)
+
+    @classmethod
+    def load(cls, filepath):
+        """Maps on memory the quantized embeddings saved with `save`
+
+        Only the rows read are paged in, and the pages are shared by all
+        the processes that load the same file.
+
+        :param str filepath: The path of the file
+        :rtype: QuantizedEmbeddings
+        """
+        meta, arrays = vocabulary.read_arrays(filepath)
+        return cls(arrays['data'], arrays.get('scales'), meta['report'])
+
+
+def _exact_neighbours(matrix, queries, k):
+    """Exact top k rows by cosine for each query row of a float matrix"""
+    norms = np.maximum(np.linalg.norm(matrix, axis=1), 1e-12)
+    normalized = matrix / norms[:, None]
+    result = []
+    for start in range(0, len(queries), 32):
+        cosines = normalized.dot(normalized[queries[start:start + 32]].T)
+        top = np.argpartition(-cosines, k - 1, axis=0)[:k]
+        result += [set(column.tolist()) for column in top.T]
+    return result
+
+
+def recall_report(matrix, quantized, n_queries=200, k=10, seed=137):
+    """Measures the precision lost by the quantized embeddings
+
+    For a sample of entities, the k nearest entities are found with the full
+    precision embeddings and with the quantized ones. The recall is the
+    fraction of the full precision neighbours found with the quantized ones.
+
+    :param numpy.ndarray matrix: The full precision embeddings
+    :param QuantizedEmbeddings quantized: The quantized embeddings
+    :param int n_queries: The number of entities sampled
+    :param int k: The number of neighbours
+    :param int seed: The seed to sample entities
+    :return: The recall@k, reconstruction error and memory used
+    :rtype: dict
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    k = min(k, len(matrix))
+    rng = np.random.RandomState(seed)
+    queries = rng.choice(len(matrix), size=min(n_queries, len(matrix)),
+                         replace=False)
+    full = _exact_neighbours(matrix, queries, k)
+    approx = _exact_neighbours(quantized[:].astype(np.float64), queries, k)
+    recalls = [len(f & a) / float(k) for f, a in zip(full, approx)]
+    error = np.abs(quantized[:] - matrix)
+    return {'dtype': quantized.dtype,
+            'k': k,
+            'queries': len(queries),
+            'recall': float(np.mean(recalls)),
+            'min_recall': float(np.min(recalls)),
+            'max_abs_error': float(error.max()),
+            'mean_abs_error': float(error.mean()),
+            'full_bytes': int(matrix.nbytes),
+            'quantized_bytes': int(quantized.nbytes()),
+            'compression': float(matrix.nbytes) / quantized.nbytes()}
+
+
+def quantize_model(model, model_path, dtype='float16', **report_kwargs):
+    """Saves the quantized entity embeddings of a model next to it
+
+    :param skge.Model model: The trained model
+    :param str model_path: The path where the model is saved
+    :param str dtype: One of DTYPES
+    :return: The path of the quantized embeddings and the recall report
+    :rtype: tuple
+    """
+    quantized = QuantizedEmbeddings.quantize(model.E, dtype)
+    quantized.report = recall_report(model.E, quantized, **report_kwargs)
+    filepath = quantized_path(model_path, dtype)
+    quantized.save(filepath)
+    return filepath, quantized.report
+
+
+def load_embeddings(model_path, load_model, dtype='float16'):
+    """Loads the entity embeddings of a model, quantized if possible
+
+    :param str model_path: The path of the trained model
+    :param function load_model: Loads the full model if there is no
+                                quantized version, such as
+                                algorithm.load_model
+    :param str dtype: The storage type preferred
+    :return: QuantizedEmbeddings or the ``E`` matrix of the model
+    """
+    filepath = quantized_path(model_path, dtype)
+    if os.path.isfile(filepath):
+        return QuantizedEmbeddings.load(filepath)
+    return load_model(model_path).E
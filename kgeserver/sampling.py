@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# sampling.py: Indexes over triples used to build negative examples
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import kgeserver.graph_statistics as graph_statistics
+
+
+class TripleIndex(object):
+    """Answers if triples are known to be true, many triples at once
+
+    Every triple (subject, object, predicate) is encoded as the int64 key
+    ``(predicate * N + subject) * N + object``, where N is the number of
+    entities. Keys are stored sorted, so membership of a whole batch is
+    solved with a single binary search. If the key does not fit on 64 bits,
+    keys are records of the three ids, which are compared in that order, as
+    graph_statistics.unique_triples does.
+    """
+    KEY_DTYPE = np.dtype([('p', np.int64), ('s', np.int64), ('o', np.int64)])
+
+    def __init__(self, true_triples, n_entities, n_relations=None):
+        """Builds the index from a list of triples
+
+        :param list true_triples: The (subject, object, predicate) triples
+        :param int n_entities: The number of entities of the dataset
+        :param int n_relations: The number of relations of the dataset. By
+                                default, the highest relation of the triples
+        """
+        self.n_entities = max(int(n_entities), 1)
+        xs = graph_statistics.triples_array(true_triples)
+        if n_relations is None:
+            n_relations = int(xs[:, 2].max()) + 1 if len(xs) else 1
+        self.records = self.n_entities * self.n_entities * \
+            max(int(n_relations), 1) >= 2 ** 63
+        self.keys = np.unique(self.encode(xs))
+
+    def encode(self, xs):
+        """Returns the key of each triple
+
+        :param numpy.ndarray xs: An array with (subject, object, predicate)
+        :return: The int64 keys, or records if they do not fit on 64 bits
+        :rtype: numpy.ndarray
+        """
+        if self.records:
+            keys = np.empty(len(xs), dtype=self.KEY_DTYPE)
+            keys['p'] = xs[:, 2]
+            keys['s'] = xs[:, 0]
+            keys['o'] = xs[:, 1]
+            return keys
+        n = self.n_entities
+        return (xs[:, 2] * n + xs[:, 0]) * n + xs[:, 1]
+
+    def contains(self, xs):
+        """Checks which triples are inside the index
+
+        :param numpy.ndarray xs: An array with (subject, object, predicate)
+        :return: A boolean array, True if the triple is known
+        :rtype: numpy.ndarray
+        """
+        keys = self.encode(xs)
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos == len(self.keys)] = 0
+        return self.keys[pos] == keys
+
+
+class TypeIndex(object):
+    """Stores which entities appear as head and as tail of every relation
+
+    The candidates of all relations are stored in a single array, sorted by
+    relation, and a pointer array marks where each relation starts (CSR
+    layout). This allows to draw a typed entity for many relations at once.
+    """
+    def __init__(self, triples, n_relations):
+        """Builds the domain and range of each relation
+
+        :param list triples: The (subject, object, predicate) triples
+        :param int n_relations: The number of relations of the dataset
+        """
+        xs = graph_statistics.triples_array(triples)
+        self.n_relations = n_relations
+        self.heads_ptr, self.heads = self._group(xs[:, 2], xs[:, 0])
+        self.tails_ptr, self.tails = self._group(xs[:, 2], xs[:, 1])
+
+    def _group(self, ps, elements):
+        """Groups the distinct elements that appear with each relation
+
+        :return: A pointer array and the grouped elements
+        :rtype: tuple
+        """
+        base = int(elements.max()) + 1 if len(elements) else 1
+        keys = np.unique(ps * base + elements)
+        rels, grouped = np.divmod(keys, base)
+        counts = np.bincount(rels, minlength=self.n_relations)
+        ptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return ptr, grouped
+
+    def _sample(self, ptr, grouped, ps, rng):
+        start = ptr[ps]
+        count = ptr[ps + 1] - start
+        offset = (rng.random_sample(len(ps)) * count).astype(np.int64)
+        return grouped[start + offset]
+
+    def sample_heads(self, ps, rng=np.random):
+        """Draws a head entity of each relation given
+
+        :param numpy.ndarray ps: The relations. Each one must have triples
+        :param numpy.random.RandomState rng: The random generator
+        :rtype: numpy.ndarray
+        """
+        return self._sample(self.heads_ptr, self.heads, ps, rng)
+
+    def sample_tails(self, ps, rng=np.random):
+        """Draws a tail entity of each relation given
+
+        :param numpy.ndarray ps: The relations. Each one must have triples
+        :param numpy.random.RandomState rng: The random generator
+        :rtype: numpy.ndarray
+        """
+        return self._sample(self.tails_ptr, self.tails, ps, rng)
+
+    def domain_size(self, ps):
+        """Returns how many distinct heads each relation has"""
+        return self.heads_ptr[ps + 1] - self.heads_ptr[ps]
+
+    def range_size(self, ps):
+        """Returns how many distinct tails each relation has"""
+        return self.tails_ptr[ps + 1] - self.tails_ptr[ps]
+
+
+def head_probabilities(triples, n_entities, n_relations):
+    """Probability of corrupting the head of a triple of each relation
+
+    Replacing the "1" side of 1-N or M-1 relations yields more false
+    negatives (the "bern" strategy of TransH), so the head is corrupted with
+    probability ``tph / (tph + hpt)``, where tph are the tails per head and
+    hpt the heads per tail of the relation. Relations without triples get
+    0.5.
+
+    :param list triples: The (subject, object, predicate) triples
+    :param int n_entities: The number of entities of the dataset
+    :param int n_relations: The number of relations of the dataset
+    :rtype: numpy.ndarray
+    """
+    _, tph, hpt = graph_statistics.relation_cardinalities(
+        triples, n_entities, n_relations)
+    total = tph + hpt
+    return np.divide(tph, total, out=np.full_like(total, 0.5),
+                     where=total > 0)
+
+
+def _corrupt(xs, type_index, true_index, head_mask, rng, max_tries):
+    """Same as `typed_corruptions`, but returns all the corrupted triples
+    and a boolean array that is False on the ones still true"""
+    neg = np.array(xs, dtype=np.int64, copy=True)
+    todo = np.arange(len(neg))
+    for _ in range(max_tries):
+        if len(todo) == 0:
+            break
+        heads = todo[head_mask[todo]]
+        tails = todo[~head_mask[todo]]
+        neg[heads, 0] = type_index.sample_heads(neg[heads, 2], rng)
+        neg[tails, 1] = type_index.sample_tails(neg[tails, 2], rng)
+        todo = todo[true_index.contains(neg[todo])]
+
+    keep = np.ones(len(neg), dtype=bool)
+    keep[todo] = False
+    return neg, keep
+
+
+def typed_corruptions(xs, type_index, true_index, head_mask, rng=np.random,
+                      max_tries=10):
+    """Corrupts the head or the tail of each triple with typed entities
+
+    The entity that replaces the head (or tail) is drawn from the entities
+    that have been seen as head (or tail) of the same relation. Corrupted
+    triples that are known to be true are drawn again, up to ``max_tries``
+    times, and are discarded if they are still true after that.
+
+    :param numpy.ndarray xs: An array with (subject, object, predicate)
+    :param TypeIndex type_index: The domain and range of each relation
+    :param TripleIndex true_index: The triples known to be true
+    :param numpy.ndarray head_mask: True where the head must be corrupted
+    :param numpy.random.RandomState rng: The random generator
+    :param int max_tries: Maximum number of draws for each triple
+    :return: The corrupted triples (maybe less than given)
+    :rtype: numpy.ndarray
+    """
+    neg, keep = _corrupt(xs, type_index, true_index, head_mask, rng,
+                         max_tries)
+    return neg[keep]
+
+
+class TypedSampler(object):
+    """Negative sampler of training triples with typed entities
+
+    The domain and range of every relation (see TypeIndex), the training
+    triples and the head probability of each relation (see
+    `head_probabilities`) are computed once from the training triples. Then
+    every triple of a batch is repeated *ne* times, and its head or its tail
+    is replaced at once by `typed_corruptions`.
+
+    ``sample_batch`` is used by the native trainer. ``sample`` has the
+    interface of the skge samplers.
+    """
+    def __init__(self, ne, xs, sz, max_tries=10):
+        """
+        :param int ne: Number of negative triples for each triple
+        :param list xs: The training triples
+        :param tuple sz: A tuple (N, N, M) with the size of the tensor
+        :param int max_tries: Maximum number of draws for each triple
+        """
+        xs = graph_statistics.triples_array(xs)
+        self.ne = ne
+        self.max_tries = max_tries
+        self.type_index = TypeIndex(xs, sz[2])
+        self.true_index = TripleIndex(xs, sz[0], sz[2])
+        self.head_prob = head_probabilities(xs, sz[0], sz[2])
+
+    def sample_batch(self, xs, rng=np.random):
+        """Returns the positive and negative pairs of a batch
+
+        :param numpy.ndarray xs: The (subject, object, predicate) triples
+        :param numpy.random.RandomState rng: The random generator
+        :return: Two arrays of the same length, the triple and its
+                 corruption
+        :rtype: tuple
+        """
+        pos = np.repeat(xs, self.ne, axis=0)
+        head_mask = rng.random_sample(len(pos)) < self.head_prob[pos[:, 2]]
+        neg, keep = _corrupt(pos, self.type_index, self.true_index,
+                             head_mask, rng, self.max_tries)
+        return pos[keep], neg[keep]
+
+    def sample(self, xys):
+        """Returns the negative triples of some (triple, label) pairs, as
+        the skge samplers do
+
+        :param list xys: The (triple, label) pairs
+        :return: The (triple, -1.0) pairs of the corrupted triples
+        :rtype: list
+        """
+        if len(xys) == 0:
+            return []
+        xs = graph_statistics.triples_array([x for x, _ in xys])
+        _, neg = self.sample_batch(xs)
+        return [(tuple(x), -1.0) for x in neg.tolist()]
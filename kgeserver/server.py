@@ -21,18 +21,70 @@ import sys
 import os
 import kgeserver.dataset as dataset
 import kgeserver.algorithm as algorithm
-import skge
-from annoy import AnnoyIndex
+import functools
+import numpy as np
+import kgeserver.graph_statistics as graph_statistics
+from kgeserver.lazy_import import lazy_import
+
+# Imported when an index is built or loaded
+annoy = lazy_import("annoy")
+
+# Distance used by each model to compare entities
+MODEL_METRICS = {
+    'TransE': 'l1',
+    'HolE': 'dot',
+}
+
+# Scoring functions of each model, used to predict links
+MODEL_EVALUATORS = {
+    'TransE': algorithm.TransEEval,
+    'HolE': algorithm.HolEEval,
+}
+
+# Models scored faster by an engine that keeps precomputed values
+MODEL_ENGINES = {
+    'HolE': algorithm.HolEEngine,
+}
+
+# Maximum number of scores kept in memory while predicting links
+PREDICT_VALUES = 2 ** 23
+
+
+def model_distances(vector, candidates, metric):
+    """Distance from a vector to every candidate, using a model metric
+
+    :param numpy.ndarray vector: The query embedding
+    :param numpy.ndarray candidates: The embeddings of candidates, by rows
+    :param str metric: 'l1', 'l2' or 'dot'. For 'dot' the distance is the
+                       negative dot product, so lower is always better
+    :rtype: numpy.ndarray
+    """
+    if metric == 'l1':
+        return np.abs(candidates - vector).sum(axis=1)
+    elif metric == 'l2':
+        return np.sqrt(((candidates - vector) ** 2).sum(axis=1))
+    elif metric == 'dot':
+        return -candidates.dot(vector)
+    raise ValueError("Unknown metric {}".format(metric))
 
 
 class Server():
     """The server can perform prediction operations
     """
-    def __init__(self, search_index):
+    def __init__(self, search_index, embeddings=None, metric='l1'):
         """Creates a server, given a indexed search tree
 
+        If the embeddings are given, the candidates found on the search
+        index can be sorted again using the distance of the model, which may
+        not be the same used by the index.
+
         :param SearchIndex search_index: A ready search index
+        :param numpy.ndarray embeddings: The embeddings of the entities
+        :param str metric: The distance used by the model. See MODEL_METRICS
         """
+        self.embeddings = embeddings
+        self.metric = metric
+
         if not search_index or search_index.index is None:
             print("The search index has not been generated")
             return None
@@ -42,19 +94,46 @@ class Server():
         else:
             self.index = search_index.index
 
-    def similarity_by_id(self, id, k, search_k=-1):
+    def rerank(self, vector, candidates, k):
+        """Sorts candidates by the distance of the model to a vector
+
+        All candidates are compared at once, with a single vectorized pass.
+
+        :param numpy.ndarray vector: The query embedding
+        :param list candidates: The ids of the candidate entities
+        :param int k: The entities to return
+        :returns: A list of pairs (id, model distance), nearest first
+        :rtype: list
+        """
+        candidates = np.asarray(candidates, dtype=np.int64)
+        distances = model_distances(np.asarray(vector, dtype=np.float64),
+                                    self.embeddings[candidates], self.metric)
+        best = np.argsort(distances, kind='mergesort')[:k]
+        return [(int(candidates[i]), float(distances[i])) for i in best]
+
+    def similarity_by_id(self, id, k, search_k=-1, candidates=1):
         """Given an entity id, return the k'th most similar entities
 
         Returns a list of pairs, where the first item is the entity
         and the second item is the distance to entity.
 
+        With candidates greater than 1, k * candidates entities are taken
+        from the search index and the best k are chosen with the distance of
+        the model. This requires the embeddings of the entities.
+
         :param int id: The entity id
         :param int k: The entities to show
+        :param int search_k: Nodes inspected by the search index
+        :param int candidates: Multiplier of entities taken from the index
         :returns: A list with k id's, which are the most similar entities
         :rtype: list of pairs
         """
         if id is None:
             return None
+        if candidates > 1 and self.embeddings is not None:
+            found = self.index.get_nns_by_item(id, k * candidates,
+                                               search_k=search_k)
+            return self.rerank(self.embeddings[id], found, k)
         sim = self.index.get_nns_by_item(
                 id, k, include_distances=True, search_k=search_k)
         return [(sim[0][i], sim[1][i]) for i in range(0, len(sim[0]))]
@@ -73,14 +152,22 @@ class Server():
 
         return matrix
 
-    def similarity_by_embedding(self, embedd, k, search_k=-1):
+    def similarity_by_embedding(self, embedd, k, search_k=-1, candidates=1):
         """For a given embedding, return most similar id's
 
+        See `similarity_by_id` to learn about candidates param.
+
         :param list embedd: An embedding vector
         :param int k: The similar entities shown for each entity
+        :param int search_k: Nodes inspected by the search index
+        :param int candidates: Multiplier of entities taken from the index
         :returns: A list with k id's, which are the most similar entities
         :rtype: list
         """
+        if candidates > 1 and self.embeddings is not None:
+            found = self.index.get_nns_by_vector(embedd, k * candidates,
+                                                 search_k=search_k)
+            return self.rerank(embedd, found, k)
         sim = self.index.get_nns_by_vector(
                 embedd, k, include_distances=True, search_k=search_k)
         return [(sim[0][i], sim[1][i]) for i in range(0, len(sim[0]))]
@@ -121,10 +208,19 @@ class SearchIndex():
         :param TrainedModel trained_model: The trained model
         :param int depth: The depth desired to generate the search index
         """
-        entities_matrix = trained_model.E
+        self.build_from_embeddings(trained_model.E, depth)
+
+    def build_from_embeddings(self, entities_matrix, depth):
+        """Creates an index from the embeddings of the entities
+
+        :param numpy.ndarray entities_matrix: The embeddings, one entity by
+                                              row. QuantizedEmbeddings are
+                                              also valid
+        :param int depth: The depth desired to generate the search index
+        """
         nrows, emb_size = entities_matrix.shape
 
-        self.index = AnnoyIndex(emb_size)
+        self.index = annoy.AnnoyIndex(emb_size)
 
         # Populate the search index with the trained embedding
         for row in range(0, nrows):
@@ -159,6 +255,144 @@ class SearchIndex():
         :return: If operations had or not errors
         :rtype: boolean
         """
-        self.index = AnnoyIndex(emb_size)
+        self.index = annoy.AnnoyIndex(emb_size)
         self.index.load(filepath)
         self.ready = True
+
+
+class AdjacencyIndex():
+    """Known tails of each (subject, predicate) and heads of each
+    (object, predicate) pair
+
+    Pairs are encoded as the int64 key ``predicate * N + entity`` and stored
+    sorted next to the other entity of the triple, so the known entities of
+    a pair are a contiguous slice found with a binary search.
+    """
+    def __init__(self, true_triples, n_entities):
+        """Builds the index from a list of triples
+
+        :param list true_triples: The (subject, object, predicate) triples
+        :param int n_entities: The number of entities of the dataset
+        """
+        self.n_entities = max(int(n_entities), 1)
+        xs = graph_statistics.triples_array(true_triples)
+        n = self.n_entities
+        self.tail_keys, self.tails = self._group(xs[:, 2] * n + xs[:, 0],
+                                                 xs[:, 1])
+        self.head_keys, self.heads = self._group(xs[:, 2] * n + xs[:, 1],
+                                                 xs[:, 0])
+
+    @staticmethod
+    def _group(keys, values):
+        order = np.argsort(keys, kind='mergesort')
+        return keys[order], values[order]
+
+    @staticmethod
+    def _lookup(keys, values, key):
+        start, end = np.searchsorted(keys, [key, key + 1])
+        return values[start:end]
+
+    def known_tails(self, subject, pred):
+        """Returns the objects of the known triples (subject, ?, pred)"""
+        return self._lookup(self.tail_keys, self.tails,
+                            pred * self.n_entities + subject)
+
+    def known_heads(self, obj, pred):
+        """Returns the subjects of the known triples (?, obj, pred)"""
+        return self._lookup(self.head_keys, self.heads,
+                            pred * self.n_entities + obj)
+
+
+def top_k(scores, k, exclude=None):
+    """Returns the k highest scores of an array, without sorting all of it
+
+    :param numpy.ndarray scores: The score of every entity
+    :param int k: The number of entities returned
+    :param numpy.ndarray exclude: Entities that must not be returned
+    :return: A list of pairs (entity, score), best first
+    :rtype: list
+    """
+    if exclude is not None and len(exclude):
+        scores = scores.copy()
+        scores[exclude] = -np.inf
+        k = min(k, len(scores) - len(np.unique(exclude)))
+    k = min(k, len(scores))
+    if k <= 0:
+        return []
+    best = np.argpartition(-scores, k - 1)[:k]
+    best = best[np.argsort(-scores[best], kind='mergesort')]
+    return [(int(entity), float(scores[entity])) for entity in best]
+
+
+class LinkPredictor():
+    """Completes triples (s, p, ?) and (?, p, o) with a trained model
+
+    Every query scores all the entities at once with the scoring function of
+    the model. See MODEL_EVALUATORS and MODEL_ENGINES
+    """
+    def __init__(self, model, adjacency=None):
+        """Creates a predictor from a trained model
+
+        :param skge.Model model: The trained model (TransE or HolE)
+        :param AdjacencyIndex adjacency: The known triples. Needed to filter
+                                         them from the predictions
+        """
+        model_name = model.__class__.__name__
+        if model_name not in MODEL_EVALUATORS:
+            raise ValueError("Model {} can't predict links".format(model_name))
+        self.model = model
+        self.adjacency = adjacency
+        if model_name in MODEL_ENGINES:
+            self.engine = MODEL_ENGINES[model_name](model)
+            self.scores_o = self.engine.scores_o
+            self.scores_s = self.engine.scores_s
+        else:
+            evaluator = MODEL_EVALUATORS[model_name]
+            self.engine = None
+            self.scores_o = functools.partial(evaluator.batch_scores_o, model)
+            self.scores_s = functools.partial(evaluator.batch_scores_s, model)
+
+    def _predict(self, scores_fn, known_fn, entities, preds, k, filtered):
+        entities = np.asarray(entities, dtype=np.int64)
+        preds = np.asarray(preds, dtype=np.int64)
+        # Queries are scored by chunks to limit the size of score matrices
+        chunk = max(1, PREDICT_VALUES // len(self.model.E))
+        results = []
+        for start in range(0, len(entities), chunk):
+            scores = scores_fn(entities[start:start + chunk],
+                               preds[start:start + chunk])
+            for row, entity, pred in zip(scores, entities[start:],
+                                         preds[start:]):
+                exclude = None
+                if filtered and known_fn is not None:
+                    exclude = known_fn(entity, pred)
+                results.append(top_k(row, k, exclude))
+        return results
+
+    def predict_tails(self, subjects, preds, k=10, filtered=True):
+        """Finds the best objects for a batch of (s, p, ?) queries
+
+        :param list subjects: The subject id of each query
+        :param list preds: The predicate id of each query
+        :param int k: The number of objects returned by query
+        :param bool filtered: Remove the objects of known triples
+        :return: A list with the (entity, score) pairs of each query
+        :rtype: list
+        """
+        known = self.adjacency.known_tails if self.adjacency else None
+        return self._predict(self.scores_o, known,
+                             subjects, preds, k, filtered)
+
+    def predict_heads(self, objects, preds, k=10, filtered=True):
+        """Finds the best subjects for a batch of (?, p, o) queries
+
+        :param list objects: The object id of each query
+        :param list preds: The predicate id of each query
+        :param int k: The number of subjects returned by query
+        :param bool filtered: Remove the subjects of known triples
+        :return: A list with the (entity, score) pairs of each query
+        :rtype: list
+        """
+        known = self.adjacency.known_heads if self.adjacency else None
+        return self._predict(self.scores_s, known,
+                             objects, preds, k, filtered)
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# vocabulary.py: Compact and memory mapped storage of entity URIs
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+import tempfile
+import numpy as np
+
+# First bytes of a vocabulary file
+MAGIC = b"KGEVOCAB"
+# Arrays inside the file start on multiples of this value
+ALIGNMENT = 64
+
+
+def vocabulary_path(dataset_path):
+    """Path of the vocabulary of a binary dataset
+
+    :param str dataset_path: The path of the binary dataset
+    :rtype: str
+    """
+    return dataset_path[:-4] + "_vocab.bin"
+
+
+def split_uri(uri):
+    """Splits an URI into its namespace and its local name
+
+    The namespace ends with the last '/' or '#' of the URI.
+
+    :param str uri: The URI
+    :return: The namespace and the local name
+    :rtype: tuple
+    """
+    cut = max(uri.rfind("/"), uri.rfind("#")) + 1
+    return uri[:cut], uri[cut:]
+
+
+def uri_hash(uri):
+    """Returns a 64 bits hash of an URI, stable between processes"""
+    return int.from_bytes(hashlib.md5(uri.encode("utf-8")).digest()[:8],
+                          "little")
+
+
+def _hashes(uris):
+    """Returns the uri_hash of many URIs as an uint64 array"""
+    digests = b"".join(hashlib.md5(uri.encode("utf-8")).digest()[:8]
+                       for uri in uris)
+    return np.frombuffer(digests, dtype='<u8')
+
+
+def _ranges_differ(first, first_starts, second, second_starts, lengths):
+    """Compares many ranges of two byte arrays at once
+
+    :param numpy.ndarray first: The first array
+    :param numpy.ndarray first_starts: Where each range starts on first
+    :param numpy.ndarray second: The second array
+    :param numpy.ndarray second_starts: Where each range starts on second
+    :param numpy.ndarray lengths: The length of each range
+    :return: True for the ranges with different bytes
+    :rtype: numpy.ndarray
+    """
+    # Position of every byte of the ranges, as if they were contiguous
+    ends = np.cumsum(lengths)
+    total = int(ends[-1]) if len(ends) else 0
+    shift = ends - lengths
+    index_type = np.int32 if max(total, len(first), len(second)) < 2 ** 31 \
+        else np.int64
+    flat = np.arange(total, dtype=index_type)
+    differ = first[flat + np.repeat((first_starts - shift)
+                                    .astype(index_type), lengths)] != \
+        second[flat + np.repeat((second_starts - shift)
+                                .astype(index_type), lengths)]
+    result = np.zeros(len(lengths), dtype=bool)
+    result[np.searchsorted(ends, np.flatnonzero(differ), side='right')] = True
+    return result
+
+
+class Vocabulary():
+    """A list of URIs stored on a few contiguous arrays
+
+    Each URI is split into a namespace, stored once, and a local name. The
+    local names are stored one after the other on a single bytes buffer,
+    with the offset where each one starts:
+
+    * *ns*: The namespace id of each URI
+    * *offsets*: Where each local name starts, and where the last one ends
+    * *names*: The UTF-8 bytes of all local names
+
+    URIs are found with a sorted array of their 64 bits hashes (*keys*),
+    and the id of each hash (*key_ids*). A whole batch of URIs is found with
+    a single binary search.
+
+    With *local_lookup*, an URI is also found by its local name on any
+    namespace, as datasets that only store local names (such as Wikidata
+    ids) do.
+    """
+    def __init__(self, namespaces, ns, offsets, names, keys, key_ids,
+                 local_lookup=False):
+        self.namespaces = namespaces
+        self.local_lookup = local_lookup
+        self.ns = ns
+        self.offsets = offsets
+        self.names = names
+        self.keys = keys
+        self.key_ids = key_ids
+        # Bytes of the namespaces, built on the first batch lookup
+        self._namespace_bytes = None
+
+    @classmethod
+    def build(cls, uris, local_lookup=False):
+        """Creates the vocabulary of a list of URIs
+
+        :param list uris: The URIs. Its position on the list is its id
+        :param bool local_lookup: Find URIs by their local name too
+        :rtype: Vocabulary
+        """
+        namespaces, ns_ids = [], {}
+        ns = np.empty(len(uris), dtype=np.uint32)
+        lengths = np.empty(len(uris), dtype=np.int64)
+        local_names = []
+        for i, uri in enumerate(uris):
+            namespace, local = split_uri(uri)
+            if namespace not in ns_ids:
+                ns_ids[namespace] = len(namespaces)
+                namespaces.append(namespace)
+            ns[i] = ns_ids[namespace]
+            local = local.encode("utf-8")
+            lengths[i] = len(local)
+            local_names.append(local)
+        if len(namespaces) <= 2 ** 16:
+            ns = ns.astype(np.uint16)
+
+        offsets = np.zeros(len(uris) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        names = np.frombuffer(b"".join(local_names), dtype=np.uint8)
+        if len(names) < 2 ** 32:
+            offsets = offsets.astype(np.uint32)
+
+        hashes = _hashes(uris)
+        order = np.argsort(hashes, kind='mergesort')
+        return cls(namespaces, ns, offsets, names, hashes[order],
+                   order.astype(np.int32 if len(uris) < 2 ** 31
+                                else np.int64), local_lookup)
+
+    def __len__(self):
+        return len(self.ns)
+
+    def nbytes(self):
+        """Memory used by the arrays of the vocabulary"""
+        return sum(array.nbytes for array in (self.ns, self.offsets,
+                                              self.names, self.keys,
+                                              self.key_ids))
+
+    def get(self, id):
+        """Returns the URI of an id, or None if it does not exist
+
+        :param int id: The id
+        :rtype: str
+        """
+        if id < 0 or id >= len(self.ns):
+            return None
+        name = self.names[self.offsets[id]:self.offsets[id + 1]]
+        return self.namespaces[self.ns[id]] + name.tobytes().decode("utf-8")
+
+    def _find(self, uri, key):
+        pos = int(np.searchsorted(self.keys, key))
+        # Hashes may collide, so the URI of every candidate is checked
+        while pos < len(self.keys) and self.keys[pos] == key:
+            if self.get(int(self.key_ids[pos])) == uri:
+                return int(self.key_ids[pos])
+            pos += 1
+        return -1
+
+    def get_id(self, uri):
+        """Returns the id of an URI, or -1 if it does not exist
+
+        A local name without namespace (such as ``Q42``) is looked for on
+        every namespace.
+
+        :param str uri: The URI
+        :rtype: int
+        """
+        id = self._find(uri, np.uint64(uri_hash(uri)))
+        namespace, local = split_uri(uri)
+        if id < 0 and local and (namespace == "" or self.local_lookup):
+            for namespace in self.namespaces:
+                id = self._find(namespace + local,
+                                np.uint64(uri_hash(namespace + local)))
+                if id >= 0:
+                    break
+        return id
+
+    def get_ids(self, uris):
+        """Returns the ids of many URIs at once
+
+        :param list uris: The URIs
+        :return: The id of each URI, or -1 if it does not exist
+        :rtype: numpy.ndarray
+        """
+        uris = list(uris)
+        ids = np.full(len(uris), -1, dtype=np.int64)
+        if len(uris) == 0 or len(self.keys) == 0:
+            return ids
+        hashes = _hashes(uris)
+        pos = np.searchsorted(self.keys, hashes)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == hashes[found]
+        ids[found] = self.key_ids[pos[found]]
+        # Hashes may collide, and some URIs are found by their local name,
+        # so the ones not verified are looked for one by one
+        for i in np.flatnonzero(~self._verify(uris, ids)):
+            ids[i] = self.get_id(uris[i])
+        return ids
+
+    def _verify(self, uris, ids):
+        """Checks that the URIs are the ones of their ids, all at once
+
+        The URIs are encoded together, and their bytes are compared with
+        the namespace and the local name of their ids, without decoding
+        any URI of the vocabulary.
+
+        :param list uris: The URIs
+        :param numpy.ndarray ids: The id found for each URI, or -1
+        :return: True for the URIs that have the right id
+        :rtype: numpy.ndarray
+        """
+        if self._namespace_bytes is None:
+            encoded = [namespace.encode("utf-8")
+                       for namespace in self.namespaces]
+            ns_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(namespace) for namespace in encoded],
+                      out=ns_offsets[1:])
+            self._namespace_bytes = (
+                np.frombuffer(b"".join(encoded), dtype=np.uint8), ns_offsets)
+        ns_names, ns_offsets = self._namespace_bytes
+
+        # Each URI ends with a NUL byte, which UTF-8 only uses for NUL
+        query = np.frombuffer(("\0".join(uris) + "\0").encode("utf-8"),
+                              dtype=np.uint8)
+        ends = np.flatnonzero(query == 0)
+        if len(ends) != len(uris):
+            return np.zeros(len(uris), dtype=bool)
+        query_starts = np.concatenate(([0], ends[:-1] + 1))
+
+        valid = ids >= 0
+        candidates = np.where(valid, ids, 0)
+        ns = self.ns[candidates].astype(np.int64)
+        ns_starts = ns_offsets[ns]
+        ns_lengths = ns_offsets[ns + 1] - ns_starts
+        starts = self.offsets[candidates].astype(np.int64)
+        lengths = self.offsets[candidates + 1] - starts
+        valid &= ns_lengths + lengths == ends - query_starts
+
+        rows = np.flatnonzero(valid)
+        query_starts = query_starts[rows]
+        differ = _ranges_differ(ns_names, ns_starts[rows], query,
+                                query_starts, ns_lengths[rows])
+        differ |= _ranges_differ(self.names, starts[rows], query,
+                                 query_starts + ns_lengths[rows],
+                                 lengths[rows])
+        valid[rows[differ]] = False
+        return valid
+
+    def arrays(self):
+        """Returns the arrays of the vocabulary, by name"""
+        return {'ns': self.ns, 'offsets': self.offsets, 'names': self.names,
+                'keys': self.keys, 'key_ids': self.key_ids}
+
+
+def write_arrays(filepath, meta, arrays):
+    """Writes arrays on a file that can be memory mapped
+
+    The file starts with MAGIC, the length of a JSON header and the header,
+    which contains *meta* and the dtype, shape and position of each array.
+    It is written on a temporary file of its own, renamed when complete, so
+    processes writing the same file at once never mix their writes.
+    """
+    entries, position = {}, 0
+    for name, array in sorted(arrays.items()):
+        entries[name] = [array.dtype.str, list(array.shape), position]
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({'meta': meta, 'arrays': entries}).encode("utf-8")
+    start = len(MAGIC) + 8 + len(header)
+    start = -(-start // ALIGNMENT) * ALIGNMENT
+
+    directory = os.path.dirname(os.path.abspath(filepath))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp",
+                                    prefix=os.path.basename(filepath) + ".")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(MAGIC)
+            out.write(struct.pack("<Q", len(header)))
+            out.write(header)
+            for name, array in sorted(arrays.items()):
+                out.seek(start + entries[name][2])
+                out.write(np.ascontiguousarray(array).tobytes())
+            out.truncate(start + position)
+            out.flush()
+            os.fsync(out.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_arrays(filepath):
+    """Maps on memory the arrays of a file written with write_arrays
+
+    :return: The meta dict and the read only arrays, by name
+    :rtype: tuple
+    """
+    with open(filepath, "rb") as vocab_file:
+        if vocab_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a vocabulary file".format(filepath))
+        header_len = struct.unpack("<Q", vocab_file.read(8))[0]
+        header = json.loads(vocab_file.read(header_len).decode("utf-8"))
+        buf = mmap.mmap(vocab_file.fileno(), 0, access=mmap.ACCESS_READ)
+    start = len(MAGIC) + 8 + header_len
+    start = -(-start // ALIGNMENT) * ALIGNMENT
+    arrays = {}
+    for name, (dtype, shape, position) in header['arrays'].items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(buf, dtype=dtype, count=count,
+                                     offset=start + position).reshape(shape)
+    return header['meta'], arrays
+
+
+class DatasetVocabulary():
+    """The entities and relations of a dataset, as compact vocabularies
+
+    It has the same methods a Dataset uses to translate URIs and ids, so it
+    can replace the whole dataset where only these are needed. Unknown
+    elements return None.
+    """
+    def __init__(self, entities, relations):
+        self.entities = entities
+        self.relations = relations
+
+    @classmethod
+    def from_dataset(cls, dtset):
+        """Builds the vocabularies with the URIs returned by a dataset
+
+        :param kgeserver.dataset.Dataset dtset: The dataset
+        :rtype: DatasetVocabulary
+        """
+        # Datasets with a base URI only store, and check, local names
+        local_lookup = hasattr(dtset, 'entity_base')
+        return cls(
+            Vocabulary.build([dtset.get_entity(i)
+                              for i in range(len(dtset.entities))],
+                             local_lookup),
+            Vocabulary.build([dtset.get_relation(i)
+                              for i in range(len(dtset.relations))],
+                             local_lookup))
+
+    def save(self, filepath):
+        """Saves both vocabularies on a single file
+
+        :param str filepath: The path of the file
+        """
+        arrays, meta = {}, {}
+        for kind, vocab in (('entities', self.entities),
+                            ('relations', self.relations)):
+            meta[kind] = {'namespaces': vocab.namespaces,
+                          'local_lookup': vocab.local_lookup}
+            for name, array in vocab.arrays().items():
+                arrays[kind + "." + name] = array
+        write_arrays(filepath, meta, arrays)
+
+    @classmethod
+    def load(cls, filepath):
+        """Maps a vocabulary file on memory
+
+        :param str filepath: The path of the file
+        :rtype: DatasetVocabulary
+        """
+        meta, arrays = read_arrays(filepath)
+        vocabs = []
+        for kind in ('entities', 'relations'):
+            names = ('ns', 'offsets', 'names', 'keys', 'key_ids')
+            vocabs.append(Vocabulary(
+                meta[kind]['namespaces'],
+                *[arrays[kind + "." + name] for name in names],
+                local_lookup=meta[kind]['local_lookup']))
+        return cls(*vocabs)
+
+    def get_entity(self, id):
+        """Gets the entity URI given an id, or None"""
+        return self.entities.get(id)
+
+    def get_entity_id(self, entity):
+        """Gets the id given an entity URI, or None"""
+        id = self.entities.get_id(entity)
+        return id if id >= 0 else None
+
+    def get_entity_ids(self, entities):
+        """Gets the ids of many entities. Unknown entities get -1
+
+        :rtype: numpy.ndarray
+        """
+        return self.entities.get_ids(entities)
+
+    def get_relation(self, id):
+        """Gets the relation URI given an id, or None"""
+        return self.relations.get(id)
+
+    def get_relation_id(self, relation):
+        """Gets the id given a relation URI, or None"""
+        id = self.relations.get_id(relation)
+        return id if id >= 0 else None
@@ -19,14 +19,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import absolute_import, unicode_literals
 import os
+import glob
+import shutil
 import multiprocessing
 from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from .celery import app
+from celery import chord, group
 import time
 import json
-import skge
+import timeit
+import threading
+import contextlib
 import kgeserver.dataset as dataset
+import kgeserver.crawl_log as crawl_log
 import kgeserver.algorithm as algorithm
+import kgeserver.dataset_split as dataset_split
+import kgeserver.delta_log as delta_log
+import kgeserver.native_trainer as native_trainer
+import kgeserver.quantization as quantization
+import kgeserver.neighbour_table as neighbour_table
+import kgeserver.vocabulary as vocabulary
+import kgeserver.autocomplete as autocomplete
+import kgeserver.graph_statistics as graph_statistics
 import kgeserver.server as server
 
 # Import parent directory (data_access)
@@ -38,7 +54,70 @@ except ImportError:
     raise
 
 
-@app.task(bind=True)
+def _CONFIG_get_checkpoint_epochs():
+    """Epochs between two checkpoints of a training task"""
+    try:
+        return int(os.environ["CHECKPOINT_EPOCHS"])
+    except (KeyError, ValueError):
+        return 10
+
+
+def _CONFIG_get_checkpoint_minutes():
+    """Minutes between two checkpoints of a training task"""
+    try:
+        return float(os.environ["CHECKPOINT_MINUTES"])
+    except (KeyError, ValueError):
+        return 15.0
+
+
+def _CONFIG_get_train_workers():
+    """Processes that train a model at once. 0 uses all the cores"""
+    try:
+        return int(os.environ["TRAIN_WORKERS"])
+    except (KeyError, ValueError):
+        return 1
+
+
+def _CONFIG_get_train_sampler():
+    """Sampler of negative triples: random-mode, lcwa or corrupted"""
+    sampler = os.environ.get("TRAIN_SAMPLER", "random-mode")
+    if sampler not in ("random-mode", "lcwa", "corrupted"):
+        return "random-mode"
+    return sampler
+
+
+def _CONFIG_get_native_trainer():
+    """True to train models with kgeserver.native_trainer instead of skge"""
+    return os.environ.get("TRAINER", "skge") == "native"
+
+
+# The workers serving the embeddings read the same setting
+_CONFIG_get_embeddings_dtype = \
+    data_access.dataset_dao._CONFIG_get_embeddings_dtype
+
+
+def _CONFIG_get_knn_table_size():
+    """Neighbours precomputed for each entity after indexing. 0 disables it
+
+    The entity itself is stored too, so the table answers similar_entities
+    requests with a limit lower than this number.
+    """
+    try:
+        return int(os.environ["KNN_TABLE_SIZE"])
+    except (KeyError, ValueError):
+        return 51
+
+
+def _CONFIG_get_knn_table_entities():
+    """Entities with more triples stored on the table. 0 stores all of them
+    """
+    try:
+        return int(os.environ["KNN_TABLE_ENTITIES"])
+    except (KeyError, ValueError):
+        return 100000
+
+
+@app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
 def generate_dataset_from_sparql(self, dataset_id, graph_pattern, levels,
                                  **keyw_args):
     """Creates a recurrent dataset from a seed vector
@@ -47,6 +126,10 @@ def generate_dataset_from_sparql(self, dataset_id, graph_pattern, levels,
     be executed in foreground. The status of the generation can be queried
     through it's celery UUID.
 
+    Every entity scanned is saved on a crawl log next to the dataset. If the
+    worker dies, the task is sent again to the queue and the crawl continues
+    where it stopped, without querying again the entities already scanned.
+
     :param levels: The number of levels to scan
     :param dataset_path: The path to dataset file
     :param graph_pattern: The main query containing triples
@@ -84,21 +167,13 @@ def generate_dataset_from_sparql(self, dataset_id, graph_pattern, levels,
         progress.total = max_iter
         progres_dao.set_progress(celery_uuid, progress)
 
-    sv_kwargs = {}
-    sv_kwargs['where'] = graph_pattern
-    sv_kwargs['callback'] = lambda: progres_dao.add_progress(celery_uuid)
-    sv_kwargs['start_callback'] = init_progress_callback
-
     # Batch limit has to be an integer
     try:
-        sv_kwargs['batch_size'] = int(keyw_args.pop('batch_size'))
+        keyw_args['batch_size'] = int(keyw_args.pop('batch_size'))
     except (LookupError, ValueError, TypeError):
-        pass
+        keyw_args.pop('batch_size', None)
 
-    # Get the seed vector and load first entities
-    seed_vector = dtset.load_from_graph_pattern(**sv_kwargs)
-
-    celery_uuid = "celery-task-progress-"+self.request.id
+    progress_key = "celery-task-progress-"+self.request.id
 
     def status_callback(status):
         """Saves the progress of the task on redis db"""
@@ -110,7 +185,7 @@ def generate_dataset_from_sparql(self, dataset_id, graph_pattern, levels,
                     }
 
         # Retrieve task from redis
-        task = redis.get(celery_uuid).decode("utf-8")
+        task = redis.get(progress_key).decode("utf-8")
         task = json.loads(task)
 
         # Add task progress
@@ -118,17 +193,15 @@ def generate_dataset_from_sparql(self, dataset_id, graph_pattern, levels,
 
         # Save again on redis
         task = json.dumps(task).encode("utf-8")
-        redis.set(celery_uuid, task)
+        redis.set(progress_key, task)
         return
 
-    # Build the optional args dict
-    keyw_args["ext_callback"] = status_callback
-
     # Call to the *heavy* method
-    dtset.load_dataset_recurrently(levels, seed_vector, **keyw_args)
-
-    # Save new binary
-    dtset.save_to_binary(dataset_path)
+    crawl_dataset(dtset, dataset_path, graph_pattern, levels,
+                  seed_start_callback=init_progress_callback,
+                  seed_callback=lambda: progres_dao.add_progress(
+                      celery_uuid),
+                  status_callback=status_callback, **keyw_args)
 
     # Restore status
     dataset_dao.set_status(dataset_id, 0)
@@ -136,11 +209,65 @@ def generate_dataset_from_sparql(self, dataset_id, graph_pattern, levels,
     return False
 
 
-@app.task(bind=True)
+def crawl_dataset(dtset, dataset_path, graph_pattern, levels,
+                  batch_size=None, seed_start_callback=None,
+                  seed_callback=None, status_callback=None, **keyw_args):
+    """Loads the triples of a graph pattern and their neighbours on a dataset
+
+    Every entity scanned is saved on a crawl log next to the dataset, so a
+    crawl that was interrupted continues where it stopped. The dataset is
+    saved when the crawl finishes, and then the log is removed.
+
+    :param kgeserver.dataset.Dataset dtset: The dataset, already loaded
+    :param str dataset_path: The path of the binary dataset
+    :param str graph_pattern: The main query containing triples
+    :param int levels: The number of levels to scan
+    :param int batch_size: The size of the batches of the seed query
+    :param function seed_start_callback: Receives the number of batches of
+                                         the seed query
+    :param function seed_callback: Called after each batch of the seed query
+    :param function status_callback: Receives the status of the crawl on
+                                     each level
+    :kwparam limit_ent: Use only for testing purposes
+    """
+    sv_kwargs = {'where': graph_pattern}
+    if batch_size is not None:
+        sv_kwargs['batch_size'] = batch_size
+    if seed_callback is not None:
+        sv_kwargs['callback'] = seed_callback
+    if seed_start_callback is not None:
+        sv_kwargs['start_callback'] = seed_start_callback
+
+    # The log is only valid for the same crawl
+    signature = {'graph_pattern': graph_pattern, 'levels': levels,
+                 'limit_ent': keyw_args.get('limit_ent')}
+    log = crawl_log.CrawlLog(crawl_log.log_path(dataset_path), signature)
+
+    # Get the seed vector and load first entities, unless they were saved
+    seed_vector = log.load_seed(dtset)
+    if seed_vector is None:
+        seed_vector = dtset.load_from_graph_pattern(**sv_kwargs)
+        log.save_seed(dtset, seed_vector)
+
+    if status_callback is not None:
+        keyw_args["ext_callback"] = status_callback
+    keyw_args["crawl_log"] = log
+    dtset.load_dataset_recurrently(levels, seed_vector, **keyw_args)
+
+    # Save new binary. The crawl log is not needed anymore
+    dtset.save_to_binary(dataset_path)
+    data_access.DatasetDAO().build_dataset_files(dataset_path, dtset)
+    log.clear()
+
+
+@app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
 def train_dataset_from_algorithm(self, dataset_id, algorithm_dict):
     """Trains a dataset given an algorithm
 
-    It is able to save the progress of training.
+    It is able to save the progress of training. The state of the training is
+    saved periodically on a checkpoint, and the task is sent again to the
+    queue if the worker dies, so the training continues from the last
+    checkpoint instead of starting again.
     :param str dataset_path: The path where binary dataset is located
     :param dict algorithm: An algorithm to be used in dataset training
     """
@@ -169,7 +296,7 @@ def train_dataset_from_algorithm(self, dataset_id, algorithm_dict):
                 "total_steps": None}
     redis.set(celery_uuid, json.dumps({"progress": progress}).encode("utf-8"))
 
-    def status_callback(trainer):
+    def status_callback(trainer, telemetry):
         """Saves the progress of the task on redis db"""
         print("Status Callback. Trainer {}".format(trainer.epoch))
         # Retrieve task from redis
@@ -178,34 +305,120 @@ def train_dataset_from_algorithm(self, dataset_id, algorithm_dict):
 
         # Add task progress
         task['progress']['current'] = trainer.epoch
+        # Add the time series with the information of each epoch
+        task['telemetry'] = telemetry.to_dict()
 
         # Save again on redis
         task = json.dumps(task).encode("utf-8")
         redis.set(celery_uuid, task)
         return
 
+    # Heavy task
+    model_path, embeddings, report = train_model(
+        dtset, dtset_path, algorithm_dict, status_callback)
+    task = json.loads(redis.get(celery_uuid).decode("utf-8"))
+    task['quantization'] = report
+    redis.set(celery_uuid, json.dumps(task).encode("utf-8"))
+
+    # Update values on DB when model training has finished
+    dataset_dao.set_status(dataset_id, 1)
+    dataset_dao.set_model(dataset_id, model_path)
+
+    return False
+
+
+def train_model(dtset, dtset_path, algorithm_dict, status_callback=None):
+    """Trains a model of a dataset and saves it next to the dataset
+
+    The state of the training is saved periodically on a checkpoint, so the
+    training continues from it if it is interrupted. The checkpoint is
+    removed when the model is saved.
+
+    :param kgeserver.dataset.Dataset dtset: The dataset, already loaded
+    :param str dtset_path: The path of the binary dataset
+    :param dict algorithm_dict: The algorithm used to train the dataset
+    :param function status_callback: Receives the trainer and the telemetry
+                                     of the training after each epoch
+    :return: The path of the model, the embeddings served and the recall
+             report of their quantization
+    :rtype: tuple
+    """
+    if status_callback is None:
+        def status_callback(trainer, telemetry):
+            pass
+
+    # One checkpoint for each dataset and algorithm
+    checkpoint_path = dtset_path[:-4] + "_checkpoint_{}.bin".format(
+        algorithm_dict["id"])
+
+    # Algorithms without model (created before it existed) use TransE
+    native = _CONFIG_get_native_trainer()
+    model_type, eval_type = algorithm.get_model_types(
+        algorithm_dict.get('model') or 'TransE', native=native)
+
     # Creates an optional parameters dict for better readability
     kwargs = {
         'train_all': True,  # All dataset will be trained, not validated
         'test_all': -1,  # No validation is going to be performed
-        'model_type': skge.TransE,  # The default model will be used
+        'model_type': model_type,  # Provided by the algorithm
+        'trainer_type': native_trainer.PairwiseTrainer if native else None,
+        'eval_type': eval_type,  # Used only if validation is performed
         'ncomp': algorithm_dict['embedding_size'],  # Provided by the algorithm
         'margin': algorithm_dict['margin'],  # Provided by the algorithm
         'max_epochs': algorithm_dict['max_epochs'],  # Max number of iterations
-        'external_callback': status_callback,  # The status callback
+        # The status callback
+        'external_callback': lambda trn: status_callback(
+            trn, model.telemetry),
+        # Saves the training state to continue it if the worker dies
+        'checkpoint_path': checkpoint_path,
+        'checkpoint_epochs': _CONFIG_get_checkpoint_epochs(),
+        'checkpoint_minutes': _CONFIG_get_checkpoint_minutes(),
+        # Trains on several processes over shared parameters
+        'workers': _CONFIG_get_train_workers(),
+        # Negative triples of the same type converge sooner
+        'sampler': _CONFIG_get_train_sampler(),
     }
 
-    # Heavy task
     model = algorithm.ModelTrainer(dtset, **kwargs)
     modeloentrenado = model.run()
     model_path = dtset_path[:-4] + "_model.bin"
-    modeloentrenado.save(model_path)
+    model.save_trained_model(model_path, modeloentrenado)
+    # Smaller copy of the embeddings used to serve queries
+    quantized_file, report = quantization.quantize_model(
+        modeloentrenado, model_path, _CONFIG_get_embeddings_dtype())
+    print("Quantized embeddings saved on {}: recall@{} = {:.4f}, {:.1f}x "
+          "smaller".format(quantized_file, report['k'], report['recall'],
+                           report['compression']))
+    # The model is safe on disk, the checkpoint is not needed anymore
+    try:
+        os.remove(checkpoint_path)
+    except OSError:
+        pass
 
-    # Update values on DB when model training has finished
-    dataset_dao.set_status(dataset_id, 1)
-    dataset_dao.set_model(dataset_id, model_path)
+    return model_path, quantization.QuantizedEmbeddings.load(
+        quantized_file), report
 
-    return False
+
+@app.task(acks_late=True, reject_on_worker_lost=True)
+def compact_triples(dataset_id):
+    """Updates a dataset with the triples inserted on its delta log
+
+    The log is merged on the binary dataset while it is over the limit, and
+    the vocabulary, the split file and the statistics are built again if any
+    triple was merged, so the requests never load the dataset. The inserts
+    made while the task runs go to a new log. If other task replaces the
+    binary dataset meanwhile, the log is kept, and is merged by the next
+    compaction.
+
+    :param int dataset_id: The dataset ID
+    :return: The number of triples merged
+    :rtype: int
+    """
+    dataset_dao = data_access.DatasetDAO()
+    merged, err = dataset_dao.compact_triples(dataset_id)
+    if err is not None:
+        raise OSError(str(err))
+    return merged
 
 
 @app.task(bind=True)
@@ -218,6 +431,7 @@ def insert_triples_from_graph_pattern(self, dataset_path, graph_pattern):
     dtset.load_from_graph_pattern(verbose=2, where=graph_pattern)
     # dt.show()
     dtset.save_to_binary(dataset_path)
+    data_access.DatasetDAO().build_dataset_files(dataset_path, dtset)
 
     # TODO Update values on dataset db
 
@@ -253,8 +467,26 @@ def build_autocomplete_index(self, dataset_id, langs=['en', 'es']):
     progres_dao.create_progress(celery_uuid, len(dtset.entities))
     progres_dao.update_progress(celery_uuid, 0)
 
-    entity_dao = data_access.EntityDAO(dataset_dto.dataset_type, dataset_id)
+    entity_dao = data_access.get_entity_dao(dataset_dto.dataset_type,
+                                            dataset_id)
 
+    index_entity_labels(dtset, entity_dao, langs,
+                        lambda: progres_dao.add_progress(celery_uuid))
+
+    # Update status on DB when finished
+    dataset_dao.set_status(dataset_id, 2)
+
+    return False
+
+
+def index_entity_labels(dtset, entity_dao, langs, callback=None):
+    """Stores the labels of all the entities of a dataset on the search index
+
+    :param kgeserver.dataset.Dataset dtset: The dataset, already loaded
+    :param EntityDAO entity_dao: The DAO of the autocomplete index
+    :param list langs: A list of languages in ISO 639-1 format
+    :param function callback: Called after each entity
+    """
     def get_labels(entity):
         """Auxiliar method to wrap dtset.entity_labels.
 
@@ -265,7 +497,8 @@ def build_autocomplete_index(self, dataset_id, langs=['en', 'es']):
                                                                langs=langs)
 
         # track progress: add one more step
-        progres_dao.add_progress(celery_uuid)
+        if callback is not None:
+            callback()
 
         # Create the doc to be stored on elasticsearch and insert it
         entity_doc = {"entity": entity,
@@ -276,12 +509,11 @@ def build_autocomplete_index(self, dataset_id, langs=['en', 'es']):
 
     # Execute get_labels concurrently, using as many processes as cpu cores
     with ThreadPool(multiprocessing.cpu_count()) as p:
-        all_labels = p.map(get_labels, dtset.entities)
+        p.map(get_labels, dtset.entities)
 
-    # Update status on DB when finished
-    dataset_dao.set_status(dataset_id, 2)
-
-    return False
+    # Entities with more triples are suggested first by the embedded backend
+    degrees = graph_statistics.entity_degrees(dtset.subs, len(dtset.entities))
+    entity_dao.save_index(dict(zip(dtset.entities, degrees.tolist())))
 
 
 @app.task(bind=True)
@@ -298,34 +530,450 @@ def build_search_index(self, dataset_id, n_trees):
     # Creates the progress object in redis
     celery_uuid = self.request.id
     progres_dao = data_access.ProgressDAO()
-    progres_dao.create_progress(celery_uuid, 3)
+    progres_dao.create_progress(celery_uuid, 4)
     progres_dao.update_progress(celery_uuid, 0)
 
     dataset_dao = data_access.DatasetDAO()
     # Set working status
     dataset_dao.set_status(dataset_id, -2)
     model_path, err = dataset_dao.get_model(dataset_id)
-    # Load the model and initialize the search index
-    model = skge.TransE.load(model_path)
+
+    # Execute heavy task and track the progress
+    search_index_file = build_index(
+        dataset_id, model_path, n_trees,
+        callback=lambda step: progres_dao.update_progress(celery_uuid, step))
+
+    # Update values on DB
+    dataset_dao.set_status(dataset_id, 2)
+    dataset_dao.set_search_index(dataset_id, search_index_file)
+
+    return False
+
+
+def build_index(dataset_id, model_path, n_trees, embeddings=None, dtset=None,
+                callback=None):
+    """Builds the search index of a model and its neighbour table
+
+    :param int dataset_id: The id of the dataset
+    :param str model_path: The path of the trained model
+    :param int n_trees: The number of trees to be generated
+    :param embeddings: The embeddings of the entities. They are loaded from
+                       the model if not given
+    :param kgeserver.dataset.Dataset dtset: The dataset, if it is loaded
+    :param function callback: Receives the number of steps done, out of 4
+    :return: The path of the search index
+    :rtype: str
+    """
+    if callback is None:
+        def callback(step):
+            pass
+
+    # Load the embeddings and initialize the search index
+    if embeddings is None:
+        embeddings = quantization.load_embeddings(
+            model_path, algorithm.load_model, _CONFIG_get_embeddings_dtype())
     search_index = server.SearchIndex()
 
     # File to store the search index
     search_index_file = model_path[:-4] + "_annoy_{}.bin".format(n_trees)
 
-    # Execute heavy task and track the progress
-    progres_dao.update_progress(celery_uuid, 1)
-    search_index.build_from_trained_model(model, n_trees)
-    progres_dao.update_progress(celery_uuid, 2)
+    callback(1)
+    search_index.build_from_embeddings(embeddings, n_trees)
+    callback(2)
     search_index.save_to_binary(search_index_file)
-    progres_dao.update_progress(celery_uuid, 3)
+    callback(3)
+
+    # The neighbours of the last index are not valid anymore
+    build_neighbour_table(dataset_id, embeddings, search_index_file, dtset)
+    callback(4)
+    return search_index_file
 
-    # Update values on DB
-    dataset_dao.set_status(dataset_id, 2)
-    dataset_dao.set_search_index(dataset_id, search_index_file)
+
+def build_neighbour_table(dataset_id, embeddings, search_index_file,
+                          dtset=None):
+    """Precomputes the nearest neighbours of the most connected entities
+
+    The table is saved next to the search index, and is built again every
+    time the index is built. See KNN_TABLE_SIZE and KNN_TABLE_ENTITIES
+
+    :param int dataset_id: The id of the dataset
+    :param numpy.ndarray embeddings: The embeddings of the entities
+    :param str search_index_file: The path of the search index
+    :param kgeserver.dataset.Dataset dtset: The dataset, if it is loaded
+    """
+    prefix = search_index_file[:-4] + "_knn"
+    k = _CONFIG_get_knn_table_size()
+    if k <= 0:
+        neighbour_table.NeighbourTable.remove(prefix)
+        return
+
+    entities = None
+    n_entities = _CONFIG_get_knn_table_entities()
+    if 0 < n_entities < len(embeddings):
+        if dtset is None:
+            dataset_path, err = data_access.DatasetDAO().get_binary_path(
+                dataset_id)
+            dtset = dataset.Dataset()
+            dtset.load_from_binary(dataset_path)
+        entities = neighbour_table.top_entities_by_degree(
+            dtset.subs, len(embeddings), n_entities)
+
+    neighbour_table.NeighbourTable.build(embeddings, prefix, k, entities)
+
+
+class PipelineProgress():
+    """The progress of all the stages of a pipeline, saved on redis
+
+    The ``progress`` key has the same fields as the progress of the other
+    tasks: the percentage done of the whole pipeline, and the stages
+    finished. The ``stages`` key has the state, progress and duration of
+    each stage. Stages may run concurrently, and the progress is saved at
+    most once every SAVE_INTERVAL seconds, unless a stage starts or ends.
+    """
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, celery_uuid, stages, backend=None):
+        self.redis = backend or data_access.get_redis_backend()
+        self.key = "celery-task-progress-{}".format(celery_uuid)
+        self.stages = OrderedDict(
+            (name, {"state": "PENDING", "current": 0, "total": None,
+                    "seconds": None}) for name in stages)
+        self.extra = {}
+        self._lock = threading.Lock()
+        self._saved = 0
+        with self._lock:
+            self._save(force=True)
+
+    def to_dict(self):
+        """Returns the progress as stored on redis
+
+        :rtype: dict
+        """
+        done = 0.0
+        for stage in self.stages.values():
+            if stage["state"] == "SUCCESS":
+                done += 1
+            elif stage["state"] == "STARTED" and stage["total"]:
+                done += min(1.0, max(0, stage["current"]) / stage["total"])
+        finished = sum(1 for stage in self.stages.values()
+                       if stage["state"] == "SUCCESS")
+        progress = {"current": int(100 * done / max(1, len(self.stages))),
+                    "total": 100,
+                    "current_steps": finished,
+                    "total_steps": len(self.stages)}
+        task = {"progress": progress, "stages": self.stages}
+        task.update(self.extra)
+        return task
+
+    def _save(self, force=False):
+        now = time.time()
+        if force or now - self._saved >= self.SAVE_INTERVAL:
+            self.redis.set(self.key, self.to_dict())
+            self._saved = now
+
+    @contextlib.contextmanager
+    def stage(self, name, total=None):
+        """Marks a stage as started, and as finished or failed on exit
+
+        :param str name: The name of the stage
+        :param int total: The steps of the stage, if they are known
+        """
+        stage = self.stages[name]
+        with self._lock:
+            stage.update(state="STARTED", total=total)
+            self._save(force=True)
+        start = timeit.default_timer()
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                stage["state"] = "FAILURE"
+                stage["seconds"] = timeit.default_timer() - start
+                self._save(force=True)
+            raise
+        with self._lock:
+            stage["state"] = "SUCCESS"
+            if stage["total"] is not None:
+                stage["current"] = stage["total"]
+            stage["seconds"] = timeit.default_timer() - start
+            self._save(force=True)
+
+    def update(self, name, current, total=None):
+        """Sets the steps done of a stage
+
+        :param str name: The name of the stage
+        :param int current: The steps done
+        :param int total: The steps of the stage, if they have changed
+        """
+        with self._lock:
+            self.stages[name]["current"] = current
+            if total is not None:
+                self.stages[name]["total"] = total
+            self._save()
+
+    def advance(self, name):
+        """Adds one step done to a stage"""
+        with self._lock:
+            self.stages[name]["current"] += 1
+            self._save()
+
+    def set_extra(self, key, value):
+        """Stores other information of the task, such as the telemetry"""
+        with self._lock:
+            self.extra[key] = value
+            self._save()
+
+
+@app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def run_pipeline(self, dataset_id, generate_triples=None, algorithm_dict=None,
+                 n_trees=None, langs=None):
+    """Refreshes a dataset end to end on a single task
+
+    Runs the stages requested, in this order: crawls the triples
+    (*generate_triples*), trains a model (*algorithm_dict*), builds the
+    search index (*n_trees*) and the autocomplete index (*langs*). Stages
+    with a None parameter are skipped.
+
+    The dataset is loaded once and shared by all the stages, and the search
+    index is built with the embeddings returned by the training, without
+    loading the model again. The labels of the autocomplete index only
+    depend on the entities, so they are fetched while the model is trained.
+    The progress of all the stages is saved on a single object (see
+    PipelineProgress).
+
+    :param int dataset_id: The dataset ID
+    :param dict generate_triples: The graph_pattern, levels and batch_size of
+                                  the crawl, as in generate_dataset_from_sparql
+    :param dict algorithm_dict: An algorithm to be used in dataset training
+    :param int n_trees: The number of trees of the search index
+    :param list langs: A list of languages in ISO 639-1 format
+    """
+    dataset_dao = data_access.DatasetDAO()
+    dataset_path, err = dataset_dao.get_binary_path(dataset_id)
+    if dataset_path is None:
+        raise FileNotFoundError("Dataset path is not on the system")
+    dataset_dto, err = dataset_dao.get_dataset_by_id(dataset_id)
+
+    stages = [name for name, param in (('crawl', generate_triples),
+                                       ('train', algorithm_dict),
+                                       ('index', n_trees),
+                                       ('autocomplete', langs))
+              if param is not None]
+    progress = PipelineProgress(self.request.id, stages)
+
+    # Load current dataset, used by all the stages
+    dtset = dataset.Dataset()
+    dtset.load_from_binary(dataset_path)
+
+    if generate_triples is not None:
+        dataset_dao.set_status(dataset_id, -1)
+        crawl_kwargs = dict(generate_triples)
+        with progress.stage('crawl'):
+            crawl_dataset(
+                dtset, dataset_path, crawl_kwargs.pop('graph_pattern'),
+                int(crawl_kwargs.pop('levels')),
+                status_callback=lambda status: progress.update(
+                    'crawl', status['it_analyzed'], status['it_total']),
+                **crawl_kwargs)
+        dataset_dao.set_status(dataset_id, 0)
+
+    def fetch_labels():
+        entity_dao = data_access.get_entity_dao(dataset_dto.dataset_type,
+                                                dataset_id)
+        with progress.stage('autocomplete', len(dtset.entities)):
+            index_entity_labels(dtset, entity_dao, langs,
+                                lambda: progress.advance('autocomplete'))
+
+    def training_callback(trainer, telemetry):
+        progress.update('train', trainer.epoch)
+        progress.set_extra('telemetry', telemetry.to_dict())
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        labels = executor.submit(fetch_labels) if langs is not None else None
+
+        model_path, embeddings = None, None
+        if algorithm_dict is not None:
+            dataset_dao.set_algorithm(dataset_id, algorithm_dict["id"])
+            dataset_dao.set_status(dataset_id, -1)
+            with progress.stage('train', algorithm_dict['max_epochs']):
+                model_path, embeddings, report = train_model(
+                    dtset, dataset_path, algorithm_dict, training_callback)
+            progress.set_extra('quantization', report)
+            dataset_dao.set_status(dataset_id, 1)
+            dataset_dao.set_model(dataset_id, model_path)
+
+        if n_trees is not None:
+            if model_path is None:
+                model_path, err = dataset_dao.get_model(dataset_id)
+            dataset_dao.set_status(dataset_id, -2)
+            with progress.stage('index', 4):
+                search_index_file = build_index(
+                    dataset_id, model_path, n_trees, embeddings, dtset,
+                    callback=lambda step: progress.update('index', step))
+            dataset_dao.set_status(dataset_id, 2)
+            dataset_dao.set_search_index(dataset_id, search_index_file)
+
+        # Raises the error of the labels, if any
+        if labels is not None:
+            labels.result()
 
     return False
 
 
+def _search_keys(search_id):
+    """Redis keys of the progress and of the trials of a search"""
+    return ("celery-task-progress-{}".format(search_id),
+            "search-trials-{}".format(search_id))
+
+
+def _save_search_progress(redis, search_id, n_trials, **extra):
+    """Saves the progress of a search from the state of its trials
+
+    Each trial saves its state and score on its own field of a redis hash,
+    so the trials running on other workers never overwrite it, and the
+    progress is computed again from the whole hash.
+    """
+    progress_key, trials_key = _search_keys(search_id)
+    trials = redis.hgetall(trials_key)
+    finished = sum(1 for trial in trials.values()
+                   if trial['state'] in ("SUCCESS", "FAILURE"))
+    task = {"progress": {"current": finished,
+                         "total": n_trials,
+                         "current_steps": finished,
+                         "total_steps": n_trials},
+            "trials": [trials[key] for key in sorted(trials, key=int)]}
+    task.update(extra)
+    redis.set(progress_key, task)
+
+
+@app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def search_algorithm(self, dataset_id, search):
+    """Looks for the best algorithm of a dataset, on all the workers
+
+    Every configuration of the search (see algorithm.search_trials) is
+    trained on its own run_search_trial task, so the trials run on all the
+    celery workers at once. The trials map the triples from a split file
+    (see kgeserver.dataset_split) written once next to the dataset, instead
+    of loading the dataset again. The best trial is saved as a new algorithm
+    by finish_search.
+
+    This task is replaced by the chord of the trials and finish_search,
+    which keeps its id, so the task finishes when the search does. The
+    progress shows every trial, with its state and score.
+
+    :param int dataset_id: The dataset ID
+    :param dict search: The models, margins, embedding_sizes and max_epochs
+                        tried, and the test_all, patience and eval_seconds of
+                        the validation
+    """
+    dataset_dao = data_access.DatasetDAO()
+    dataset_path, err = dataset_dao.get_binary_path(dataset_id)
+    if dataset_path is None:
+        raise FileNotFoundError("Dataset path is not on the system")
+
+    dtset = dataset.Dataset()
+    dtset.load_from_binary(dataset_path)
+    split_file = dataset_split.split_path(dataset_path)
+    dataset_split.save_split(dtset, split_file)
+
+    trials = algorithm.search_trials(
+        search['models'], search['margins'], search['embedding_sizes'],
+        search['max_epochs'])
+    validation = dict((key, search[key])
+                      for key in ('test_all', 'patience', 'eval_seconds')
+                      if search.get(key) is not None)
+
+    search_id = self.request.id
+    redis = data_access.get_redis_backend()
+    for trial_id, trial in enumerate(trials):
+        redis.hset(_search_keys(search_id)[1], trial_id,
+                   {"id": trial_id, "state": "PENDING", "algorithm": trial,
+                    "score": None})
+    _save_search_progress(redis, search_id, len(trials))
+
+    raise self.replace(chord(
+        group(run_search_trial.s(search_id, len(trials), split_file,
+                                 trial_id, trial, validation)
+              for trial_id, trial in enumerate(trials)),
+        finish_search.s(search_id, len(trials))))
+
+
+@app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def run_search_trial(self, search_id, n_trials, split_file, trial_id, trial,
+                     validation):
+    """Trains and validates one configuration of a search_algorithm task
+
+    A trial that fails is saved as failed, and does not stop the search.
+
+    :param str search_id: The id of the search_algorithm task
+    :param int n_trials: The number of trials of the search
+    :param str split_file: The path of the split file of the dataset
+    :param int trial_id: The position of the trial on the search
+    :param dict trial: The algorithm dict of the trial
+    :param dict validation: Other ModelTrainer params of the validation
+    :return: The trial, with its state, score and duration
+    :rtype: dict
+    """
+    redis = data_access.get_redis_backend()
+    trials_key = _search_keys(search_id)[1]
+    result = {"id": trial_id, "state": "STARTED", "algorithm": trial,
+              "score": None}
+    redis.hset(trials_key, trial_id, result)
+    _save_search_progress(redis, search_id, n_trials)
+
+    start = timeit.default_timer()
+    try:
+        dtset = dataset_split.SplitDataset.load(split_file)
+        result.update(algorithm.evaluate_algorithm(
+            dtset, trial, native=_CONFIG_get_native_trainer(),
+            workers=_CONFIG_get_train_workers(),
+            sampler=_CONFIG_get_train_sampler(), **validation))
+        result["state"] = "SUCCESS"
+    except Exception as err:
+        print("Trial {} of search {} failed: {}".format(
+            trial_id, search_id, err))
+        result["state"] = "FAILURE"
+        result["error"] = str(err)
+    result["seconds"] = timeit.default_timer() - start
+
+    redis.hset(trials_key, trial_id, result)
+    _save_search_progress(redis, search_id, n_trials)
+    return result
+
+
+@app.task(bind=True)
+def finish_search(self, results, search_id, n_trials):
+    """Saves the best trial of a search as a new algorithm
+
+    The algorithm trains up to the epoch of the best validation score.
+
+    :param list results: The result of every trial, see run_search_trial
+    :param str search_id: The id of the search_algorithm task
+    :param int n_trials: The number of trials of the search
+    :return: The new algorithm and the best trial
+    :rtype: dict
+    """
+    scored = [result for result in results
+              if result["state"] == "SUCCESS" and result["score"] is not None]
+    if not scored:
+        raise ValueError("No trial of the search could be validated")
+    best = max(scored, key=lambda result: result["score"])
+
+    algorithm_dict = dict(best["algorithm"])
+    if best.get("best_epoch"):
+        algorithm_dict["max_epochs"] = best["best_epoch"]
+    algorithm_id, err = data_access.AlgorithmDAO().insert_algorithm(
+        algorithm_dict)
+    if algorithm_id is None:
+        raise ValueError(str(err))
+    algorithm_dict["id"] = algorithm_id
+
+    _save_search_progress(data_access.get_redis_backend(), search_id,
+                          n_trials, algorithm=algorithm_dict,
+                          best_trial=best["id"])
+    return {"algorithm": algorithm_dict, "trial": best}
+
+
 def find_embeddings_on_model(dataset_id, entities):
     """Returns a list with the corresponding embeddings
 
@@ -348,23 +996,24 @@ def find_embeddings_on_model(dataset_id, entities):
     if dataset_path is None:
         raise FileNotFoundError("The binary dataset doesn't exist on database")
 
-    # Load dataset from binary
-    dtset = dataset.Dataset()
-    dtset.load_from_binary(dataset_path)
+    dataset_dto, err = dataset_dao.get_dataset_by_id(dataset_id)
+    vocab, err = dataset_dao.get_vocabulary(dataset_dto)
+    if vocab is None:
+        raise FileNotFoundError(err[1])
 
     model_path, err = dataset_dao.get_model(dataset_id)
     if model_path is None:
         raise FileNotFoundError("The model path does not exist on database")
-    # Load the model and initialize the search index
-    model = skge.TransE.load(model_path)
+    # Load the embeddings, quantized if they are available
+    embeddings = quantization.load_embeddings(
+        model_path, algorithm.load_model, _CONFIG_get_embeddings_dtype())
 
     return_list = []
-    for entity in entities:
-        position = dtset.get_entity_id(entity)
-        if position is None or position < 0:
+    for entity, position in zip(entities, vocab.get_entity_ids(entities)):
+        if position < 0:
             continue
         else:
-            embedding = model.E[position]
+            embedding = embeddings[int(position)]
         return_list.append([entity, embedding.tolist()])
     return return_list
 
@@ -372,7 +1021,39 @@ def find_embeddings_on_model(dataset_id, entities):
 def delete_dataset_by_id(dataset_id):
     dataset_dao = data_access.DatasetDAO()
     list_bin_files, err = dataset_dao.delete_dataset(dataset_id)
-    for bin_file in list_bin_files:
+    # Quantized embeddings are saved next to the model
+    for bin_file in list(list_bin_files):
+        if bin_file.endswith("_model.bin"):
+            quantized = [quantization.quantized_path(bin_file, dtype)
+                         for dtype in quantization.DTYPES]
+            list_bin_files += [q for q in quantized if os.path.isfile(q)]
+        # Neighbour tables are saved next to the search index
+        elif "_annoy_" in bin_file:
+            neighbour_table.NeighbourTable.remove(bin_file[:-4] + "_knn")
+        # The folder of the dataset is removed when it is empty
+        elif os.path.isdir(bin_file):
+            continue
+        # The vocabulary, the autocomplete index, the split file, the
+        # statistics and the delta log are saved next to the binary dataset
+        else:
+            log = delta_log.DeltaLog(bin_file)
+            list_bin_files += [
+                path for path in [vocabulary.vocabulary_path(bin_file),
+                                  autocomplete.suggest_path(bin_file),
+                                  dataset_split.split_path(bin_file),
+                                  data_access.dataset_dao.statistics_path(
+                                      bin_file),
+                                  log.scheduled_path, log.lock_path] +
+                log.files()
+                if os.path.isfile(path)]
+            # The checkpoints of the trainings that did not finish, one for
+            # each algorithm
+            list_bin_files += glob.glob(
+                glob.escape(bin_file[:-4]) + "_checkpoint_*.bin")
+            # The log of a crawl that did not finish
+            shutil.rmtree(crawl_log.log_path(bin_file), ignore_errors=True)
+    # Files first, so the folders are empty when they are removed
+    for bin_file in sorted(list_bin_files, key=os.path.isdir):
         print(bin_file)
         try:
             os.remove(bin_file)
@@ -20,11 +20,11 @@
 import os
 import time
 import sqlite3
-import redis
 import json
-import kgeserver.server as server
+import threading
 import kgeserver.dataset as dataset
 import kgeserver.wikidata_dataset as wikidata_dataset
+from kgeserver.lazy_import import lazy_import
 import data_access.dataset_dao as dataset_dao
 import data_access.algorithm_dao as algorithm_dao
 import data_access.data_access_base as data_access_base
@@ -33,8 +33,16 @@ DatasetDAO = dataset_dao.DatasetDAO
 AlgorithmDAO = algorithm_dao.AlgorithmDAO
 MainDAO = data_access_base.MainDAO
 EntityDAO = entity_dao.EntityDAO
+EmbeddedEntityDAO = entity_dao.EmbeddedEntityDAO
+get_entity_dao = entity_dao.get_entity_dao
 EntityDTO = entity_dao.EntityDTO
 
+redis = lazy_import("redis")
+
+# The backend shared by the DAOs of this process. See get_redis_backend
+_redis_backend = None
+_redis_backend_lock = threading.Lock()
+
 
 class RedisBackend:
     """Creates a wrapper for redis to manage dicts inside Redis
@@ -65,6 +73,32 @@ class RedisBackend:
     def incr(self, key):
         return self.connection.incr(key)
 
+    def hset(self, key, field, value):
+        """Sets a field of a hash, so many processes write the same key"""
+        return self.connection.hset(key, field,
+                                    json.dumps(value).encode("utf-8"))
+
+    def hgetall(self, key):
+        """Returns all the fields of a hash, as a dict"""
+        return dict((field.decode("utf-8"), json.loads(value.decode("utf-8")))
+                    for field, value in self.connection.hgetall(key).items())
+
+
+def get_redis_backend():
+    """Returns the RedisBackend of this process, created on first use
+
+    The connection pool of the client is shared by all the DAOs, instead of
+    being created when the module is imported.
+
+    :rtype: RedisBackend
+    """
+    global _redis_backend
+    if _redis_backend is None:
+        with _redis_backend_lock:
+            if _redis_backend is None:
+                _redis_backend = RedisBackend()
+    return _redis_backend
+
 
 class TaskDAO():
     """Manages the Task resource from Redis KeyStore database.
@@ -73,12 +107,12 @@ class TaskDAO():
     be created. It will only contain an integer to be incremented with every
     task created.
     """
-    def __init__(self, backend=RedisBackend()):
+    def __init__(self, backend=None):
         self.task = {"celery_uuid": None,
                      "id": None,
                      "next": None}
 
-        self.redis = backend
+        self.redis = backend or get_redis_backend()
 
     def redis_id(self):
         return self.redis_id_build(self.task["id"])
@@ -133,8 +167,8 @@ class ProgressDTO():
 class ProgressDAO():
     """This class allows to manage the status of a task on the database
     """
-    def __init__(self, backend=RedisBackend()):
-        self.redis = backend
+    def __init__(self, backend=None):
+        self.redis = backend or get_redis_backend()
 
     def _redis_id(self, celery_uuid):
         """auxiliar method to fastly create the redis id
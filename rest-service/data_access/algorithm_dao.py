@@ -21,7 +21,6 @@
 import os
 import time
 import sqlite3
-import redis
 import json
 import kgeserver.server as server
 import kgeserver.dataset as dataset
@@ -21,7 +21,6 @@
 import os
 import time
 import sqlite3
-import redis
 import json
 import copy
 import kgeserver.server as server
@@ -62,6 +61,16 @@ def _CONFIG_get_database_fill():
         return False
 
 
+# Columns added to the tables after their creation: (table, column, type).
+# Older databases get them when they are opened
+ADDED_COLUMNS = [
+    ("algorithm", "model", "TEXT"),
+]
+
+# Databases already migrated by this process
+_migrated_databases = set()
+
+
 class MainDAO():
 
     def __init__(self):
@@ -91,6 +100,29 @@ class MainDAO():
             raise PermissionError(msg)
 
         self.connection = sqlite3.connect(self.database_file)
+        if self.database_file not in _migrated_databases:
+            self.migrate_db()
+            _migrated_databases.add(self.database_file)
+
+    def migrate_db(self):
+        """Adds the columns of ADDED_COLUMNS that the database lacks
+
+        It can be called many times, and by many processes at once.
+        """
+        for table, column, column_type in ADDED_COLUMNS:
+            columns = [row["name"] for row in self.execute_query(
+                "PRAGMA table_info({}) ;".format(table))]
+            if column in columns:
+                continue
+            try:
+                self.execute_query("ALTER TABLE {} ADD COLUMN {} {} ;"
+                                   .format(table, column, column_type))
+            except sqlite3.OperationalError:
+                # Added by another process meanwhile
+                columns = [row["name"] for row in self.execute_query(
+                    "PRAGMA table_info({}) ;".format(table))]
+                if column not in columns:
+                    raise
 
     def build_basic_db(self, insert_dummy=False):
 
@@ -98,7 +130,8 @@ class MainDAO():
                            "(id INTEGER UNIQUE PRIMARY KEY, "
                            "embedding_size INTEGER, "
                            "max_epochs INTEGER, "
-                           "margin FLOAT) ; ")
+                           "margin FLOAT, "
+                           "model TEXT) ; ")
 
         self.execute_query("CREATE TABLE dataset "
                            "(id INTEGER UNIQUE PRIMARY KEY, "
@@ -21,18 +21,103 @@
 import os
 import time
 import sqlite3
-import redis
 import json
+import hashlib
+import tempfile
+import collections
+import numpy as np
 from pathlib import PurePath
 import kgeserver.server as server
+import kgeserver.algorithm as algorithm
+import kgeserver.quantization as quantization
+import kgeserver.neighbour_table as neighbour_table
+import kgeserver.vocabulary as vocabulary
 import kgeserver.dataset as dataset
+import kgeserver.delta_log as delta_log
+import kgeserver.dataset_split as dataset_split
+import kgeserver.graph_statistics as graph_statistics
 import kgeserver.wikidata_dataset as wikidata_dataset
 import kgeserver.dbpedia_dataset as dbpedia_dataset
 import data_access.data_access_base as data_access_base
+import instrumentation
 from data_access.dataset_dto import DatasetDTO
 from data_access.algorithm_dao import AlgorithmDAO
 
 
+def _CONFIG_get_delta_log_bytes():
+    """Size of the delta log of a dataset that starts its compaction"""
+    try:
+        return int(os.environ["DELTA_LOG_COMPACT_BYTES"])
+    except (KeyError, ValueError):
+        return 1024 * 1024
+
+
+def _CONFIG_get_embeddings_dtype():
+    """Type used to store the embeddings served (float16 or int8)"""
+    dtype = os.environ.get("EMBEDDINGS_DTYPE", "float16")
+    if dtype not in quantization.DTYPES:
+        return "float16"
+    return dtype
+
+
+# Link predictors kept in memory, by model path. Loading a model and indexing
+# its triples takes much longer than a prediction
+LINK_PREDICTORS_CACHED = 2
+_link_predictors = collections.OrderedDict()
+
+# Embeddings kept in memory, by model path. The quantized ones are memory
+# mapped, but the model is unpickled when there is no quantized copy
+EMBEDDINGS_CACHED = 4
+_embeddings = collections.OrderedDict()
+
+# Vocabularies opened by this process, by path. They are memory mapped, so
+# the pages are shared between workers
+_vocabularies = {}
+
+# Split files opened by this process, by path. Memory mapped too
+_split_datasets = {}
+
+
+def statistics_path(dataset_path):
+    """Path of the statistics of a binary dataset
+
+    :param str dataset_path: The path of the binary dataset
+    :rtype: str
+    """
+    return dataset_path[:-4] + "_stats.json"
+
+
+def _file_version(path):
+    """Identifies a file, which changes when it is replaced
+
+    :return: The inode and modification time of the file, or None
+    :rtype: tuple
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def _write_json(path, obj):
+    """Writes a JSON file on a temporary file that replaces it"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                    suffix=".tmp",
+                                    prefix=os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "w") as json_file:
+            json.dump(obj, json_file)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
 class DatasetDAO(data_access_base.MainDAO):
     """Object to interact between the data storage and returns valid objects
 
@@ -258,11 +343,146 @@ class DatasetDAO(data_access_base.MainDAO):
         if dataset_dto and dataset_dto._binary_dataset:
             dtst = dataset.Dataset()
             path = os.path.join(self.bin_path, dataset_dto._binary_dataset)
-            dtst.load_from_binary(path)
+            with instrumentation.span("build_dataset_object"):
+                dtst.load_from_binary(path)
             return dtst
         else:
             return None
 
+    def get_vocabulary(self, dataset_dto):
+        """Returns the entities and relations of a dataset, without its triples
+
+        The vocabulary is saved on a file next to the binary dataset by
+        build_dataset_files, and it is only built here if it does not
+        exist. It is much cheaper to open than the dataset, so it should be
+        used to translate entities and ids on requests. Until the task that
+        follows an insert replaces it, the previous vocabulary is returned.
+
+        :param DatasetDTO dataset_dto: The dataset
+        :returns: A kgeserver.vocabulary.DatasetVocabulary or None
+        :rtype: tuple
+        """
+        if not dataset_dto or not dataset_dto._binary_dataset:
+            return None, (404, "The dataset has no binary dataset")
+        dtst_path = dataset_dto.get_binary_dataset()
+        vocab_path = vocabulary.vocabulary_path(dtst_path)
+        version = _file_version(vocab_path)
+        cached = _vocabularies.get(vocab_path)
+        if version is not None and cached is not None and \
+                cached[0] == version:
+            return cached[1], None
+        if version is None:
+            built, err = self.build_dataset_files(dtst_path)
+            if built is None:
+                return None, err
+            version = _file_version(vocab_path)
+        try:
+            with instrumentation.span("get_vocabulary"):
+                vocab = vocabulary.DatasetVocabulary.load(vocab_path)
+        except (OSError, ValueError) as err:
+            msg = "The server has encountered an error: '{}'."
+            return None, (500, msg.format(err.args))
+        _vocabularies[vocab_path] = (version, vocab)
+        return vocab, None
+
+    def get_split_dataset(self, dataset_dto):
+        """Returns the triples of a dataset as memory mapped arrays
+
+        The triples are saved on a split file next to the binary dataset
+        (see kgeserver.dataset_split) by build_dataset_files, and it is only
+        built here if it does not exist. Reading the triples from it only
+        pages in the parts of the file being read. Until the task that
+        follows an insert replaces it, the previous split is returned.
+
+        :param DatasetDTO dataset_dto: The dataset
+        :returns: A kgeserver.dataset_split.SplitDataset or None
+        :rtype: tuple
+        """
+        if not dataset_dto or not dataset_dto._binary_dataset:
+            return None, (404, "The dataset has no binary dataset")
+        dtst_path = dataset_dto.get_binary_dataset()
+        split_file = dataset_split.split_path(dtst_path)
+        version = _file_version(split_file)
+        cached = _split_datasets.get(split_file)
+        if version is not None and cached is not None and \
+                cached[0] == version:
+            return cached[1], None
+        if version is None:
+            built, err = self.build_dataset_files(dtst_path)
+            if built is None:
+                return None, err
+            version = _file_version(split_file)
+        try:
+            with instrumentation.span("get_split_dataset"):
+                split = dataset_split.SplitDataset.load(split_file)
+        except (OSError, ValueError) as err:
+            msg = "The server has encountered an error: '{}'."
+            return None, (500, msg.format(err.args))
+        _split_datasets[split_file] = (version, split)
+        return split, None
+
+    def get_dataset_statistics(self, dataset_dto, use_cache=True):
+        """Returns the degree and relation statistics of a dataset
+
+        Statistics are saved inside the binary dataset. To avoid loading the
+        entire binary file on each request, they are also written on a JSON
+        file next to the binary dataset by build_dataset_files, when the
+        dataset is created, crawled or updated with inserted triples, and
+        this method only reads that file. Datasets saved before the
+        statistics existed do not have it, so it is built on their first
+        request. Until the task that follows an insert replaces it, the
+        previous statistics are returned.
+
+        :param DatasetDTO dataset_dto: The dataset to get statistics from
+        :param bool use_cache: False to compute the statistics again, loading
+                               the binary dataset
+        :return: A dictionary with the statistics
+        :rtype: tuple
+        """
+        if not dataset_dto._binary_dataset:
+            return None, (404, "The dataset has no binary dataset")
+        dtst_path = dataset_dto.get_binary_dataset()
+        stats_path = statistics_path(dtst_path)
+        if not use_cache or not os.path.exists(stats_path):
+            built, err = self.build_dataset_files(dtst_path)
+            if built is None:
+                return None, err
+        try:
+            with open(stats_path) as stats_file:
+                return json.load(stats_file), None
+        except (OSError, ValueError) as err:
+            msg = "The server has encountered an error: '{}'."
+            return None, (500, msg.format(err.args))
+
+    def build_dataset_files(self, dtst_path, dtset=None):
+        """Builds the files read by requests instead of the binary dataset
+
+        The vocabulary, the split file and the statistics are written on
+        temporary files that replace the current ones, so the requests
+        served meanwhile read the previous files. The vocabulary is replaced
+        first, so it always knows all the ids of the split file.
+
+        :param str dtst_path: The path of the binary dataset
+        :param kgeserver.dataset.Dataset dtset: The dataset, if it is loaded
+        :return: True if the files were built
+        :rtype: tuple
+        """
+        try:
+            with instrumentation.span("build_dataset_files"):
+                if dtset is None:
+                    dtset = dataset.Dataset()
+                    dtset.load_from_binary(dtst_path)
+                vocabulary.DatasetVocabulary.from_dataset(dtset).save(
+                    vocabulary.vocabulary_path(dtst_path))
+                dataset_split.save_split(
+                    dtset, dataset_split.split_path(dtst_path))
+                _write_json(statistics_path(dtst_path),
+                            dtset.get_statistics())
+        except (OSError, ValueError) as err:
+            msg = "The server has encountered an error: '{}'."
+            return None, (500, msg.format(err.args))
+        return True, None
+
     # def build_dataset_path(self, dataset_dto):  # TODO deprecated
     #     """Generates a relative path to the dataset from a DTO
     #     :deprecated: See get_binary_path
@@ -302,13 +522,199 @@ class DatasetDAO(data_access_base.MainDAO):
                           "ready for search".format(**dataset_dto.to_dict()))
         try:
             sch_in = server.SearchIndex()
-            sch_in.load_from_file(dataset_dto.get_binary_index(),
-                                  dataset_dto.algorithm['embedding_size'])
+            with instrumentation.span("get_search_index"):
+                sch_in.load_from_file(dataset_dto.get_binary_index(),
+                                      dataset_dto.algorithm['embedding_size'])
             return sch_in, None
         except OSError as err:
             msg = "The server has encountered an error: '{}'."
             return None, (500, msg.format(err.args))
 
+    def get_artifact_version(self, dataset_id):
+        """Returns an identifier of the files used to answer predictions
+
+        The identifier changes when the dataset, the model or the search
+        index files are replaced or modified, or when the dataset changes
+        its status. It is much cheaper than loading the dataset.
+
+        :param int dataset_id: The id of the dataset
+        :returns: A short hexadecimal string
+        :rtype: tuple
+        """
+        query = ("SELECT binary_dataset, binary_model, binary_index, status, "
+                 "algorithm FROM dataset WHERE id=? ;")
+        res = self.execute_query(query, dataset_id)
+        if res is None or len(res) < 1:
+            return None, (404, "Dataset {} not found".format(dataset_id))
+
+        identity = [dataset_id, res[0]['status'], res[0]['algorithm']]
+        for key in ('binary_dataset', 'binary_model', 'binary_index'):
+            if not res[0][key]:
+                identity.append(None)
+                continue
+            path = os.path.join(self.bin_path, res[0][key])
+            try:
+                stat = os.stat(path)
+                identity.append((path, stat.st_ino, stat.st_size,
+                                 stat.st_mtime_ns))
+            except OSError:
+                identity.append((path, None))
+        # Inserted triples change the dataset without replacing its file
+        if res[0]['binary_dataset']:
+            log = delta_log.DeltaLog(
+                os.path.join(self.bin_path, res[0]['binary_dataset']))
+            for path in log.files():
+                try:
+                    stat = os.stat(path)
+                    identity.append((path, stat.st_size, stat.st_mtime_ns))
+                except OSError:
+                    pass
+        digest = hashlib.sha1(repr(identity).encode("utf-8")).hexdigest()
+        return digest[:20], None
+
+    def get_neighbour_table(self, dataset_dto):
+        """Returns the precomputed neighbours of the search index
+
+        The table is only returned if it has been built after the index.
+
+        :returns: A kgeserver.neighbour_table.NeighbourTable or None
+        :rtype: tuple
+        """
+        if dataset_dto.status < 2 or dataset_dto._binary_index is None:
+            return None, (409, "Dataset {id} has not been indexed yet"
+                          .format(**dataset_dto.to_dict()))
+        index_path = dataset_dto.get_binary_index()
+        prefix = index_path[:-4] + "_knn"
+        rows_path = neighbour_table.table_paths(prefix)[2]
+        try:
+            if os.path.getmtime(rows_path) < os.path.getmtime(index_path):
+                return None, (409, "The neighbour table is older than the "
+                              "search index")
+            with instrumentation.span("get_neighbour_table"):
+                return neighbour_table.NeighbourTable.load(prefix), None
+        except (OSError, ValueError) as err:
+            return None, (404, "There is no neighbour table: {}".format(err))
+
+    def get_embeddings(self, dataset_dto):
+        """Returns the embeddings of the entities of a trained dataset
+
+        The quantized embeddings of EMBEDDINGS_DTYPE are used if they exist,
+        to load less data. The last embeddings used are kept in memory, and
+        they are loaded again only if the file read changes.
+
+        :returns: The embeddings (one entity by row) or None
+        :rtype: tuple
+        """
+        if not dataset_dto.is_trained() or dataset_dto._binary_model is None:
+            return None, (409, "Dataset {id} has not been trained yet"
+                          .format(**dataset_dto.to_dict()))
+        model_path = dataset_dto.get_binary_model()
+        dtype = _CONFIG_get_embeddings_dtype()
+        quantized_file = quantization.quantized_path(model_path, dtype)
+        try:
+            if os.path.isfile(quantized_file):
+                version = (quantized_file, os.path.getmtime(quantized_file))
+            else:
+                version = (model_path, os.path.getmtime(model_path))
+            cached = _embeddings.get(model_path)
+            if cached is not None and cached[0] == version:
+                _embeddings.move_to_end(model_path)
+                return cached[1], None
+
+            with instrumentation.span("get_embeddings"):
+                embeddings = quantization.load_embeddings(
+                    model_path, algorithm.load_model, dtype)
+        except (OSError, ValueError) as err:
+            msg = "The server has encountered an error: '{}'."
+            return None, (500, msg.format(err.args))
+
+        _embeddings[model_path] = (version, embeddings)
+        while len(_embeddings) > EMBEDDINGS_CACHED:
+            _embeddings.popitem(last=False)
+        return embeddings, None
+
+    def get_link_predictor(self, dataset_dto):
+        """Returns a link predictor with the trained model of a dataset
+
+        The last predictors used are kept in memory. The model is loaded
+        again only if its file changes, and the known triples, used to
+        filter the predictions, are indexed again when triples are inserted
+        on the delta log or the dataset files are built again.
+
+        :param DatasetDTO dataset_dto: The trained dataset
+        :returns: A kgeserver.server.LinkPredictor or None
+        :rtype: tuple
+        """
+        if not dataset_dto.is_trained() or dataset_dto._binary_model is None:
+            return None, (409, "Dataset {id} has not been trained yet"
+                          .format(**dataset_dto.to_dict()))
+        model_path = dataset_dto.get_binary_model()
+        dtst_path = dataset_dto.get_binary_dataset()
+        log = delta_log.DeltaLog(dtst_path)
+        try:
+            mtime = os.path.getmtime(model_path)
+            # Taken before reading the triples, so none is missed
+            data_version = [_file_version(path) for path in
+                            [dtst_path, dataset_split.split_path(dtst_path)] +
+                            log.files()]
+            cached = _link_predictors.get(model_path)
+            if cached is not None and cached[0] == mtime and \
+                    cached[1] == data_version:
+                _link_predictors.move_to_end(model_path)
+                return cached[2], None
+
+            with instrumentation.span("get_link_predictor"):
+                if cached is not None and cached[0] == mtime:
+                    model = cached[2].model
+                else:
+                    model = algorithm.load_model(model_path)
+                known, err = self._known_triples(dataset_dto, log,
+                                                 len(model.E))
+                if known is None:
+                    return None, err
+                adjacency = server.AdjacencyIndex(known, len(model.E))
+                predictor = server.LinkPredictor(model, adjacency)
+        except (OSError, ValueError) as err:
+            msg = "The server has encountered an error: '{}'."
+            return None, (500, msg.format(err.args))
+
+        _link_predictors[model_path] = (mtime, data_version, predictor)
+        while len(_link_predictors) > LINK_PREDICTORS_CACHED:
+            _link_predictors.popitem(last=False)
+        return predictor, None
+
+    def _known_triples(self, dataset_dto, log, n_entities):
+        """Returns the triples of a dataset as ids, without loading it
+
+        The triples of the split file are read with the ones of the delta
+        log not built on it yet. Triples with entities unknown to the
+        vocabulary, or newer than a model of n_entities, are skipped.
+
+        :param DatasetDTO dataset_dto: The dataset
+        :param kgeserver.delta_log.DeltaLog log: The delta log of dataset
+        :param int n_entities: The entities of the model
+        :return: The (subject, object, predicate) rows
+        :rtype: tuple
+        """
+        split, err = self.get_split_dataset(dataset_dto)
+        if split is None:
+            return None, err
+        triples = [split.arrays[name] for name in dataset_split.SPLITS]
+        inserted = log.read()
+        if inserted:
+            vocab, err = self.get_vocabulary(dataset_dto)
+            if vocab is None:
+                return None, err
+            subjects, objects, preds = zip(*inserted)
+            triples.append(np.column_stack((
+                vocab.get_entity_ids(subjects),
+                vocab.get_entity_ids(objects),
+                vocab.relations.get_ids(preds))))
+        xs = np.concatenate([graph_statistics.triples_array(x)
+                             for x in triples])
+        return xs[((xs >= 0) & (xs < n_entities))[:, :2].all(axis=1) &
+                  (xs[:, 2] >= 0)], None
+
     def get_server(self):  # TODO: Deprecated
         """Returns the server with the correct search index loaded.
 
@@ -364,6 +770,7 @@ class DatasetDAO(data_access_base.MainDAO):
         self.binary_dataset = unique_name
         dtst_path = os.path.join(self.bin_path, bin_name)
         newdataset.save_to_binary(dtst_path)
+        self.build_dataset_files(dtst_path, newdataset)
         rowid = result.lastrowid
         result.close()
 
@@ -396,28 +803,92 @@ class DatasetDAO(data_access_base.MainDAO):
         ]
 
     def insert_triples(self, dataset_dto, triples_list):
-        # TODO: This should not be here
         """Insert triples on the Dataset.
+
+        The triples are appended to the delta log of the dataset (see
+        kgeserver.delta_log), without loading the binary dataset. They are
+        checked with the type of the dataset first, and none is inserted if
+        one of them is not valid.
+
+        The update of the dataset is only scheduled once the log is over
+        DELTA_LOG_COMPACT_BYTES, so small inserts never rebuild it.
+
+        :param DatasetDTO dataset_dto: The dataset
+        :param list triples_list: The triples, as load_dataset_from_json
+        :return: True if the log is over the limit and the update of the
+                 dataset has not been scheduled yet. The caller must start
+                 compact_triples
+        :rtype: tuple
         """
-        dtst_path = dataset_dto.get_binary_dataset()
-        if dtst_path is None:
+        if not dataset_dto._binary_dataset or \
+                not os.path.isfile(dataset_dto.get_binary_dataset()):
             return None, (500, "Dataset couldn't be loaded")
-        dtset = dataset.Dataset()
-        dtset.load_from_binary(dtst_path)
-        dtset.show()
 
-        result = dtset.load_dataset_from_json(triples_list)
-
-        # sql = "SELECT binary_dataset FROM dataset WHERE id=?"
-        # result = self.execute_query(sql, self.dataset["id"])
-        # bin_file = result[0]['binary_dataset']
+        dataset_types = dict((dataset_type['name'], dataset_type['class'])
+                             for dataset_type in self.get_dataset_types())
+        checker = dataset_types.get(dataset_dto.dataset_type,
+                                    dataset.Dataset)()
+        triples = []
+        for triple in triples_list:
+            subject = triple["subject"]['value']
+            obj = triple["object"]['value']
+            pred = triple["predicate"]['value']
+            if not (checker.check_entity(subject) and
+                    checker.check_entity(obj) and
+                    checker.check_relation(pred)):
+                return None, (400, "The triple ({}, {}, {}) is not valid"
+                              .format(subject, pred, obj))
+            triples.append((subject, obj, pred))
+
+        log = delta_log.DeltaLog(dataset_dto.get_binary_dataset())
+        try:
+            log.append(triples)
+            # A compaction left unfinished is retried too
+            if log.size() < _CONFIG_get_delta_log_bytes() and \
+                    not os.path.isfile(log.compacting_path):
+                return False, None
+            return log.schedule_compaction(), None
+        except OSError as err:
+            msg = "The server has encountered an error: '{}'."
+            return None, (500, msg.format(err.args))
 
-        dtset.show()
+    def compact_triples(self, dataset_id):
+        """Updates a dataset with the triples of its delta log
 
-        result = result and\
-            dtset.save_to_binary(dataset_dto.get_binary_dataset())
+        The log is merged on the binary dataset while it is over
+        DELTA_LOG_COMPACT_BYTES, or a compaction was left unfinished. Then
+        the update is unscheduled, so the next insert schedules another one,
+        and, if any triple was merged, the files read by requests are built
+        again (see build_dataset_files) with the triples of the log.
 
-        return result, None
+        :param int dataset_id: The id of the dataset
+        :return: The number of triples merged, or None if the binary dataset
+                 was replaced meanwhile
+        :rtype: tuple
+        """
+        dtst_path, err = self.get_binary_path(dataset_id)
+        if dtst_path is None:
+            return None, err
+        log = delta_log.DeltaLog(dtst_path)
+        merged = 0
+        try:
+            try:
+                while merged is not None and (
+                        log.size() >= _CONFIG_get_delta_log_bytes() or
+                        os.path.isfile(log.compacting_path)):
+                    added = log.compact()
+                    merged = None if added is None else merged + added
+            finally:
+                log.unschedule_compaction()
+        except OSError as err:
+            msg = "The server has encountered an error: '{}'."
+            return None, (500, msg.format(err.args))
+        if not merged:
+            return merged, None
+        built, err = self.build_dataset_files(dtst_path)
+        if built is None:
+            return None, err
+        return merged, None
 
     def set_untrained(self, dataset_dto):
         """Set dataset_dto in untrained state
@@ -142,3 +142,12 @@ class DatasetDTO(data_access_base.DTOClass):
         """Return the path of the binary model file
         """
         return os.path.join(self._base, self._binary_model)
+
+    def get_model_name(self):
+        """Returns the name of the model used to train the dataset
+
+        Algorithms created before the model could be chosen use TransE.
+        """
+        if self.algorithm and self.algorithm.get('model'):
+            return self.algorithm['model']
+        return 'TransE'
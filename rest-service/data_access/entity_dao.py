@@ -19,11 +19,83 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import redis
 import json
-import elasticsearch.exceptions as es_exceptions
-from elasticsearch import Elasticsearch
+import threading
+import kgeserver.autocomplete as autocomplete
 import data_access.data_access_base as data_access_base
+import instrumentation
+from kgeserver.lazy_import import lazy_import
+from data_access.dataset_dao import DatasetDAO
+
+# Only needed by the autocomplete requests and tasks
+elasticsearch = lazy_import("elasticsearch")
+es_exceptions = lazy_import("elasticsearch.exceptions")
+
+# Elasticsearch global params
+ELASTIC_ENDPOINT = "http://elasticsearch:9200/"
+ELASTIC_AUTH = ("elastic", "changeme")
+# Name of the index with the entities of all datasets
+ENTITIES_INDEX = "entities"
+# Name of the completion context with the datasets of each entity
+DATASET_CONTEXT = "dataset"
+
+# Client shared by all the DAOs of this process, and the indexes already
+# checked or created. See get_es_client and EntityDAO.ensure_index
+_es_client = None
+_checked_indexes = set()
+_es_lock = threading.Lock()
+
+
+def _CONFIG_get_es_pool_size():
+    """Connections to Elasticsearch kept open by each process"""
+    try:
+        return int(os.environ["ES_POOL_SIZE"])
+    except (KeyError, ValueError):
+        return 10
+
+
+def _CONFIG_get_autocomplete_backend():
+    """Backend of the autocomplete: 'elasticsearch' or 'embedded'"""
+    backend = os.environ.get("AUTOCOMPLETE_BACKEND", "elasticsearch")
+    if backend not in ('elasticsearch', 'embedded'):
+        return 'elasticsearch'
+    return backend
+
+
+def _CONFIG_get_suggest_size():
+    """Suggestions returned by default by the autocomplete"""
+    try:
+        return int(os.environ["SUGGEST_SIZE"])
+    except (KeyError, ValueError):
+        return 10
+
+
+def get_es_client():
+    """Returns the Elasticsearch client of this process, created on first use
+
+    The client keeps a pool of connections, and it is thread safe, so it is
+    shared by every request and task instead of being created by each one.
+    """
+    global _es_client
+    if _es_client is None:
+        with _es_lock:
+            if _es_client is None:
+                _es_client = elasticsearch.Elasticsearch(
+                    ELASTIC_ENDPOINT, http_auth=ELASTIC_AUTH,
+                    maxsize=_CONFIG_get_es_pool_size())
+    return _es_client
+
+
+def get_entity_dao(dataset_type, dataset_id):
+    """Returns the DAO of the autocomplete backend configured
+
+    :param str dataset_type: The type of the dataset
+    :param int dataset_id: The id of the dataset
+    :rtype: EntityDAO or EmbeddedEntityDAO
+    """
+    if _CONFIG_get_autocomplete_backend() == 'embedded':
+        return EmbeddedEntityDAO(dataset_type, dataset_id)
+    return EntityDAO(dataset_type, dataset_id)
 
 
 class EntityDTO(data_access_base.DTOClass):
@@ -43,25 +115,50 @@ class EntityDAO():
     def __init__(self, dataset_type, dataset_id):
         """Data Access Object to interact with autocomplete
 
-        The autocomplete is provided by Elasticsearch, and it is not divided
-        by datasets, instead it is divided by dataset type.
+        The autocomplete is provided by Elasticsearch. All datasets share the
+        same index, and each entity stores the datasets it belongs to as a
+        context of its suggestions, so Elasticsearch only suggests entities
+        of the dataset of the DAO.
         """
         # TODO: Generate an index on elasticsearch with allowed fields
         # The entity must be loaded with a dataset
-
-        # Elasticsearch global params
-        self.ELASTIC_ENDPOINT = "http://elasticsearch:9200/"
-        self.ELASTIC_AUTH = ("elastic", "changeme")
-
-        # Create Elasticsearch object
-        self.es = Elasticsearch(self.ELASTIC_ENDPOINT,
-                                http_auth=self.ELASTIC_AUTH)
-        self.index = "entities"
+        self.es = get_es_client()
+        self.index = ENTITIES_INDEX
         self.type = dataset_type
         self.dataset_id = dataset_id
-        # Test if index exists, and if not, creates it
-        if not self.es.indices.exists(index=self.index):
-            self.generate_index(self.index)
+        self.ensure_index(self.index)
+
+    def ensure_index(self, indexName):
+        """Creates the index if it does not exist, once for each process
+
+        Indexes created before suggestions had contexts are created again,
+        so their autocomplete index must be built again.
+
+        :params str indexName: Name of the index
+        """
+        if indexName in _checked_indexes:
+            return
+        with _es_lock:
+            if indexName in _checked_indexes:
+                return
+            if not self.es.indices.exists(index=indexName):
+                self.generate_index(indexName)
+            elif not self._has_contexts(indexName):
+                print("Index {} has no dataset contexts. It is created "
+                      "again".format(indexName))
+                self.generate_index(indexName)
+            _checked_indexes.add(indexName)
+
+    def _has_contexts(self, indexName):
+        """Checks if the suggestions of the index are filtered by dataset"""
+        mappings = self.es.indices.get_mapping(index=indexName)
+        for index in mappings.values():
+            for mapping in index.get('mappings', {}).values():
+                suggest = mapping.get('properties', {}).get('label_suggest',
+                                                            {})
+                if suggest.get('contexts'):
+                    return True
+        return False
 
     def generate_index(self, indexName):
         """Generates the index on Elasticsearch
@@ -99,7 +196,9 @@ class EntityDAO():
             'analyzer': 'my_custom_analyzer',
             'search_analyzer': 'standard',
             'preserve_separators': False,
-            'preserve_position_increments': False
+            'preserve_position_increments': False,
+            # The datasets of the entity, given with each suggestion
+            'contexts': [{'name': DATASET_CONTEXT, 'type': 'category'}]
         }
         body['mappings'][self.type]['properties'] = {
             'entity': {'type': 'string'},
@@ -114,14 +213,15 @@ class EntityDAO():
             pass
         self.es.indices.create(index=indexName, body=body)
 
-    def suggest_entity(self, input_string):
+    def suggest_entity(self, input_string, size=None):
         """Calls Elasticsearch to get an autocomplete suggestion
 
         Given an input string, calls Elasticsearch to get autocomplete
-        suggestions based on "completion" suggester. Gives the results filtered
-        for an specific dataset (already choosen on constructor).
+        suggestions based on "completion" suggester. Only entities of the
+        dataset of the DAO are suggested.
 
         :param str input_string: The string to be asked for
+        :param int size: The number of suggestions. See SUGGEST_SIZE
         :rtype: list(EntityDTO)
         :returns: a list of EntityDTO
         """
@@ -130,39 +230,32 @@ class EntityDAO():
           "entities": {
             "text": input_string,
             "completion": {
-                "field": "label_suggest"
+                "field": "label_suggest",
+                "size": size or _CONFIG_get_suggest_size(),
+                "contexts": {DATASET_CONTEXT: [str(self.dataset_id)]}
             }
           }
         }
-        resp = self.es.suggest(index=self.index, body=request)
+        with instrumentation.span("es_suggest"):
+            resp = self.es.suggest(index=self.index, body=request)
 
-        # Filter entities to return only the entities for self.dataset_id
         entities = []
         try:
             for entity in resp['entities'][0]['options']:
-                try:
-                    # Append to entities if dataset_id appears on result
-                    if self.dataset_id in entity['_source']['datasets']:
-                        es_entity = EntityDTO(entity['_source'])
-                        entities.append({"entity": es_entity.to_dict(),
-                                         "text": entity['text']})
-                except KeyError as invalid_key:
-                    # If dataset info is not present, just skip it
-                    if str(invalid_key) != "datasets":
-                        # Re-Raise the error if KeyError is not from 'datasets'
-                        raise
-
-        except KeyError as invalid_key:
-            if str(invalid_key) == "entities":
-                # Will not match with any entity. Return empty list
-                entities = []
+                es_entity = EntityDTO(entity['_source'])
+                entities.append({"entity": es_entity.to_dict(),
+                                 "text": entity['text']})
+        except (KeyError, IndexError):
+            # Will not match with any entity. Return empty list
+            entities = []
         return entities
 
     def insert_entity(self, entity):
         """Insert an entity on Elasticsearch
 
-        Inserts the entity on Elasticsearch and stores the dataset it is, in
-        order to get better performance when getting autocomplete predictions
+        Inserts the entity on Elasticsearch and adds the dataset to the
+        datasets of the entity and to the context of its suggestions, with a
+        single scripted upsert.
 
         :param dict entity: The entity to be inserted
         """
@@ -175,27 +268,124 @@ class EntityDAO():
                     "description": entity['description'],
                     "label": entity['label'],
                     "alt_label": entity['alt_label'],
-                    "label_suggest": suggestions
+                    "datasets": [self.dataset_id],
+                    "label_suggest": {
+                        "input": suggestions,
+                        "contexts": {
+                            DATASET_CONTEXT: [str(self.dataset_id)]}}
                     }
-        # TODO: Could be useful to use a hash function or similar to avoid
-        #       possible URL encoding issues with some entities ID's
-        entity_uuid = entity['entity']
-        insert = self.es.update(index=self.index, doc_type=self.type,
-                                body={"doc": full_doc, "doc_as_upsert": True},
-                                id=entity_uuid)
 
-        # Script to update dataset id
+        # Script to update the entity on other datasets
         script = {"inline": "",         # Filled below due to high size
                   "lang": "painless",   # Elasticsearch language
                   "params": {
+                      "doc": full_doc,
                       "dataset": self.dataset_id
                   }}
 
-        script['inline'] = """if (ctx._source.datasets == null) {
-            ctx._source.datasets = [params.dataset]
-        } else if(!ctx._source.datasets.contains(params.dataset)) {
-            ctx._source.datasets.add(params.dataset)
-        }"""
-        # TODO: To avoid having two update queries, mix both in one script
-        update = self.es.update(index=self.index, doc_type=self.type,
-                                body={"script": script}, id=entity_uuid)
+        script['inline'] = """def datasets = ctx._source.datasets;
+        if (datasets == null) {
+            datasets = [];
+        }
+        if (!datasets.contains(params.dataset)) {
+            datasets.add(params.dataset);
+        }
+        def contexts = [];
+        for (def dataset : datasets) {
+            contexts.add(String.valueOf(dataset));
+        }
+        ctx._source.putAll(params.doc);
+        ctx._source.datasets = datasets;
+        ctx._source.label_suggest = [
+            'input': params.doc.label_suggest.input,
+            'contexts': ['""" + DATASET_CONTEXT + """': contexts]];"""
+        # TODO: Could be useful to use a hash function or similar to avoid
+        #       possible URL encoding issues with some entities ID's
+        entity_uuid = entity['entity']
+        insert = self.es.update(index=self.index, doc_type=self.type,
+                                body={"script": script, "upsert": full_doc},
+                                id=entity_uuid)
+
+    def save_index(self, scores=None):
+        """Finishes the index after inserting all the entities of a dataset
+
+        Elasticsearch suggests the entities as soon as they are inserted, so
+        nothing is done.
+
+        :param dict scores: The score of each entity (unused)
+        """
+        pass
+
+
+# Autocomplete indexes opened by this process, by path
+_suggest_indexes = {}
+
+
+class EmbeddedEntityDAO():
+    def __init__(self, dataset_type, dataset_id):
+        """Data Access Object to interact with the embedded autocomplete
+
+        It has the same methods as EntityDAO, but the suggestions are read
+        from a kgeserver.autocomplete.SuggestIndex saved next to the binary
+        dataset, so no Elasticsearch is needed. The index is built with all
+        the entities inserted when save_index is called.
+        """
+        self.type = dataset_type
+        self.dataset_id = dataset_id
+        self.entities = []
+        self.lock = threading.Lock()
+
+    def _index_path(self):
+        dataset_path, err = DatasetDAO().get_binary_path(self.dataset_id)
+        if dataset_path is None:
+            return None
+        return autocomplete.suggest_path(dataset_path)
+
+    def suggest_entity(self, input_string, size=None):
+        """Returns the entities of the dataset that start with a text
+
+        :param str input_string: The string to be asked for
+        :param int size: The number of suggestions. See SUGGEST_SIZE
+        :rtype: list(EntityDTO)
+        :returns: a list of EntityDTO
+        """
+        path = self._index_path()
+        try:
+            mtime = os.path.getmtime(path)
+        except (OSError, TypeError):
+            # The autocomplete index has not been built
+            return []
+        cached = _suggest_indexes.get(path)
+        if cached is None or cached[0] != mtime:
+            with instrumentation.span("load_suggest_index"):
+                cached = (mtime, autocomplete.SuggestIndex.load(path))
+            _suggest_indexes[path] = cached
+        with instrumentation.span("embedded_suggest"):
+            suggestions = cached[1].suggest(
+                input_string, size or _CONFIG_get_suggest_size())
+        return [{"entity": EntityDTO(suggestion['entity']).to_dict(),
+                 "text": suggestion['text']} for suggestion in suggestions]
+
+    def insert_entity(self, entity):
+        """Adds an entity to the index built by save_index
+
+        :param dict entity: The entity to be inserted
+        """
+        with self.lock:
+            self.entities.append(entity)
+
+    def save_index(self, scores=None):
+        """Builds the autocomplete index with the entities inserted
+
+        The index replaces the previous index of the dataset.
+
+        :param dict scores: The score of each entity, by entity. Entities
+                            with higher scores are suggested first
+        """
+        with self.lock:
+            entities = sorted(self.entities, key=lambda e: e['entity'])
+        scores = scores or {}
+        index = autocomplete.SuggestIndex.build(
+            entities, [scores.get(entity['entity'], 0)
+                       for entity in entities])
+        index.save(self._index_path())
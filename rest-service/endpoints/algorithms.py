@@ -22,13 +22,13 @@ import json
 import copy
 import falcon
 import kgeserver.server as server
+import kgeserver.algorithm as kge_algorithm
 
 # Import parent directory (data_access)
 import sys
 sys.path.insert(0, '..')
 try:
     import data_access
-    import async_server.tasks as async_tasks
 except ImportError:
     raise
 
@@ -91,6 +91,12 @@ class AlgorithmFactory():
                    "Extra info: " + extra)
             raise falcon.HTTPBadRequest(title=err_title, description=msg)
 
+        model = user_algorithm.get("model")
+        if model is not None and model not in kge_algorithm.MODELS:
+            msg = "The model must be one of: {}".format(
+                ", ".join(sorted(kge_algorithm.MODELS)))
+            raise falcon.HTTPInvalidParam(msg, "model")
+
         algorithm_dao = data_access.AlgorithmDAO()
         algorithm_id, err = algorithm_dao.insert_algorithm(user_algorithm)
         if algorithm_id is None:
@@ -23,13 +23,13 @@ import copy
 import falcon
 import kgeserver.server as server
 import endpoints.common_hooks as common_hooks
+import instrumentation
 
 # Import parent directory (data_access)
 import sys
 sys.path.insert(0, '..')
 try:
     import data_access
-    import async_server.tasks as async_tasks
 except ImportError:
     raise
 
@@ -54,6 +54,9 @@ def read_pair_list(req, resp, resource, params):
 
 
 class PredictSimilarEntitiesResource(object):
+    # Responses only depend on the request and the dataset files
+    cache_responses = True
+
     # TODO: Refactor this class using hooks
     def on_get(self, req, resp, dataset_id, entity, embedding=False):
         """Makes HTTP response for a SimilarEntities search
@@ -69,6 +72,9 @@ class PredictSimilarEntitiesResource(object):
         :query int search_k: Maximum number of nodes where the search is made.
                              The higher this param is, the higher quality is,
                              but the performance is worse. Defaults to -1
+        :query int candidates: Take limit * candidates entities from the
+                               search index and sort them with the distance
+                               of the model. Defaults to 1 (disabled)
         :returns: None
         """
         # Get dataset
@@ -82,7 +88,9 @@ class PredictSimilarEntitiesResource(object):
         if ignore is None:
             ignore = False
 
-        dataset = dataset_dao.build_dataset_object(dataset_dto)  # TODO: design
+        dataset, err = dataset_dao.get_vocabulary(dataset_dto)
+        if dataset is None:
+            raise falcon.HTTPNotFound(description=str(err))
 
         # Get server to do 'queries'
         search_index, err = dataset_dao.get_search_index(dataset_dto,
@@ -90,8 +98,24 @@ class PredictSimilarEntitiesResource(object):
         if search_index is None:
             msg_title = "Dataset not ready perform search operation"
             raise falcon.HTTPConflict(title=msg_title, description=str(err))
+        # Dig for the candidates param on Query Params
+        candidates = req.get_param_as_int('candidates')
+        if candidates is None or candidates < 1:
+            candidates = 1
+
+        # Embeddings are only needed to sort again the candidates
+        embeddings = None
+        if candidates > 1:
+            embeddings, err = dataset_dao.get_embeddings(dataset_dto)
+            if embeddings is None:
+                raise falcon.HTTPConflict(
+                    title="Dataset can't sort candidates",
+                    description=str(err))
+
         # TODO: Maybe extract server management anywhere to simplify this
-        search_server = server.Server(search_index)
+        search_server = server.Server(
+            search_index, embeddings=embeddings,
+            metric=server.MODEL_METRICS[dataset_dto.get_model_name()])
 
         # Dig for the limit param on Query Params
         limit = req.get_param_as_int('limit')
@@ -107,8 +131,9 @@ class PredictSimilarEntitiesResource(object):
 
         # If looking for similar_entities given an embedding vector
         if embedding:
-            similar_entities = search_server.similarity_by_embedding(
-                entity, limit, search_k=search_k)
+            with instrumentation.span("annoy_query"):
+                similar_entities = search_server.similarity_by_embedding(
+                    entity, limit, search_k=search_k, candidates=candidates)
             similar_entities = [{"entity": dataset.get_entity(e_id),
                                  "distance": dist}
                                 for e_id, dist in similar_entities]
@@ -124,8 +149,17 @@ class PredictSimilarEntitiesResource(object):
                 raise falcon.HTTPNotFound(
                     description="The {} entity can't be found inside dataset."
                     .format(entity))
-            sim_entities = search_server.similarity_by_id(
-                entity_id, limit, search_k=search_k)
+            # Popular entities have their neighbours already computed
+            sim_entities = None
+            if candidates == 1:
+                table, err = dataset_dao.get_neighbour_table(dataset_dto)
+                if table is not None:
+                    sim_entities = table.neighbours(entity_id, limit)
+            if sim_entities is None:
+                with instrumentation.span("annoy_query"):
+                    sim_entities = search_server.similarity_by_id(
+                        entity_id, limit, search_k=search_k,
+                        candidates=candidates)
             similar_entities = [{"entity": dataset.get_entity(e_id),
                                  "distance": dist}
                                 for e_id, dist in sim_entities]
@@ -140,6 +174,7 @@ class PredictSimilarEntitiesResource(object):
                 "entity": entity_used,
                 "limit": len(similar_entities),
                 "search_k": search_k,
+                "candidates": candidates,
                 "response": similar_entities
             }
         }
@@ -187,6 +222,9 @@ class PredictSimilarEntitiesResource(object):
 
 
 class DistanceTriples():
+    # Responses only depend on the request and the dataset files
+    cache_responses = True
+
     @falcon.before(read_pair_list)
     @falcon.before(common_hooks.check_dataset_exsistence)
     def on_post(self, req, resp, dataset_id, dataset_dto, entities_pair):
@@ -204,7 +242,9 @@ class DistanceTriples():
         :rtype: dict
         """
         dataset_dao = data_access.DatasetDAO()
-        dataset = dataset_dao.build_dataset_object(dataset_dto)  # TODO: design
+        dataset, err = dataset_dao.get_vocabulary(dataset_dto)
+        if dataset is None:
+            raise falcon.HTTPNotFound(description=str(err))
 
         # Get server to do 'queries'
         search_index, err = dataset_dao.get_search_index(dataset_dto)
@@ -222,13 +262,149 @@ class DistanceTriples():
                              "entity can't be found on the dataset")
                 .format(id_x, entity_x, id_y, entity_y))
 
-        dist = search_server.distance_between_entities(id_x, id_y)
+        with instrumentation.span("annoy_distance"):
+            dist = search_server.distance_between_entities(id_x, id_y)
 
         resp.body = json.dumps({"distance": dist})
         resp.content_type = 'application/json'
         resp.status = falcon.HTTP_200
 
 
+def read_link_queries(req, resp, resource, params):
+    """Reads the queries to complete from the body of the request"""
+    body = common_hooks.read_body_as_json(req)
+    if not isinstance(body, dict) or "queries" not in body:
+        raise falcon.HTTPMissingParam("queries")
+    if not isinstance(body["queries"], list):
+        raise falcon.HTTPInvalidParam("Must be a list of queries", "queries")
+    params["queries"] = body["queries"]
+
+
+class PredictLinksResource(object):
+    """Completes triples with the entities the model finds most likely"""
+    # Responses only depend on the request and the dataset files
+    cache_responses = True
+
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_get(self, req, resp, dataset_id, dataset_dto):
+        """Completes a single triple given on the query params
+
+        Provide the ``relation`` and either the ``head`` or the ``tail``
+        entity, such as ``?head=<uri>&relation=<uri>``.
+
+        :param int dataset_id: The dataset identifier on database
+        :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
+        :query str head: The subject of the triple
+        :query str relation: The predicate of the triple
+        :query str tail: The object of the triple
+        :query int limit: Entities returned. Defaults to 10
+        :query bool filtered: Skip known triples. Defaults to True
+        """
+        query = {}
+        for param in ("head", "relation", "tail"):
+            value = req.get_param(param)
+            if value is not None:
+                query[param] = value
+        self.predict(req, resp, dataset_dto, [query])
+
+    @falcon.before(read_link_queries)
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_post(self, req, resp, dataset_id, dataset_dto, queries):
+        """Completes a batch of triples given on the body
+
+        The body must contain a list of queries, like this:
+
+        {"queries": [
+            {"head": "http://www.wikidata.org/entity/Q1492",
+             "relation": "http://www.wikidata.org/prop/direct/P17"},
+            {"relation": "http://www.wikidata.org/prop/direct/P17",
+             "tail": "http://www.wikidata.org/entity/Q29"}
+        ]}
+
+        :param int dataset_id: The dataset identifier on database
+        :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
+        :param list queries: The queries to complete (from hook)
+        """
+        self.predict(req, resp, dataset_dto, queries)
+
+    def predict(self, req, resp, dataset_dto, queries):
+        """Makes the HTTP response with the predictions of many queries
+
+        All the queries that look for a tail are scored at once, and then
+        all the queries that look for a head.
+        """
+        dataset_dao = data_access.DatasetDAO()
+        predictor, err = dataset_dao.get_link_predictor(dataset_dto)
+        if predictor is None:
+            raise falcon.HTTPConflict(
+                title="Dataset not ready to predict links",
+                description=str(err))
+        dataset, err = dataset_dao.get_vocabulary(dataset_dto)
+        if dataset is None:
+            raise falcon.HTTPNotFound(description=str(err))
+
+        limit = req.get_param_as_int('limit')
+        if limit is None:
+            limit = 10
+        filtered = req.get_param_as_bool('filtered')
+        if filtered is None:
+            filtered = True
+
+        # Translate every query to (position, known entity id, relation id)
+        targets = {"tail": [], "head": []}
+        query_targets, query_entities = [], []
+        for position, query in enumerate(queries):
+            if not isinstance(query, dict) or "relation" not in query or\
+                    ("head" in query) == ("tail" in query):
+                raise falcon.HTTPInvalidParam(
+                    "Each query needs a relation and a head or a tail",
+                    "queries[{}]".format(position))
+            target = "tail" if "head" in query else "head"
+            query_targets.append(target)
+            query_entities.append(query["head"] if target == "tail"
+                                  else query["tail"])
+        # All the entities are looked up at once
+        entity_ids = dataset.get_entity_ids(query_entities)
+        for position, query in enumerate(queries):
+            target, entity = query_targets[position], query_entities[position]
+            entity_id = int(entity_ids[position])
+            relation_id = dataset.get_relation_id(query["relation"])
+            if entity_id < 0 or relation_id is None:
+                raise falcon.HTTPNotFound(
+                    description="The entity {} or the relation {} can't be "
+                    "found inside dataset.".format(entity, query["relation"]))
+            targets[target].append((position, entity_id, relation_id))
+
+        response = [None] * len(queries)
+        predict_fn = {"tail": predictor.predict_tails,
+                      "head": predictor.predict_heads}
+        for target, items in targets.items():
+            if not items:
+                continue
+            positions, entities, relations = zip(*items)
+            with instrumentation.span("predict_" + target + "s"):
+                results = predict_fn[target](entities, relations, k=limit,
+                                             filtered=filtered)
+            for position, result in zip(positions, results):
+                response[position] = {
+                    "query": queries[position],
+                    "target": target,
+                    "predictions": [{"entity": dataset.get_entity(e_id),
+                                     "score": score}
+                                    for e_id, score in result]}
+
+        resp.body = json.dumps({
+            "dataset": dataset_dto.to_dict(),
+            "predictions": {
+                "limit": limit,
+                "filtered": filtered,
+                "response": response
+            }
+        })
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_200
+
+
 class SuggestEntityName():
     @falcon.before(common_hooks.check_dataset_exsistence)
     def on_post(self, req, resp, dataset_id, dataset_dto):
@@ -237,12 +413,12 @@ class SuggestEntityName():
         This method will return suggestions to be used on frontend while users
         input the entity name.
 
-        TODO: this should only return entities that exists on dataset, right
-        now returns all possible entities.
+        Only entities of the dataset are suggested.
 
         :param int dataset_id: The id of the dataset to autocomplete
         :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
         :param str input: The input to autocomplete (from body)
+        :param int limit: The number of suggestions (from body, optional)
         :returns: A list with entities and full text
         :rtype: Object
         """
@@ -251,11 +427,15 @@ class SuggestEntityName():
             input_text = body['input']
         except KeyError as err:
             raise falcon.HTTPMissingParam("input")
-        entity_dao = data_access.EntityDAO(dataset_dto.dataset_type,
-                                           dataset_id)
-
-        # Extract suggestion from elasticsearch
-        suggestion = entity_dao.suggest_entity(input_text)
+        limit = body.get('limit')
+        if limit is not None and (not isinstance(limit, int) or limit < 1):
+            raise falcon.HTTPInvalidParam("A positive integer was expected",
+                                          "limit")
+        entity_dao = data_access.get_entity_dao(dataset_dto.dataset_type,
+                                                dataset_id)
+
+        # Extract suggestion from the autocomplete backend
+        suggestion = entity_dao.suggest_entity(input_text, limit)
 
         # Return a response
         resp.body = json.dumps(suggestion)
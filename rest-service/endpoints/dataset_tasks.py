@@ -21,6 +21,7 @@
 import json
 import copy
 import falcon
+from kgeserver.lazy_import import lazy_import
 import kgeserver.server as server
 import endpoints.common_hooks as common_hooks
 
@@ -29,10 +30,14 @@ import sys
 sys.path.insert(0, '..')
 try:
     import data_access
-    import async_server.tasks as async_tasks
 except ImportError:
     raise
 
+# Celery and the dependencies of the tasks are imported by the first request
+# that uses them
+async_tasks = lazy_import("async_server.tasks")
+kge_algorithm = lazy_import("kgeserver.algorithm")
+
 
 def read_body_generate_triples(req, resp, resource, params):
     try:
@@ -163,8 +168,8 @@ class AutocompleteIndex():
         except KeyError as err:
             raise falcon.HTTPMissingParam("langs")
 
-        entity_dao = data_access.EntityDAO(dataset_dto.dataset_type,
-                                           dataset_id)
+        entity_dao = data_access.get_entity_dao(dataset_dto.dataset_type,
+                                                dataset_id)
         # Call to the task
         task = async_tasks.build_autocomplete_index.delay(dataset_id,
                                                           langs=languages)
@@ -231,3 +236,201 @@ class DatasetTrain():
         resp.body = json.dumps(textbody)
         resp.content_type = 'application/json'
         resp.status = falcon.HTTP_202
+
+
+class DatasetPipeline():
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_post(self, req, resp, dataset_id, dataset_dto):
+        """Refreshes a dataset end to end with a single task
+
+        Crawls the triples, trains the dataset, and generates the search and
+        the autocomplete indexes, as the other tasks do, but loading the
+        dataset only once. Each key of the body is a stage, and the missing
+        ones are skipped:
+
+        {"pipeline":
+            {
+                "generate_triples": {"graph_pattern": "<SPARQL Query>",
+                                     "levels": 2},
+                "algorithm_id": 1,
+                "generate_index": {"n_trees": 100},
+                "generate_autocomplete_index": {"langs": ["en", "es"]}
+            }
+        }
+
+        The task shows the progress of every stage on ``stages``.
+
+        :param id dataset_id: The dataset to refresh
+        :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
+        """
+        body = common_hooks.read_body_as_json(req)
+        try:
+            pipeline = body['pipeline']
+        except (KeyError, TypeError):
+            raise falcon.HTTPMissingParam("pipeline")
+        if not isinstance(pipeline, dict) or not pipeline:
+            raise falcon.HTTPInvalidParam(
+                "At least one stage of the pipeline is required", "pipeline")
+        params = {'dataset_id': dataset_id}
+
+        generate_triples = pipeline.get('generate_triples')
+        if generate_triples is not None:
+            if "graph_pattern" not in generate_triples or \
+                    "levels" not in generate_triples:
+                raise falcon.HTTPInvalidParam(
+                    "The 'generate_triples' JSON object must contain the "
+                    "graph_pattern and levels attributes", "generate_triples")
+            try:
+                generate_triples['levels'] = int(generate_triples['levels'])
+                if generate_triples.get('batch_size') is not None:
+                    generate_triples['batch_size'] = int(
+                        generate_triples['batch_size'])
+            except (ValueError, TypeError):
+                raise falcon.HTTPInvalidParam(
+                    "The 'levels' and 'batch_size' attributes must be "
+                    "integers", "generate_triples")
+
+        algorithm = None
+        if pipeline.get('algorithm_id') is not None:
+            algorithm_dao = data_access.AlgorithmDAO()
+            algorithm, err = algorithm_dao.get_algorithm_by_id(
+                pipeline['algorithm_id'])
+            if algorithm is None:
+                raise falcon.HTTPNotFound(description=str(err))
+
+        # New triples or a new model need an untrained dataset, and the
+        # search index needs a model
+        if generate_triples is not None or algorithm is not None:
+            common_hooks.dataset_untrained_status(req, resp, self, params)
+        n_trees = None
+        if pipeline.get('generate_index') is not None:
+            if algorithm is None and generate_triples is not None:
+                raise falcon.HTTPInvalidParam(
+                    "The dataset must be trained after generating triples "
+                    "to generate the index", "generate_index")
+            if algorithm is None:
+                common_hooks.dataset_trained_status(req, resp, self, params)
+            try:
+                n_trees = int(pipeline['generate_index'].get('n_trees', 100))
+            except (ValueError, TypeError, AttributeError):
+                raise falcon.HTTPInvalidParam(
+                    "The 'n_trees' attribute must be an integer",
+                    "generate_index")
+
+        languages = None
+        if pipeline.get('generate_autocomplete_index') is not None:
+            try:
+                languages = pipeline['generate_autocomplete_index']['langs']
+            except (KeyError, TypeError):
+                raise falcon.HTTPMissingParam("langs")
+            if not isinstance(languages, list):
+                raise falcon.HTTPInvalidParam(
+                    ("A list with languages in ISO 639-1 code was expected"),
+                    "langs")
+
+        # Launch async task
+        task = async_tasks.run_pipeline.delay(
+            dataset_id, generate_triples=generate_triples,
+            algorithm_dict=algorithm, n_trees=n_trees, langs=languages)
+
+        # Create the new task
+        task_dao = data_access.TaskDAO()
+        task_obj, err = task_dao.add_task_by_uuid(task.id)
+        if task_obj is None:
+            raise falcon.HTTPNotFound(description=str(err))
+        task_obj["next"] = "/datasets/" + dataset_id
+        task_dao.update_task(task_obj)
+
+        # Store the task into DatasetDTO
+        dataset_dao = data_access.DatasetDAO()
+        dataset_dao.set_task(dataset_id, task_obj['id'])
+
+        msg = "Task {} created successfuly".format(task_obj['id'])
+        textbody = {"status": 202, "message": msg}
+        resp.location = "/tasks/" + str(task_obj['id'])
+        resp.body = json.dumps(textbody)
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_202
+
+
+class DatasetAlgorithmSearch():
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_post(self, req, resp, dataset_id, dataset_dto):
+        """Looks for the best algorithm to train a dataset
+
+        Every combination of models, margins and embedding sizes is trained
+        and validated on its own task, spread over all the workers, and the
+        best one is saved as a new algorithm:
+
+        {"search":
+            {
+                "models": ["TransE", "HolE"],
+                "margins": [0.2, 1, 2],
+                "embedding_sizes": [50, 100],
+                "max_epochs": 200,
+                "test_all": 10,
+                "patience": 3
+            }
+        }
+
+        The task shows the state and score of every trial on ``trials``, and
+        the new algorithm on ``algorithm`` when it finishes.
+
+        :param id dataset_id: The dataset to search the algorithm for
+        :param DTO dataset_dto: The Dataset DTO from dataset_id (from hook)
+        """
+        body = common_hooks.read_body_as_json(req)
+        try:
+            search = body['search']
+        except (KeyError, TypeError):
+            raise falcon.HTTPMissingParam("search")
+        if not isinstance(search, dict):
+            raise falcon.HTTPInvalidParam("A JSON object was expected",
+                                          "search")
+
+        for param in ("models", "margins", "embedding_sizes"):
+            if param not in search:
+                raise falcon.HTTPMissingParam(param)
+            if not isinstance(search[param], list) or not search[param]:
+                raise falcon.HTTPInvalidParam(
+                    "A list with at least one value was expected", param)
+        for model in search['models']:
+            if model not in kge_algorithm.MODELS:
+                msg = "The model must be one of: {}".format(
+                    ", ".join(sorted(kge_algorithm.MODELS)))
+                raise falcon.HTTPInvalidParam(msg, "models")
+        try:
+            search['margins'] = [float(m) for m in search['margins']]
+            search['embedding_sizes'] = [int(e) for e in
+                                         search['embedding_sizes']]
+            search['max_epochs'] = int(search.get('max_epochs', 200))
+            for param in ("test_all", "patience", "eval_seconds"):
+                if search.get(param) is not None:
+                    search[param] = int(search[param])
+        except (ValueError, TypeError):
+            raise falcon.HTTPInvalidParam(
+                "The margins must be numbers, and the embedding_sizes, "
+                "max_epochs, test_all, patience and eval_seconds integers",
+                "search")
+
+        # Launch async task
+        task = async_tasks.search_algorithm.delay(dataset_id, search)
+
+        # Create the new task
+        task_dao = data_access.TaskDAO()
+        task_obj, err = task_dao.add_task_by_uuid(task.id)
+        if task_obj is None:
+            raise falcon.HTTPNotFound(description=str(err))
+        task_obj["next"] = "/algorithms/"
+        task_dao.update_task(task_obj)
+
+        # Store the task into DatasetDTO
+        dataset_dao = data_access.DatasetDAO()
+        dataset_dao.set_task(dataset_id, task_obj['id'])
+
+        msg = "Task {} created successfuly".format(task_obj['id'])
+        textbody = {"status": 202, "message": msg}
+        resp.location = "/tasks/" + str(task_obj['id'])
+        resp.body = json.dumps(textbody)
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_202
@@ -20,7 +20,10 @@
 
 import json
 import copy
+import zlib
+import numpy as np
 import falcon
+from kgeserver.lazy_import import lazy_import
 import kgeserver.server as server
 import endpoints.common_hooks as common_hooks
 
@@ -29,10 +32,13 @@ import sys
 sys.path.insert(0, '..')
 try:
     import data_access
-    import async_server.tasks as async_tasks
 except ImportError:
     raise
 
+# Celery and the dependencies of the tasks are imported by the first request
+# that uses them
+async_tasks = lazy_import("async_server.tasks")
+
 
 def read_http_dataset_dto(req, resp, resource, params):
     """Returns a HTTPUserDatasetDTO"""
@@ -108,12 +114,28 @@ class DatasetResource(object):
 
         :param integer dataset_id: Unique ID of dataset
         :param integer dataset_dto: Dataset DTO (from hook)
+        :query boolean use_cache: False if statistics must be computed again
         :returns: The selected dataset
         :rtype: DatasetDTO
         """
+        cache = req.get_param_as_bool("use_cache", blank_as_true=True)
+        if cache is None:
+            cache = True
+
+        dataset_dao = data_access.DatasetDAO()
+        statistics, err = dataset_dao.get_dataset_statistics(
+            dataset_dto, use_cache=cache)
+
         response = {
             "dataset": dataset_dto.to_dict(),
         }
+        if statistics is not None:
+            response["dataset"]["statistics"] = statistics
+        else:
+            # The dataset is returned anyway, telling why there are none
+            print("Statistics of dataset {} not returned: {}".format(
+                dataset_id, err))
+            response["dataset"]["statistics_error"] = err[1]
         resp.body = json.dumps(response)
         resp.content_type = 'application/json'
         resp.status = falcon.HTTP_200
@@ -228,6 +250,8 @@ class DatasetFactory(object):
 
 
 class EmbeddingResource():
+    # Responses only depend on the request and the dataset files
+    cache_responses = True
 
     @falcon.before(read_vector_from_body)
     @falcon.before(common_hooks.check_dataset_exsistence)
@@ -264,7 +288,160 @@ class EmbeddingResource():
         resp.status = falcon.HTTP_200
 
 
+# Triples of a page of GET /datasets/{id}/triples, by default and at most.
+# Sync workers are killed if a response takes longer than their timeout
+TRIPLES_PAGE = 100000
+MAX_TRIPLES_PAGE = 1000000
+
+
+def _format_triples(rows, vocab, triples_format):
+    """Writes a chunk of triples on NDJSON or N-Triples lines
+
+    Each entity and relation of the chunk is translated only once.
+    """
+    entities = dict((int(id), vocab.get_entity(int(id)))
+                    for id in np.unique(rows[:, :2]))
+    relations = dict((int(id), vocab.get_relation(int(id)))
+                     for id in np.unique(rows[:, 2]))
+    if triples_format == "ntriples":
+        line = "<{}> <{}> <{}> .\n"
+        return "".join(line.format(entities[s], relations[p], entities[o])
+                       for s, o, p in rows.tolist())
+    return "".join(json.dumps({"subject": entities[s],
+                               "predicate": relations[p],
+                               "object": entities[o]}) + "\n"
+                   for s, o, p in rows.tolist())
+
+
+def _format_cursor(cursor, triples_format):
+    """Writes the cursor of the next page on the last line of a page"""
+    if triples_format == "ntriples":
+        return "# next_cursor: {}\n".format(cursor)
+    return json.dumps({"next_cursor": cursor}) + "\n"
+
+
+def _stream_triples(split, vocab, start, limit, filters, triples_format,
+                    gzip=False):
+    """Yields the encoded chunks of a page of triples
+
+    The triples are read only once: the cursor of the next page is written
+    after them, when the page is full.
+
+    :param SplitDataset split: The triples of the dataset
+    :param DatasetVocabulary vocab: The vocabulary of the dataset
+    :param tuple start: The split and position of the first triple
+    :param int limit: The triples of the page
+    :param dict filters: The relation and entity filters of split.scan
+    :param str triples_format: ndjson or ntriples
+    :param bool gzip: Compress the chunks with gzip
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+    for index, positions, rows in split.scan(start, **filters):
+        rows = rows[:limit]
+        limit -= len(rows)
+        chunk = ""
+        if len(rows):
+            chunk = _format_triples(rows, vocab, triples_format)
+        if limit == 0:
+            next_start = index, int(positions[len(rows) - 1]) + 1
+            chunk += _format_cursor(split.cursor(next_start), triples_format)
+        chunk = chunk.encode("utf-8")
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+        if limit == 0:
+            break
+    if compressor is not None:
+        yield compressor.flush()
+
+
 class TriplesResource():
+    @falcon.before(common_hooks.check_dataset_exsistence)
+    def on_get(self, req, resp, dataset_id, dataset_dto):
+        """Exports the triples of the dataset, a page at a time
+
+        The triples are read from the memory mapped arrays of the dataset
+        and written while they are read, so the dataset is never loaded on
+        the worker. Each line is a triple, as a JSON object with *subject*,
+        *predicate* and *object* (``format=ndjson``, the default) or in
+        N-Triples (``format=ntriples``). The response is compressed if the
+        request accepts the gzip encoding.
+
+        A full page ends with the *cursor* of the next page, on a
+        ``{"next_cursor": ...}`` line or a ``# next_cursor: ...`` comment.
+        The cursor stays valid while triples are inserted, and a 409 is
+        returned if the triples of the dataset change in any other way.
+
+        :query str cursor: The cursor of the page (the first by default)
+        :query int limit: The triples of the page (100000 by default)
+        :query str relation: Only the triples of this relation
+        :query str entity: Only the triples with this entity as subject or
+                           object
+        :query str format: ndjson or ntriples
+        :param integer dataset_id: Unique ID of dataset
+        :param integer dataset_dto: Dataset DTO (from hook)
+        """
+        limit = req.get_param_as_int('limit')
+        if limit is None:
+            limit = TRIPLES_PAGE
+        if limit < 1 or limit > MAX_TRIPLES_PAGE:
+            raise falcon.HTTPInvalidParam(
+                "The limit must be between 1 and {}".format(MAX_TRIPLES_PAGE),
+                "limit")
+        triples_format = req.get_param('format') or "ndjson"
+        if triples_format not in ("ndjson", "ntriples"):
+            raise falcon.HTTPInvalidParam(
+                "The format must be ndjson or ntriples", "format")
+
+        dataset_dao = data_access.DatasetDAO()
+        split, err = dataset_dao.get_split_dataset(dataset_dto)
+        if split is None:
+            raise falcon.HTTPNotFound(description=str(err))
+        start = (0, 0)
+        if req.get_param('cursor') is not None:
+            try:
+                start = split.parse_cursor(req.get_param('cursor'))
+            except ValueError:
+                raise falcon.HTTPInvalidParam(
+                    "The cursor must be the next_cursor of a page", "cursor")
+            if start is None:
+                raise falcon.HTTPConflict(
+                    title="Cursor expired",
+                    description=("The triples of the dataset have changed. "
+                                 "Start again from the first page"))
+        # The vocabulary is newer than the split, so it knows all its ids
+        vocab, err = dataset_dao.get_vocabulary(dataset_dto)
+        if vocab is None:
+            raise falcon.HTTPNotFound(description=str(err))
+
+        filters = {}
+        unknown = False
+        if req.get_param('relation') is not None:
+            filters['relation'] = vocab.get_relation_id(
+                req.get_param('relation'))
+            unknown = filters['relation'] is None
+        if req.get_param('entity') is not None:
+            filters['entity'] = vocab.get_entity_id(req.get_param('entity'))
+            unknown = unknown or filters['entity'] is None
+
+        if triples_format == "ntriples":
+            resp.content_type = 'application/n-triples'
+        else:
+            resp.content_type = 'application/x-ndjson'
+        resp.status = falcon.HTTP_200
+        if unknown:
+            # Nothing can match an element that is not on the dataset
+            resp.body = ""
+            return
+
+        gzip = 'gzip' in (req.get_header('Accept-Encoding') or "")
+        if gzip:
+            resp.set_header('Content-Encoding', 'gzip')
+        resp.set_header('Vary', 'Accept-Encoding')
+        resp.stream = _stream_triples(split, vocab, start, limit, filters,
+                                      triples_format, gzip)
+
     @falcon.before(common_hooks.check_dataset_exsistence)
     @falcon.before(read_triples_from_body)
     def on_post(self, req, resp, dataset_id, dataset_dto, triples_list):
@@ -286,6 +463,12 @@ class TriplesResource():
                     "object": "Q29"}
             ]
 
+        The triples are appended to the delta log of the dataset. When the
+        log grows over the limit, a task merges it on the binary dataset and
+        builds again the vocabulary, the statistics and the triples exported.
+        They show the new triples when it finishes. If one of the triples is
+        not valid, none of them is added.
+
         :param integer dataset_id: Unique ID of dataset
         :param integer dataset_dto: Dataset DTO (from hook)
         :param list triples_list: List of triples to insert (from hook)
@@ -296,6 +479,8 @@ class TriplesResource():
         res, err = dataset_dao.insert_triples(dataset_dto, triples_list)
         if res is None:
             raise falcon.HTTPBadRequest(description=str(err))
+        if res:
+            async_tasks.compact_triples.delay(dataset_id)
 
         textbody = {"status": 202, "message": "Resources created successfuly"}
         resp.body = json.dumps(textbody)
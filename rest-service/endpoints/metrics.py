@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# metrics.py: Falcon file to expose the service metrics
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import falcon
+
+# Import parent directory (instrumentation)
+import sys
+sys.path.insert(0, '..')
+try:
+    import instrumentation
+except ImportError:
+    raise
+
+
+class MetricsResource():
+
+    def on_get(self, req, resp):
+        """Return the metrics of all workers in Prometheus text format
+
+        :returns: The metrics in text exposition format
+        :rtype: str
+        """
+        resp.body = instrumentation.registry.render()
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.status = falcon.HTTP_200
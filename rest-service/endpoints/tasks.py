@@ -21,6 +21,7 @@
 import json
 import copy
 import falcon
+from kgeserver.lazy_import import lazy_import
 import kgeserver.server as server
 
 # Import parent directory (data_access)
@@ -28,11 +29,12 @@ import sys
 sys.path.insert(0, '..')
 try:
     import data_access
-    import async_server.tasks as async_tasks
-    import async_server.celery as celery_server
 except ImportError:
     raise
 
+# Celery is imported by the first request that uses it
+celery_server = lazy_import("async_server.celery")
+
 
 class TasksResource():
 
@@ -57,6 +59,25 @@ class TasksResource():
         except Exception:
             pass
 
+        # Progress and telemetry stored by the task while it is running
+        celery_uuid = "celery-task-progress-" + task_obj['celery_uuid']
+        redis = data_access.get_redis_backend()
+        task_progress = redis.get(celery_uuid)
+
+        try:
+            if "telemetry" in task_progress:
+                task["telemetry"] = task_progress["telemetry"]
+            # Pipelines show the progress of each stage
+            if "stages" in task_progress:
+                task["stages"] = task_progress["stages"]
+            # Searches show every trial, and the algorithm found
+            if "trials" in task_progress:
+                task["trials"] = task_progress["trials"]
+            if "algorithm" in task_progress:
+                task["algorithm"] = task_progress["algorithm"]
+        except TypeError:
+            pass
+
         if t_uuid.state == "SUCCESS":
             # Look if exists some next
             if "next" in task_obj and task_obj["next"] is not None:
@@ -72,11 +93,6 @@ class TasksResource():
 
         elif t_uuid.state == "STARTED":
             # Get task progress and show to the user
-            celery_uuid = "celery-task-progress-" + task_obj['celery_uuid']
-
-            redis = data_access.RedisBackend()
-            task_progress = redis.get(celery_uuid)
-
             try:
                 if "progress" in task_progress:
                     task["progress"] = task_progress["progress"]
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# instrumentation.py: Request metrics shared between gunicorn workers
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import json
+import glob
+import time
+import fcntl
+import socket
+import tempfile
+import threading
+import contextlib
+
+# Name of each metric: (type, help)
+METRICS = {
+    'kgeserver_http_requests_total': (
+        'counter', 'HTTP requests processed, by route, method and status'),
+    'kgeserver_http_request_errors_total': (
+        'counter', 'HTTP requests that ended with a 5xx status or exception'),
+    'kgeserver_http_request_duration_seconds': (
+        'histogram', 'Latency of HTTP requests, by route and method'),
+    'kgeserver_http_requests_in_flight': (
+        'gauge', 'HTTP requests being processed right now'),
+    'kgeserver_span_duration_seconds': (
+        'histogram', 'Duration of internal operations, by span name'),
+    'kgeserver_cache_requests_total': (
+        'counter', 'Cache lookups, by cache name and result (hit or miss)'),
+}
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Minimum seconds between two dumps of the metrics of a worker
+FLUSH_INTERVAL = 1.0
+
+# Seconds between two dumps of the metrics of an idle worker. The
+# modification time of its file tells the other workers it is alive
+HEARTBEAT_INTERVAL = 15.0
+
+# Workers that have not saved their metrics for this long are dead
+WORKER_TIMEOUT = 4 * HEARTBEAT_INTERVAL
+
+# File with the counters and histograms of the workers already dead
+AGGREGATE_FILE = "aggregate.json"
+
+
+def _CONFIG_get_metrics_path():
+    """Directory where every worker saves its metrics. Must be shared
+    between all workers of the same service.
+    """
+    try:
+        return os.environ["METRICS_PATH"]
+    except KeyError:
+        return os.path.join(tempfile.gettempdir(), "kgeserver-metrics")
+
+
+def _labels_key(labels):
+    """Returns a hashable and JSON friendly representation of labels"""
+    return tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, _escape(v))
+                          for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _read_snapshot(file_name):
+    """Reads the metrics saved on a file, or None if it can't be read"""
+    try:
+        with open(file_name) as snapshot_file:
+            return json.load(snapshot_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_snapshot(file_name, snapshot):
+    """Writes the metrics on a temporary file that replaces file_name
+
+    Readers will never find a half written file.
+    """
+    tmp_name = "{0}.{1}.tmp".format(file_name, threading.get_ident())
+    with open(tmp_name, "w") as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(tmp_name, file_name)
+
+
+def _merge_snapshot(snapshot, counters, gauges, histograms):
+    """Adds the metrics of a snapshot to the merged ones
+
+    :param dict snapshot: The metrics of a worker, as saved on its file
+    :param dict counters: The merged counters, updated
+    :param dict gauges: The merged gauges, updated. None to skip them
+    :param dict histograms: The merged histograms, updated
+    """
+    for name, labels, value in snapshot["counters"]:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        counters[key] = counters.get(key, 0) + value
+    if gauges is not None:
+        for name, labels, value in snapshot.get("gauges", []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            gauges[key] = gauges.get(key, 0) + value
+    for name, labels, value in snapshot["histograms"]:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        hist = histograms.setdefault(
+            key, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+        for i, bucket in enumerate(value["buckets"]):
+            hist["buckets"][i] += bucket
+        hist["sum"] += value["sum"]
+        hist["count"] += value["count"]
+
+
+class MetricsRegistry(object):
+    """Stores the metrics of the current process
+
+    Each worker process keeps its metrics in memory and dumps them
+    periodically into a JSON file inside a directory shared by all workers
+    (``METRICS_PATH``). When metrics are rendered, every file is read and
+    merged, so the values are the sum of all workers, no matter which
+    worker has answered the request. A worker that has not saved its file
+    for WORKER_TIMEOUT seconds is dead, and its file is merged on a single
+    aggregate file, so the directory does not grow with every restart.
+
+    All methods are thread safe, because gunicorn workers may serve
+    several requests at the same time using threads.
+    """
+    def __init__(self, path=None):
+        self.path = path or _CONFIG_get_metrics_path()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.last_flush = 0
+        self.started = int(time.time())
+        self.heartbeat_pid = None
+
+    def inc(self, name, labels={}, value=1):
+        """Increments a counter or a gauge
+
+        :param str name: The name of the metric
+        :param dict labels: The labels of the metric
+        :param float value: The amount to increment
+        """
+        key = (name, _labels_key(labels))
+        store = self.gauges if METRICS[name][0] == 'gauge' else self.counters
+        with self.lock:
+            store[key] = store.get(key, 0) + value
+
+    def dec(self, name, labels={}, value=1):
+        """Decrements a gauge"""
+        self.inc(name, labels, -value)
+
+    def observe(self, name, value, labels={}):
+        """Adds an observation to a histogram
+
+        :param str name: The name of the metric
+        :param float value: The observed value, usually seconds
+        :param dict labels: The labels of the metric
+        """
+        key = (name, _labels_key(labels))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = {"buckets": [0] * len(BUCKETS), "sum": 0.0,
+                        "count": 0}
+                self.histograms[key] = hist
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Measures the time spent inside a with block
+
+        :param str name: The name of the operation measured
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe('kgeserver_span_duration_seconds',
+                         time.time() - start, {"span": name})
+
+    def snapshot(self):
+        """Returns all metrics of this process as a JSON friendly dict"""
+        with self.lock:
+            return {
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "counters": [[k[0], k[1], v]
+                             for k, v in self.counters.items()],
+                "gauges": [[k[0], k[1], v] for k, v in self.gauges.items()],
+                "histograms": [[k[0], k[1],
+                                dict(v, buckets=list(v["buckets"]))]
+                               for k, v in self.histograms.items()]
+            }
+
+    def flush(self, force=False):
+        """Saves the metrics of this process on the shared directory
+
+        The first flush of every process starts its heartbeat.
+
+        :param bool force: Save even if last dump was done recently
+        """
+        if self.heartbeat_pid != os.getpid():
+            self._start_heartbeat()
+        now = time.time()
+        if not force and now - self.last_flush < FLUSH_INTERVAL:
+            return
+        self.last_flush = now
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            file_name = os.path.join(
+                self.path, "worker_{0}_{1}_{2}.json".format(
+                    socket.gethostname(), os.getpid(), self.started))
+            _write_snapshot(file_name, self.snapshot())
+        except OSError as err:
+            print("Metrics couldn't be saved: {}".format(err))
+
+    def _start_heartbeat(self):
+        """Starts a thread that saves the metrics while the worker is idle
+
+        PIDs can't tell if a worker is alive: they are reused, and workers
+        on other containers sharing the directory have their own PIDs. The
+        modification time of the file of each worker is used instead.
+        Threads do not survive a fork, so each process starts its own.
+        """
+        self.heartbeat_pid = os.getpid()
+        thread = threading.Thread(target=self._heartbeat, daemon=True)
+        thread.start()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            self.flush(force=True)
+
+    def fold_dead_workers(self):
+        """Merges the files of dead workers on the aggregate file
+
+        The files are removed after, so each scrape only reads the files
+        of live workers and the aggregate. A lock file keeps workers
+        serving /metrics at the same time from merging a file twice.
+        """
+        now = time.time()
+        dead = []
+        for file_name in glob.glob(os.path.join(self.path, "worker_*.json")):
+            try:
+                if now - os.stat(file_name).st_mtime > WORKER_TIMEOUT:
+                    dead.append(file_name)
+            except FileNotFoundError:
+                continue
+        if not dead:
+            return
+
+        aggregate_name = os.path.join(self.path, AGGREGATE_FILE)
+        try:
+            with open(aggregate_name + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    counters, histograms, folded = {}, {}, []
+                    aggregate = _read_snapshot(aggregate_name)
+                    if aggregate is not None:
+                        _merge_snapshot(aggregate, counters, None,
+                                        histograms)
+                    for file_name in dead:
+                        # Already merged by another worker, if missing
+                        snapshot = _read_snapshot(file_name)
+                        if snapshot is not None:
+                            _merge_snapshot(snapshot, counters, None,
+                                            histograms)
+                            folded.append(file_name)
+                    if not folded:
+                        return
+                    _write_snapshot(aggregate_name, {
+                        "counters": [[k[0], k[1], v]
+                                     for k, v in counters.items()],
+                        "histograms": [[k[0], k[1], v]
+                                       for k, v in histograms.items()]
+                    })
+                    for file_name in folded:
+                        os.remove(file_name)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        except OSError as err:
+            print("Metrics of dead workers couldn't be merged: {}".format(
+                err))
+
+    def collect(self):
+        """Merges the metrics of all workers
+
+        Counters and histograms of workers that have already finished are
+        kept on the aggregate file, so totals never decrease. Gauges only
+        include live workers.
+
+        :return: Counters, gauges and histograms merged
+        :rtype: tuple
+        """
+        self.flush(force=True)
+        self.fold_dead_workers()
+        counters, gauges, histograms = {}, {}, {}
+        aggregate = _read_snapshot(os.path.join(self.path, AGGREGATE_FILE))
+        if aggregate is not None:
+            _merge_snapshot(aggregate, counters, None, histograms)
+        for file_name in glob.glob(os.path.join(self.path, "worker_*.json")):
+            snapshot = _read_snapshot(file_name)
+            if snapshot is not None:
+                _merge_snapshot(snapshot, counters, gauges, histograms)
+        return counters, gauges, histograms
+
+    def render(self):
+        """Returns the metrics of all workers in text exposition format
+
+        :rtype: str
+        """
+        counters, gauges, histograms = self.collect()
+        lines = []
+        for name in sorted(METRICS):
+            metric_type, help_text = METRICS[name]
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} {1}".format(name, metric_type))
+            if metric_type == 'histogram':
+                for key in sorted(k for k in histograms if k[0] == name):
+                    hist = histograms[key]
+                    for bound, count in zip(BUCKETS, hist["buckets"]):
+                        le_label = [("le", repr(bound))]
+                        lines.append("{0}_bucket{1} {2}".format(
+                            name, _format_labels(key[1], le_label),
+                            _format_value(count)))
+                    lines.append("{0}_bucket{1} {2}".format(
+                        name, _format_labels(key[1], [("le", "+Inf")]),
+                        _format_value(hist["count"])))
+                    lines.append("{0}_sum{1} {2}".format(
+                        name, _format_labels(key[1]),
+                        _format_value(hist["sum"])))
+                    lines.append("{0}_count{1} {2}".format(
+                        name, _format_labels(key[1]),
+                        _format_value(hist["count"])))
+            else:
+                store = gauges if metric_type == 'gauge' else counters
+                for key in sorted(k for k in store if k[0] == name):
+                    lines.append("{0}{1} {2}".format(
+                        name, _format_labels(key[1]),
+                        _format_value(store[key])))
+        return "\n".join(lines) + "\n"
+
+
+# The registry of this process
+registry = MetricsRegistry()
+span = registry.span
+
+
+class MetricsMiddleware(object):
+    """Falcon middleware that measures every request"""
+
+    def process_request(self, req, resp):
+        req.context['metrics_start'] = time.time()
+        req.context['metrics_route'] = 'unknown'
+        registry.inc('kgeserver_http_requests_in_flight')
+
+    def process_resource(self, req, resp, resource, params):
+        # Route template if Falcon provides it, otherwise the resource name
+        route = getattr(req, 'uri_template', None)
+        if not route and resource is not None:
+            route = resource.__class__.__name__
+        req.context['metrics_route'] = route or 'unknown'
+
+    def process_response(self, req, resp, resource, req_succeeded=True):
+        try:
+            start = req.context['metrics_start']
+        except KeyError:
+            return
+        elapsed = time.time() - start
+        route = req.context.get('metrics_route', 'unknown')
+        status = str(resp.status).split(" ")[0]
+
+        registry.dec('kgeserver_http_requests_in_flight')
+        registry.observe('kgeserver_http_request_duration_seconds', elapsed,
+                         {"route": route, "method": req.method})
+        registry.inc('kgeserver_http_requests_total',
+                     {"route": route, "method": req.method,
+                      "status": status})
+        if not req_succeeded or status.startswith("5"):
+            registry.inc('kgeserver_http_request_errors_total',
+                         {"route": route, "method": req.method})
+        registry.flush()
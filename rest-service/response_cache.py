@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# response_cache.py: ETags and in-process cache of prediction responses
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import io
+import os
+import threading
+import collections
+import falcon
+import data_access
+from instrumentation import registry
+
+
+def _CONFIG_get_response_cache_bytes():
+    """Memory used by the responses cached on each worker. 0 disables it"""
+    try:
+        return int(os.environ["RESPONSE_CACHE_BYTES"])
+    except (KeyError, ValueError):
+        return 64 * 1024 * 1024
+
+
+class ResponseCache(object):
+    """A LRU cache of response bodies, bounded by their size
+
+    All methods are thread safe.
+    """
+    def __init__(self, max_bytes):
+        """Creates an empty cache
+
+        :param int max_bytes: The size of all bodies cached. Bodies bigger
+                              than a quarter of this size are not cached
+        """
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the (body, content_type) cached for a key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, content_type):
+        """Caches a response body, removing the least recently used ones"""
+        size = len(body)
+        if size * 4 > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.used_bytes -= len(old[0])
+            self.entries[key] = (body, content_type)
+            self.used_bytes += size
+            while self.used_bytes > self.max_bytes:
+                _, (old_body, _) = self.entries.popitem(last=False)
+                self.used_bytes -= len(old_body)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used_bytes = 0
+
+
+# The cache of this process
+cache = ResponseCache(_CONFIG_get_response_cache_bytes())
+
+
+def _etag_matches(header, etag):
+    """Checks an If-None-Match header against an ETag"""
+    if header is None:
+        return False
+    for value in header.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        if value == "*" or value == etag:
+            return True
+    return False
+
+
+class ResponseCacheMiddleware(object):
+    """Falcon middleware that caches the responses of prediction resources
+
+    Only resources with a true ``cache_responses`` attribute and a
+    ``dataset_id`` param are cached. Their responses must only depend on the
+    request and on the files of the dataset (see
+    DatasetDAO.get_artifact_version), which give the ETag of the response.
+
+    A GET request with a matching ``If-None-Match`` header gets a 304 status.
+    Other requests are answered from the cache of the worker, using the
+    method, path, sorted query params and body as key.
+    """
+    def __init__(self, response_cache=None):
+        self.cache = response_cache or cache
+
+    def process_resource(self, req, resp, resource, params):
+        if not getattr(resource, 'cache_responses', False) or \
+                'dataset_id' not in params or \
+                req.method not in ('GET', 'POST'):
+            return
+        version, err = data_access.DatasetDAO().get_artifact_version(
+            params['dataset_id'])
+        if version is None:
+            return
+        etag = '"{}"'.format(version)
+        req.context['cache_etag'] = etag
+
+        if req.method == 'GET' and \
+                _etag_matches(req.get_header('If-None-Match'), etag):
+            registry.inc('kgeserver_cache_requests_total',
+                         {"cache": "etag", "result": "hit"})
+            resp.status = falcon.HTTP_304
+            resp.etag = etag
+            resp.complete = True
+            return
+
+        if self.cache.max_bytes <= 0:
+            return
+        body = b""
+        if req.method == 'POST':
+            # The body is read again by the resource
+            body = req.stream.read()
+            req.stream = io.BytesIO(body)
+        query = tuple(sorted((key, str(value))
+                             for key, value in req.params.items()))
+        key = (version, req.method, req.path, query, body)
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            registry.inc('kgeserver_cache_requests_total',
+                         {"cache": "responses", "result": "hit"})
+            resp.data, resp.content_type = entry
+            resp.status = falcon.HTTP_200
+            resp.etag = etag
+            resp.complete = True
+            return
+        registry.inc('kgeserver_cache_requests_total',
+                     {"cache": "responses", "result": "miss"})
+        req.context['cache_key'] = key
+
+    def process_response(self, req, resp, resource, req_succeeded=True):
+        if 'cache_etag' in req.context and req_succeeded and \
+                resp.status == falcon.HTTP_200:
+            resp.etag = req.context['cache_etag']
+        key = req.context.get('cache_key')
+        if key is None or not req_succeeded or \
+                resp.status != falcon.HTTP_200 or resp.body is None:
+            return
+        body = resp.body
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.cache.put(key, body, resp.content_type)
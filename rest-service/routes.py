@@ -23,9 +23,8 @@ import copy
 import falcon
 from falcon_cors import CORS
 import data_access
-import kgeserver.server as server
-import async_server.tasks as async_tasks
-import async_server.celery as celery_server
+import instrumentation
+import response_cache
 import logging
 
 from endpoints.datasets import (DatasetFactory,
@@ -35,19 +34,25 @@ from endpoints.datasets import (DatasetFactory,
 from endpoints.dataset_tasks import (GenerateTriplesResource,
                                      AutocompleteIndex,
                                      DatasetIndex,
-                                     DatasetTrain)
+                                     DatasetTrain,
+                                     DatasetPipeline,
+                                     DatasetAlgorithmSearch)
 from endpoints.dataset_prediction import (PredictSimilarEntitiesResource,
                                           DistanceTriples,
+                                          PredictLinksResource,
                                           SuggestEntityName)
 from endpoints.algorithms import AlgorithmFactory, AlgorithmResource
 from endpoints.tasks import TasksResource
+from endpoints.metrics import MetricsResource
 
 # CORS
 cors = CORS(allow_all_origins=True, allow_all_headers=True,
             allow_all_methods=True, expose_headers_list=['*'])
 
 # falcon.API instances are callable WSGI apps
-app = falcon.API(middleware=[cors.middleware])
+app = falcon.API(middleware=[cors.middleware,
+                             instrumentation.MetricsMiddleware(),
+                             response_cache.ResponseCacheMiddleware()])
 
 # Resources are represented by long-lived class instances
 dataset = DatasetResource()
@@ -56,12 +61,16 @@ similar_entities = PredictSimilarEntitiesResource()
 triples = TriplesResource()
 gentriples = GenerateTriplesResource()
 triples_distance = DistanceTriples()
+predict_links = PredictLinksResource()
 dataset_train = DatasetTrain()
 dataset_index = DatasetIndex()
+dataset_pipeline = DatasetPipeline()
+dataset_search = DatasetAlgorithmSearch()
 dataset_embedding = EmbeddingResource()
 autocompleteIndex = AutocompleteIndex()
 task_resource = TasksResource()
 suggest_name = SuggestEntityName()
+metrics_resource = MetricsResource()
 
 algorithm_resource = AlgorithmResource()
 algorithm_factory = AlgorithmFactory()
@@ -75,8 +84,11 @@ app.add_route('/datasets/{dataset_id}/distance', triples_distance)
 app.add_route('/datasets/{dataset_id}/similar_entities/{entity}',
               similar_entities)
 app.add_route('/datasets/{dataset_id}/similar_entities', similar_entities)
+app.add_route('/datasets/{dataset_id}/predict', predict_links)
 app.add_route('/datasets/{dataset_id}/train', dataset_train)
 app.add_route('/datasets/{dataset_id}/generate_index', dataset_index)
+app.add_route('/datasets/{dataset_id}/pipeline', dataset_pipeline)
+app.add_route('/datasets/{dataset_id}/search_algorithm', dataset_search)
 app.add_route('/datasets/{dataset_id}/embeddings', dataset_embedding)
 app.add_route('/datasets/{dataset_id}/generate_autocomplete_index',
               autocompleteIndex)
@@ -87,3 +99,5 @@ app.add_route('/tasks/{task_id}', task_resource)
 
 app.add_route('/algorithms/{algorithm_id}', algorithm_resource)
 app.add_route('/algorithms/', algorithm_factory)
+
+app.add_route('/metrics', metrics_resource)
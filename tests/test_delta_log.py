@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# test_delta_log.py: Tests of the delta log of inserted triples
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import contextlib
+import kgeserver.dataset as dataset
+import kgeserver.delta_log as delta_log
+
+
+class DeltaLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "dataset.bin")
+        dtset = dataset.Dataset()
+        for i in range(20):
+            dtset.add_triple("e{}".format(i), "e{}".format(i + 1), "r")
+        self.save(dtset)
+        self.log = delta_log.DeltaLog(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, dtset):
+        # The dataset prints itself when saved
+        with contextlib.redirect_stdout(io.StringIO()):
+            dtset.save_to_binary(self.path)
+
+    def load(self, with_delta=True):
+        dtset = dataset.Dataset()
+        with contextlib.redirect_stdout(io.StringIO()):
+            dtset.load_from_binary(self.path, with_delta=with_delta)
+        return dtset
+
+    def test_append(self):
+        self.assertEqual(self.log.size(), 0)
+        self.assertEqual(self.log.read(), [])
+        size_before, size = self.log.append([("a", "b", "r")])
+        self.assertEqual(size_before, 0)
+        self.assertEqual(size, self.log.size())
+        self.log.append([("b", "c", "r"), ("c", "a", "s")])
+        self.assertEqual(self.log.read(), [("a", "b", "r"), ("b", "c", "r"),
+                                           ("c", "a", "s")])
+
+    def test_unfinished_batch(self):
+        self.log.append([("a", "b", "r")])
+        # A process died while writing a batch
+        with open(self.log.path, "a") as log:
+            log.write('{"triples": [["x", "y"')
+        self.log.append([("b", "c", "r")])
+        self.assertEqual(self.log.read(), [("a", "b", "r"), ("b", "c", "r")])
+
+    def test_load_with_delta(self):
+        self.log.append([("e0", "new", "r"), ("e0", "e1", "r")])
+        dtset = self.load()
+        # The triple already on the dataset is skipped
+        self.assertEqual(len(dtset.subs), 21)
+        split = dtset.train_split()
+        self.assertEqual(sum(len(subs) for subs in split.values()), 21)
+        self.assertIn("new", dtset.entities)
+        self.assertEqual(len(self.load(with_delta=False).subs), 20)
+
+    def test_compact(self):
+        self.log.append([("e0", "new", "r"), ("new", "e5", "s")])
+        before = self.load().train_split()
+        self.assertEqual(self.log.compact(), 2)
+        self.assertEqual(self.log.read(), [])
+        self.assertFalse(os.path.exists(self.log.compacting_path))
+        dtset = self.load(with_delta=False)
+        self.assertEqual(len(dtset.subs), 22)
+        # Every triple stays on its split
+        self.assertEqual(dtset.train_split(), before)
+        self.assertEqual(self.log.compact(), 0)
+
+    def test_inserts_while_compacting(self):
+        self.log.append([("e0", "new", "r")])
+        self.assertTrue(self.log._start_compaction())
+        self.log.append([("new", "e5", "r")])
+        self.assertEqual(self.log.read(), [("e0", "new", "r"),
+                                           ("new", "e5", "r")])
+        self.assertEqual(len(self.load().subs), 22)
+        # The compacting file left is merged first
+        self.assertEqual(self.log.compact(), 1)
+        self.assertEqual(self.log.read(), [("new", "e5", "r")])
+        self.assertEqual(len(self.load().subs), 22)
+
+    def test_cancelled_compaction(self):
+        self.log.append([("e0", "new", "r")])
+        load_from_binary = dataset.Dataset.load_from_binary
+
+        def replace_dataset(dtset, *args, **kwargs):
+            result = load_from_binary(dtset, *args, **kwargs)
+            # Other task replaces the dataset during the compaction
+            other = dataset.Dataset()
+            other.add_triple("a", "b", "r")
+            time.sleep(0.01)
+            self.save(other)
+            return result
+
+        dataset.Dataset.load_from_binary = replace_dataset
+        try:
+            merged = self.log.compact()
+        finally:
+            dataset.Dataset.load_from_binary = load_from_binary
+        self.assertIsNone(merged)
+        self.assertEqual(self.log.read(), [("e0", "new", "r")])
+        self.assertEqual(len(self.load(with_delta=False).subs), 1)
+
+    def test_schedule_compaction(self):
+        self.assertTrue(self.log.schedule_compaction())
+        self.assertFalse(self.log.schedule_compaction())
+        self.log.unschedule_compaction()
+        self.assertTrue(self.log.schedule_compaction())
+        # A compaction scheduled long ago was lost
+        old = time.time() - delta_log.DeltaLog.SCHEDULED_TIMEOUT - 1
+        os.utime(self.log.scheduled_path, (old, old))
+        self.assertTrue(self.log.schedule_compaction())
+        self.assertFalse(self.log.schedule_compaction())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# test_graph_statistics.py: Tests of kgeserver.graph_statistics
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import unittest
+import numpy as np
+import kgeserver.graph_statistics as graph_statistics
+
+
+def random_triples(n_triples, n_entities, n_relations, seed=0):
+    """Random (subject, object, predicate) rows, with duplicates"""
+    rng = np.random.RandomState(seed)
+    return np.column_stack((rng.randint(n_entities, size=n_triples),
+                            rng.randint(n_entities, size=n_triples),
+                            rng.randint(n_relations, size=n_triples)))
+
+
+class TriplesArrayTest(unittest.TestCase):
+    def test_list(self):
+        xs = graph_statistics.triples_array([(1, 2, 0), (3, 4, 1)])
+        self.assertEqual(xs.shape, (2, 3))
+        self.assertEqual(xs.dtype, np.int64)
+
+    def test_empty(self):
+        self.assertEqual(graph_statistics.triples_array([]).shape, (0, 3))
+
+
+class UniqueTriplesTest(unittest.TestCase):
+    def test_removes_duplicates(self):
+        xs = random_triples(500, 10, 3)
+        unique = graph_statistics.unique_triples(xs, 10, 3)
+        self.assertEqual(set(map(tuple, unique.tolist())),
+                         set(map(tuple, xs.tolist())))
+        self.assertEqual(len(unique), len(set(map(tuple, xs.tolist()))))
+
+    def test_keys_over_64_bits(self):
+        # The keys would overflow, so the rows are compared
+        xs = random_triples(500, 10, 3) * [2 ** 30, 2 ** 30, 1]
+        unique = graph_statistics.unique_triples(xs, 2 ** 34, 3)
+        self.assertEqual(set(map(tuple, unique.tolist())),
+                         set(map(tuple, xs.tolist())))
+        self.assertEqual(len(unique), len(set(map(tuple, xs.tolist()))))
+
+
+class CardinalitiesTest(unittest.TestCase):
+    def test_averages(self):
+        xs = random_triples(300, 15, 4)
+        cards, tph, hpt = graph_statistics.relation_cardinalities(xs, 15, 4)
+        unique = set(map(tuple, xs.tolist()))
+        for p in range(4):
+            triples = [x for x in unique if x[2] == p]
+            heads = set(x[0] for x in triples)
+            tails = set(x[1] for x in triples)
+            self.assertAlmostEqual(tph[p], len(triples) / len(heads))
+            self.assertAlmostEqual(hpt[p], len(triples) / len(tails))
+        classified = sum((cards[c] for c in cards), [])
+        self.assertEqual(sorted(classified), list(range(4)))
+
+    def test_classes(self):
+        xs = [(0, 1, 0), (2, 3, 0),                         # 1-1
+              (0, 5, 1), (1, 5, 1), (2, 5, 1),              # 1-N
+              (0, 1, 2), (0, 2, 2), (0, 3, 2),              # M-1
+              (0, 1, 3), (0, 2, 3), (1, 1, 3), (1, 2, 3)]   # M-N
+        cards, _, _ = graph_statistics.relation_cardinalities(xs, 6, 5)
+        self.assertEqual(cards['1-1'], [0])
+        self.assertEqual(cards['1-N'], [1])
+        self.assertEqual(cards['M-1'], [2])
+        self.assertEqual(cards['M-N'], [3, 4])
+
+    def test_relation_without_triples(self):
+        # Classified as M-N, like the sparse tensor averages of NaN did
+        xs = [(0, 1, 0), (2, 3, 0)]
+        cards, tph, hpt = graph_statistics.relation_cardinalities(xs, 4, 2)
+        self.assertEqual(cards['M-N'], [1])
+        self.assertEqual((tph[1], hpt[1]), (0.0, 0.0))
+
+
+class DegreesTest(unittest.TestCase):
+    def test_entity_degrees(self):
+        xs = random_triples(200, 12, 2)
+        degrees = graph_statistics.entity_degrees(xs, 12)
+        for entity in range(12):
+            expected = np.sum(xs[:, 0] == entity) + np.sum(xs[:, 1] == entity)
+            self.assertEqual(degrees[entity], expected)
+
+    def test_histogram(self):
+        histogram = graph_statistics.degree_histogram([0, 1, 2, 3, 4, 8])
+        self.assertEqual(histogram['bins'], [0, 1, 2, 4, 8])
+        self.assertEqual(histogram['counts'], [1, 1, 2, 1, 1])
+
+    def test_empty_histogram(self):
+        self.assertEqual(graph_statistics.degree_histogram([]),
+                         {'bins': [], 'counts': []})
+
+
+class ComputeStatisticsTest(unittest.TestCase):
+    def test_statistics(self):
+        xs = [(0, 1, 0), (0, 1, 0), (1, 2, 1), (2, 0, 1)]
+        statistics = graph_statistics.compute_statistics(xs, 4, 2)
+        self.assertEqual(statistics['triples'], 3)
+        self.assertEqual(statistics['relation_counts'], [1, 2])
+        self.assertEqual(statistics['out_degree']['max'], 1)
+        self.assertEqual(statistics['in_degree']['histogram']['counts'],
+                         [1, 3])
+        # Only builtin types, so it is saved as JSON
+        self.assertEqual(json.loads(json.dumps(statistics)), statistics)
+
+    def test_empty(self):
+        statistics = graph_statistics.compute_statistics([], 0, 0)
+        self.assertEqual(statistics['triples'], 0)
+        self.assertEqual(statistics['out_degree']['mean'], 0.0)
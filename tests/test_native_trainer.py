@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# test_native_trainer.py: Tests of the gradients of the native models
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import numpy as np
+import kgeserver.native_trainer as native_trainer
+
+# Triples of a batch and a corrupted triple for each one
+POS = np.array([[1, 2, 0], [3, 4, 1], [1, 5, 0], [6, 1, 2]])
+NEG = np.array([[1, 7, 0], [9, 4, 1], [8, 2, 0], [6, 3, 2]])
+
+
+class GradientsTest(unittest.TestCase):
+    """Compares the gradients with finite differences of the loss"""
+    STEP = 1e-6
+
+    def model(self, model_type, margin, **kwargs):
+        np.random.seed(0)
+        model = model_type((10, 10, 3), 8, dtype=np.float64, **kwargs)
+        model.margin = margin
+        return model
+
+    def loss(self, model):
+        """Margin ranking loss of the batch"""
+        fp = model._scores(POS[:, 0], POS[:, 2], POS[:, 1])
+        fn = model._scores(NEG[:, 0], NEG[:, 2], NEG[:, 1])
+        # TransE ranks its distances, without activation function
+        if not isinstance(model, native_trainer.TransE):
+            fp, fn = model._activation(fp), model._activation(fn)
+        violations = fn + model.margin > fp
+        return np.sum((model.margin - fp + fn)[violations])
+
+    def check_gradients(self, model):
+        n_violations, loss, grads = model._pairwise_gradients(POS, NEG)
+        self.assertEqual(n_violations, len(POS))
+        self.assertAlmostEqual(loss, self.loss(model))
+        self.assertEqual(sorted(grads), ['E', 'R'])
+        for name, (rows, grad) in grads.items():
+            # Each row is updated once
+            self.assertEqual(len(rows), len(set(rows.tolist())))
+            param = model._params[name]
+            numeric = np.zeros_like(grad)
+            for i, row in enumerate(rows):
+                for k in range(param.shape[1]):
+                    value = param[row, k]
+                    param[row, k] = value + self.STEP
+                    plus = self.loss(model)
+                    param[row, k] = value - self.STEP
+                    minus = self.loss(model)
+                    param[row, k] = value
+                    numeric[i, k] = (plus - minus) / (2 * self.STEP)
+            np.testing.assert_allclose(grad, numeric, atol=1e-6)
+
+    def test_transe(self):
+        self.check_gradients(self.model(native_trainer.TransE, 5.0))
+
+    def test_hole_sigmoid(self):
+        self.check_gradients(self.model(native_trainer.HolE, 1.0))
+
+    def test_hole_linear(self):
+        self.check_gradients(self.model(native_trainer.HolE, 1.0,
+                                        af='linear'))
+
+    def test_no_violations(self):
+        model = self.model(native_trainer.TransE, -100.0)
+        self.assertEqual(model._pairwise_gradients(POS, NEG), (0, 0.0, {}))
+
+    def test_regularization(self):
+        model = self.model(native_trainer.TransE, 5.0)
+        _, _, grads = model._pairwise_gradients(POS, NEG)
+        model.rparam = 0.1
+        _, _, regularized = model._pairwise_gradients(POS, NEG)
+        for name, (rows, grad) in grads.items():
+            np.testing.assert_array_equal(regularized[name][0], rows)
+            np.testing.assert_allclose(
+                regularized[name][1],
+                grad + 0.1 * model._params[name][rows])
+
+
+class HelpersTest(unittest.TestCase):
+    def test_sum_rows(self):
+        rng = np.random.RandomState(0)
+        rows = rng.randint(6, size=40)
+        grads = rng.randn(40, 3)
+        unique, summed = native_trainer.sum_rows(rows, grads)
+        expected = np.zeros((6, 3))
+        np.add.at(expected, rows, grads)
+        np.testing.assert_array_equal(unique, np.unique(rows))
+        np.testing.assert_allclose(summed, expected[unique])
+
+    def test_ccorr_cconv(self):
+        rng = np.random.RandomState(0)
+        a, b = rng.randn(2, 5), rng.randn(2, 5)
+        # Direct definitions, on every row
+        corr = [[sum(x[i] * y[(k + i) % 5] for i in range(5))
+                 for k in range(5)] for x, y in zip(a, b)]
+        conv = [[sum(x[i] * y[(k - i) % 5] for i in range(5))
+                 for k in range(5)] for x, y in zip(a, b)]
+        np.testing.assert_allclose(native_trainer.ccorr(a, b), corr)
+        np.testing.assert_allclose(native_trainer.cconv(a, b), conv)
+
+    def test_constraints(self):
+        rows = np.array([[3.0, 4.0], [0.3, 0.4], [0.0, 0.0]])
+        np.testing.assert_allclose(np.linalg.norm(
+            native_trainer.normalize(rows)[:2], axis=1), [1, 1])
+        np.testing.assert_allclose(np.linalg.norm(
+            native_trainer.normless1(rows), axis=1), [1, 0.5, 0])
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# test_quantization.py: Tests of the quantized embeddings of kgeserver
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import kgeserver.quantization as quantization
+
+
+class QuantizedEmbeddingsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.matrix = np.random.RandomState(0).randn(300, 16)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        for dtype in quantization.DTYPES:
+            path = os.path.join(self.directory, "e_{}.bin".format(dtype))
+            quantized = quantization.QuantizedEmbeddings.quantize(
+                self.matrix, dtype)
+            quantized.report = {'dtype': dtype}
+            quantized.save(path)
+            loaded = quantization.QuantizedEmbeddings.load(path)
+            self.assertEqual(loaded.dtype, dtype)
+            self.assertEqual(loaded.report, {'dtype': dtype})
+            self.assertEqual(loaded.shape, self.matrix.shape)
+            np.testing.assert_array_equal(loaded[:], quantized[:])
+            np.testing.assert_allclose(loaded[5], self.matrix[5], atol=0.05)
+            self.assertEqual(loaded[[1, 2]].shape, (2, 16))
+            # The rows are mapped read only from the file
+            with self.assertRaises(ValueError):
+                loaded.data[0, 0] = 1
+
+    def test_load_embeddings(self):
+        class Model():
+            E = self.matrix
+
+        def load_model(path):
+            return Model()
+
+        model_path = os.path.join(self.directory, "d_model.bin")
+        # Without a quantized copy, the model is loaded
+        embeddings = quantization.load_embeddings(model_path, load_model)
+        self.assertIs(embeddings, self.matrix)
+        quantization.quantize_model(Model(), model_path, 'int8')
+        # float16 is the default, and int8 must be asked for
+        embeddings = quantization.load_embeddings(model_path, load_model)
+        self.assertIs(embeddings, self.matrix)
+        embeddings = quantization.load_embeddings(model_path, load_model,
+                                                  'int8')
+        self.assertEqual(embeddings.dtype, 'int8')
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# test_sampling.py: Tests of the indexes of kgeserver.sampling
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import numpy as np
+import kgeserver.sampling as sampling
+
+
+def random_triples(n_triples, n_entities, n_relations, seed=0):
+    """Random (subject, object, predicate) rows, with duplicates"""
+    rng = np.random.RandomState(seed)
+    return np.column_stack((rng.randint(n_entities, size=n_triples),
+                            rng.randint(n_entities, size=n_triples),
+                            rng.randint(n_relations, size=n_triples)))
+
+
+class TripleIndexTest(unittest.TestCase):
+    def check_contains(self, true_triples, queries, index):
+        known = set(map(tuple, true_triples.tolist()))
+        expected = [tuple(x) in known for x in queries.tolist()]
+        self.assertEqual(index.contains(queries).tolist(), expected)
+        self.assertTrue(index.contains(true_triples).all())
+
+    def test_contains(self):
+        true_triples = random_triples(300, 20, 4)
+        queries = random_triples(1000, 20, 4, seed=1)
+        index = sampling.TripleIndex(true_triples, 20, 4)
+        self.assertFalse(index.records)
+        self.check_contains(true_triples, queries, index)
+
+    def test_keys_over_64_bits(self):
+        n_entities = 2 ** 31
+        scale = [2 ** 26, 2 ** 26, 1]
+        true_triples = random_triples(300, 20, 4) * scale
+        queries = random_triples(1000, 20, 4, seed=1) * scale
+        index = sampling.TripleIndex(true_triples, n_entities, 4)
+        self.assertTrue(index.records)
+        self.check_contains(true_triples, queries, index)
+        # The int64 keys of these triples would be the same
+        overflow = np.array([[0, 0, 4], [0, 0, 0]], dtype=np.int64)
+        index = sampling.TripleIndex(overflow[:1], n_entities, 5)
+        self.assertEqual(index.contains(overflow).tolist(), [True, False])
+
+    def test_empty(self):
+        index = sampling.TripleIndex([], 10, 2)
+        queries = random_triples(5, 10, 2)
+        self.assertFalse(index.contains(queries).any())
+
+
+class TypeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.xs = random_triples(200, 30, 5)
+        self.index = sampling.TypeIndex(self.xs, 6)
+
+    def test_sizes(self):
+        ps = np.arange(5)
+        for p, domain, rng in zip(ps, self.index.domain_size(ps),
+                                  self.index.range_size(ps)):
+            triples = self.xs[self.xs[:, 2] == p]
+            self.assertEqual(domain, len(set(triples[:, 0])))
+            self.assertEqual(rng, len(set(triples[:, 1])))
+        # A relation without triples
+        self.assertEqual(self.index.domain_size(np.array([5]))[0], 0)
+
+    def test_samples_are_typed(self):
+        rng = np.random.RandomState(0)
+        ps = rng.randint(5, size=2000)
+        heads = self.index.sample_heads(ps, rng)
+        tails = self.index.sample_tails(ps, rng)
+        for p in range(5):
+            triples = self.xs[self.xs[:, 2] == p]
+            self.assertEqual(set(heads[ps == p]), set(triples[:, 0]))
+            self.assertEqual(set(tails[ps == p]), set(triples[:, 1]))
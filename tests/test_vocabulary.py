@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding:utf-8
+#
+# test_vocabulary.py: Tests of the memory mapped files of kgeserver.vocabulary
+# Copyright (C) 2017 Víctor Fernández Rico <vfrico@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import kgeserver.vocabulary as vocabulary
+
+
+class ArraysFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "arrays.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        arrays = {'ints': np.arange(10, dtype=np.int32).reshape(5, 2),
+                  'floats': np.linspace(0, 1, 7),
+                  'bytes': np.frombuffer(b"abc", dtype=np.uint8),
+                  'empty': np.zeros((0, 3), dtype=np.int64)}
+        meta = {'n_entities': 10, 'name': "test"}
+        vocabulary.write_arrays(self.path, meta, arrays)
+        read_meta, read = vocabulary.read_arrays(self.path)
+        self.assertEqual(read_meta, meta)
+        self.assertEqual(sorted(read), sorted(arrays))
+        for name, array in arrays.items():
+            self.assertEqual(read[name].dtype, array.dtype)
+            np.testing.assert_array_equal(read[name], array)
+        # The arrays are mapped read only
+        with self.assertRaises(ValueError):
+            read['ints'][0, 0] = 1
+        self.assertEqual(os.listdir(self.directory), ["arrays.bin"])
+
+    def test_replace(self):
+        vocabulary.write_arrays(self.path, {}, {'a': np.arange(4)})
+        _, first = vocabulary.read_arrays(self.path)
+        vocabulary.write_arrays(self.path, {}, {'a': np.arange(8) * 2})
+        _, second = vocabulary.read_arrays(self.path)
+        # A file already mapped keeps its arrays
+        np.testing.assert_array_equal(first['a'], np.arange(4))
+        np.testing.assert_array_equal(second['a'], np.arange(8) * 2)
+        self.assertEqual(oct(os.stat(self.path).st_mode & 0o777), "0o644")
+        self.assertEqual(os.listdir(self.directory), ["arrays.bin"])
+
+    def test_failed_write(self):
+        class BrokenArray():
+            dtype = np.dtype(np.int64)
+            shape = (2,)
+            nbytes = 16
+
+            def __array__(self, *args, **kwargs):
+                raise RuntimeError("Broken array")
+
+        vocabulary.write_arrays(self.path, {}, {'a': np.arange(4)})
+        with self.assertRaises(RuntimeError):
+            vocabulary.write_arrays(self.path, {}, {'a': BrokenArray()})
+        # The temporary file is removed, and the file is not replaced
+        _, read = vocabulary.read_arrays(self.path)
+        np.testing.assert_array_equal(read['a'], np.arange(4))
+        self.assertEqual(os.listdir(self.directory), ["arrays.bin"])
+
+    def test_not_an_arrays_file(self):
+        with open(self.path, "wb") as other:
+            other.write(b"something else")
+        with self.assertRaises(ValueError):
+            vocabulary.read_arrays(self.path)
+
+
+class VocabularyTest(unittest.TestCase):
+    URIS = ["http://www.wikidata.org/entity/Q1",
+            "http://www.wikidata.org/entity/Q42",
+            "http://dbpedia.org/resource/España",
+            "http://example.org/ontology#Thing"]
+
+    def test_ids(self):
+        vocab = vocabulary.Vocabulary.build(self.URIS)
+        self.assertEqual([vocab.get(i) for i in range(4)], self.URIS)
+        self.assertEqual([vocab.get_id(uri) for uri in self.URIS],
+                         [0, 1, 2, 3])
+        self.assertEqual(vocab.get_ids(self.URIS + ["http://x/y"]).tolist(),
+                         [0, 1, 2, 3, -1])
+        self.assertIsNone(vocab.get(4))
+
+    def test_local_lookup(self):
+        vocab = vocabulary.Vocabulary.build(self.URIS, local_lookup=True)
+        self.assertEqual(vocab.get_id("Q42"), 1)
+        self.assertEqual(vocab.get_id("http://other.org/Q42"), 1)
+        vocab = vocabulary.Vocabulary.build(self.URIS)
+        self.assertEqual(vocab.get_id("http://other.org/Q42"), -1)
+
+    def test_batch_matches_single_lookups(self):
+        vocab = vocabulary.Vocabulary.build(self.URIS, local_lookup=True)
+        queries = self.URIS + ["Q42", "http://other.org/Q1",
+                               "http://www.wikidata.org/entity/Q2",
+                               "http://www.wikidata.org/entity/Q421",
+                               "http://dbpedia.org/resource/Espana", ""]
+        self.assertEqual(vocab.get_ids(queries).tolist(),
+                         [vocab.get_id(uri) for uri in queries])
+
+    def test_hash_collisions(self):
+        # Every URI gets the same hash, so only the bytes tell them apart
+        hashes, uri_hash = vocabulary._hashes, vocabulary.uri_hash
+        vocabulary._hashes = lambda uris: np.zeros(len(uris), dtype='<u8')
+        vocabulary.uri_hash = lambda uri: 0
+        try:
+            vocab = vocabulary.Vocabulary.build(self.URIS)
+            queries = list(reversed(self.URIS)) + ["http://x/y"]
+            self.assertEqual(vocab.get_ids(queries).tolist(),
+                             [3, 2, 1, 0, -1])
+        finally:
+            vocabulary._hashes, vocabulary.uri_hash = hashes, uri_hash